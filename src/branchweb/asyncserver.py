@@ -0,0 +1,484 @@
+import asyncio
+import inspect
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import ratelimit
+from .webserver import web_server, webstatus, WEB_CONFIG, FILE_CHUNK_SIZE, access, debug, refusal
+from .bodyparser import body_too_large, length_reader, parse_chunk_size, LINE_LIMIT
+
+#
+# file-like wrapper around an asyncio StreamWriter
+#
+# Writes from the event loop thread are buffered in the transport,
+# writes from executor threads block until the transport drained.
+# A client that takes no data for WEB_CONFIG["read_timeout"] seconds
+# is disconnected, like the socket timeout of the other engines.
+#
+class async_wfile():
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.loop_thread = threading.get_ident()
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+        # a handler outlived the drain deadline
+        if(self.loop.is_closed()):
+            raise BrokenPipeError("The server stopped")
+
+        if(threading.get_ident() == self.loop_thread):
+            self.writer.write(data)
+        else:
+            asyncio.run_coroutine_threadsafe(self._write(data), self.loop).result()
+
+        return len(data)
+
+    async def _write(self, data):
+        if(self.writer.is_closing()):
+            raise BrokenPipeError("Client closed the connection")
+
+        self.writer.write(data)
+        await self.drain()
+
+    def flush(self):
+        pass
+
+    async def drain(self):
+        await self.within_timeout(self.writer.drain())
+
+    async def within_timeout(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, WEB_CONFIG["read_timeout"])
+        except asyncio.TimeoutError:
+            self.writer.transport.abort()
+            raise ConnectionResetError("Client stopped reading the response")
+
+    #
+    # Send count bytes of a regular file from offset with
+    # loop.sendfile, it copies the file if the transport
+    # can not use os.sendfile
+    #
+    async def sendfile(self, file, offset, count):
+        if(self.writer.is_closing()):
+            raise BrokenPipeError("Client closed the connection")
+
+        await self.drain()
+
+        while count > 0:
+            sent = await self.within_timeout(self.loop.sendfile(self.writer.transport, file, offset, min(count, FILE_CHUNK_SIZE)))
+            if(not sent):
+                break
+
+            self.written += sent
+            offset += sent
+            count -= sent
+
+#
+# await a read from the client, asyncio.TimeoutError if
+# no data arrives within WEB_CONFIG["read_timeout"] seconds
+#
+async def read_within(awaitable):
+    return await asyncio.wait_for(awaitable, WEB_CONFIG["read_timeout"])
+
+#
+# web_server handler for a single request read by the asyncio engine
+#
+class async_request(web_server):
+
+    # streaming.stream_subscriber the connection is handed to
+    stream = None
+
+    def __init__(self, server, client_address, head, wfile, requests_served):
+        self.server = server
+        self.client_address = client_address
+        self.request = None
+        self.rfile = io.BytesIO(head)
+        self.wfile = wfile
+        self.close_connection = True
+        self.requests_served = requests_served
+        self.body_length = None
+
+    def request_bytes_in(self):
+        return self.body_length or 0
+
+    #
+    # The transport may still buffer earlier writes, the
+    # engine hands the connection over after the handler
+    #
+    def hand_over(self, sub):
+        self.stream = sub
+
+    #
+    # Files are sent by the loop, handlers running in the
+    # executor wait until the transport took the whole range
+    #
+    def copy_file_range(self, file, offset, count, regular_file):
+        if(not regular_file or threading.get_ident() == self.wfile.loop_thread):
+            super().copy_file_range(file, offset, count, regular_file)
+            return
+
+        asyncio.run_coroutine_threadsafe(self.wfile.sendfile(file, offset, count), self.wfile.loop).result()
+
+    #
+    # The body was already read and decoded by the engine
+    #
+    def open_body(self):
+        if(self.body_length is None):
+            return None
+
+        return length_reader(self.rfile, self.body_length)
+
+    #
+    # flush the response of an async handler to the client
+    #
+    async def drain(self):
+        await self.wfile.drain()
+
+    #
+    # await an async endpoint handler, errors are reported
+    # to the client and never propagate
+    #
+    async def call_endpoint_async(self, real_path, ep, args, params):
+        self.endpoint = ep
+        started = time.perf_counter()
+
+        try:
+            await ep.handlerfunc(self, *args, **params)
+        except Exception as ex:
+            self.endpoint_failed(real_path, ex)
+        finally:
+            # other requests share the loop, only the total is known
+            if(self.trace is not None):
+                self.trace.add("handler", time.perf_counter() - started)
+
+#
+# asyncio based server engine
+#
+class async_server():
+
+    def __init__(self, hostname, serverport, workers = None, sock = None):
+        if(workers is None):
+            workers = WEB_CONFIG["async_workers"]
+
+        self.hostname = hostname
+        self.serverport = serverport
+        self.sock = sock
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="branchweb")
+        self.server = None
+        self.loop = None
+        self.stopping = False
+
+        # set once the server shuts down, see web_server.keep_alive_ends
+        self.draining = False
+
+        # set once the server listens, or failed to
+        self.ready = threading.Event()
+
+        # connection tasks, and the ones waiting for a request
+        self.connections = set()
+        self.idle = set()
+
+        # seconds drain() waits, WEB_CONFIG["shutdown_timeout"] if None,
+        # and whether all requests finished in time
+        self.drain_timeout = None
+        self.drained = None
+
+    #
+    # Run the event loop until the server is closed
+    #
+    def serve_forever(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.executor.shutdown(wait=False)
+            self.ready.set()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+
+        if(self.sock is not None):
+            self.server = await asyncio.start_server(self.handle_connection, sock=self.sock)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, self.hostname, self.serverport)
+
+        self.ready.set()
+
+        async with self.server:
+            try:
+                # shutdown() may have been called while starting
+                if(not self.stopping):
+                    await self.server.serve_forever()
+            except asyncio.CancelledError:
+                # closed by shutdown()
+                pass
+
+            await self.drain()
+
+    #
+    # Stop accepting connections and let serve_forever return
+    # once the open ones are drained, callable from any thread
+    #
+    def shutdown(self):
+        self.stopping = True
+
+        if(self.loop is not None):
+            self.loop.call_soon_threadsafe(self.close_server)
+
+    def close_server(self):
+        if(self.server is not None):
+            self.server.close()
+
+    #
+    # Close idle connections and wait up to drain_timeout
+    # seconds for the ones serving a request
+    #
+    async def drain(self):
+        self.draining = True
+        timeout = self.drain_timeout if self.drain_timeout is not None else WEB_CONFIG["shutdown_timeout"]
+
+        for task in list(self.idle):
+            task.cancel()
+
+        if(self.connections):
+            await asyncio.wait(list(self.connections), timeout=timeout)
+
+        self.drained = web_server.active_requests.in_flight == 0
+
+    #
+    # Handle requests on a connection until the client
+    # or the response asks for it to be closed
+    #
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info("peername")
+        wfile = async_wfile(loop, writer)
+        requests_served = 0
+        task = asyncio.current_task()
+        self.connections.add(task)
+
+        if(not ratelimit.connections.open(client_address[0])):
+            ratelimit.connections.close(client_address[0])
+            self.connections.discard(task)
+            writer.write(refusal("429 Too Many Requests", "Too many connections.", 1))
+            writer.close()
+            return
+
+        try:
+            while True:
+                self.idle.add(task)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), WEB_CONFIG["keepalive_timeout"])
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                    break
+                finally:
+                    self.idle.discard(task)
+
+                requests_served += 1
+                req = async_request(self, client_address, head, wfile, requests_served)
+                try:
+                    if(not await self.handle_request(loop, reader, writer, req)):
+                        break
+                finally:
+                    req.record_request()
+
+                if(req.close_connection or req.keep_alive_ends()):
+                    break
+
+        except ConnectionError:
+            debug("Client closed socket before request could be completed.")
+        except asyncio.CancelledError:
+            # idle on shutdown, or still busy at the drain deadline
+            debug("Connection closed on shutdown.")
+        finally:
+            ratelimit.connections.close(client_address[0])
+            self.connections.discard(task)
+            writer.close()
+
+    #
+    # Parse, read and dispatch one request
+    # Returns False if the connection can not be reused
+    #
+    async def handle_request(self, loop, reader, writer, req):
+        req.raw_requestline = req.rfile.readline(65537)
+        if(not req.parse_request()):
+            return False
+
+        # requires_auth endpoints reject before the body is read
+        resolved = None
+        if(req.command in ("GET", "POST")):
+            access("Handling API-{} request from {}..", req.command.lower(), req.client_address)
+
+            resolved = req.resolve_endpoint(req.command)
+            if(resolved is None):
+                await req.wfile.drain()
+                return not req.close_connection
+
+        try:
+            body = await self.read_body(reader, req)
+        except body_too_large:
+            req.close_connection = True
+            req.send_web_response(webstatus.SERV_FAILURE, "Request body too large.")
+            return False
+        except ValueError:
+            req.send_error(400, "Malformed request body")
+            return False
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            return False
+
+        req.rfile = body
+        try:
+            await self.dispatch(loop, req, resolved)
+        finally:
+            body.close()
+
+        if(req.stream is not None):
+            await self.hand_over(writer, req.stream)
+            return False
+
+        await req.wfile.drain()
+        return True
+
+    #
+    # Give a duplicate of the connection socket to the stream hub
+    # once everything written so far left the transport, closing
+    # the transport then leaves the connection open
+    #
+    @staticmethod
+    async def hand_over(writer, sub):
+        try:
+            writer.transport.set_write_buffer_limits(0)
+            await writer.drain()
+        except BaseException:
+            sub.close()
+            raise
+
+        sock = writer.transport.get_extra_info("socket")
+        sub.hub.attach(sub, socket.socket(fileno=os.dup(sock.fileno())))
+
+    #
+    # Read the request body into a spooled temporary file,
+    # decoding chunked transfer encoding on the way. Every read
+    # waits up to WEB_CONFIG["read_timeout"] seconds for data.
+    #
+    async def read_body(self, reader, req):
+        max_size = WEB_CONFIG["max_body_size"]
+        body = tempfile.SpooledTemporaryFile(max_size=WEB_CONFIG["upload_spool_threshold"])
+        total = 0
+
+        try:
+            transfer_encoding = req.headers.get("Transfer-Encoding")
+            if(transfer_encoding is not None and transfer_encoding.lower() == "chunked"):
+                while True:
+                    line = await read_within(reader.readline())
+                    size = parse_chunk_size(line)
+
+                    if(size == 0):
+                        # skip trailers
+                        while line not in (b"\r\n", b"\n", b""):
+                            line = await read_within(reader.readline())
+                        break
+
+                    total += size
+                    if(total > max_size):
+                        raise body_too_large()
+
+                    await self.copy_body(reader, body, size)
+                    await read_within(reader.readline())
+
+            else:
+                length = req.headers.get("Content-Length")
+                if(length is None):
+                    body.seek(0)
+                    return body
+
+                total = int(length)
+                if(total < 0):
+                    raise ValueError("Negative Content-Length")
+
+                if(total > max_size):
+                    raise body_too_large()
+
+                await self.copy_body(reader, body, total)
+
+            req.body_length = total
+            body.seek(0)
+            return body
+
+        except BaseException:
+            body.close()
+            raise
+
+    @staticmethod
+    async def copy_body(reader, body, count):
+        while count > 0:
+            data = await read_within(reader.read(min(count, LINE_LIMIT)))
+            if(not data):
+                raise asyncio.IncompleteReadError(b"", count)
+
+            body.write(data)
+            count -= len(data)
+
+    #
+    # Run the handler for a parsed request, async def endpoints
+    # run on the loop, everything else in the executor
+    #
+    # resolved: the resolve_endpoint result of GET and POST requests
+    #
+    async def dispatch(self, loop, req, resolved):
+        if(req.command == "OPTIONS"):
+            await loop.run_in_executor(self.executor, req.do_OPTIONS)
+            return
+
+        if(resolved is None):
+            req.send_error(501, "Unsupported method ({})".format(req.command))
+            return
+
+        real_path, ep, form_dict, params = resolved
+
+        if(inspect.iscoroutinefunction(ep.handlerfunc)):
+            args = (form_dict, )
+
+            if(req.command == "POST"):
+                post_data = req.read_post_data()
+                if(post_data is None):
+                    return
+
+                args = (form_dict, post_data)
+
+            try:
+                await req.call_endpoint_async(real_path, ep, args, params)
+            finally:
+                if(req.command == "POST"):
+                    web_server.close_uploads(args[1])
+        else:
+            await loop.run_in_executor(self.executor, self.run_sync, req, real_path, ep, form_dict, params)
+
+    @staticmethod
+    def run_sync(req, real_path, ep, form_dict, params):
+        args = (form_dict, )
+
+        if(req.command == "POST"):
+            post_data = req.read_post_data()
+            if(post_data is None):
+                return
+
+            args = (form_dict, post_data)
+
+            try:
+                req.call_endpoint(real_path, ep, args, params)
+            finally:
+                web_server.close_uploads(post_data)
+
+            return
+
+        req.call_endpoint(real_path, ep, args, params)
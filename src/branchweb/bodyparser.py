@@ -0,0 +1,308 @@
+import io
+import re
+import tempfile
+
+from email.message import Message
+
+# maximum length of a single line read while parsing
+LINE_LIMIT = 64 * 1024
+
+# the size of a chunk, at most 16 hex digits
+CHUNK_SIZE = re.compile(rb"[0-9A-Fa-f]{1,16}")
+
+#
+# Raised if a request body exceeds the configured maximum size
+#
+class body_too_large(Exception):
+    pass
+
+#
+# reader for a body of known length
+#
+class length_reader():
+
+    def __init__(self, rfile, length: int):
+        self.rfile = rfile
+        self.length = length
+        self.remaining = length
+
+    def consumed(self) -> int:
+        return self.length - self.remaining
+
+    def read(self, size: int = -1) -> bytes:
+        if(size < 0 or size > self.remaining):
+            size = self.remaining
+
+        if(size == 0):
+            return b""
+
+        data = self.rfile.read(size)
+        if(not data):
+            raise ValueError("Request body ended early")
+
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, limit: int = -1) -> bytes:
+        if(limit < 0 or limit > self.remaining):
+            limit = self.remaining
+
+        if(limit == 0):
+            return b""
+
+        line = self.rfile.readline(limit)
+        if(not line):
+            raise ValueError("Request body ended early")
+
+        self.remaining -= len(line)
+        return line
+
+    #
+    # Skip the rest of the body so the connection can be reused
+    #
+    def discard(self):
+        while self.read(LINE_LIMIT):
+            pass
+
+#
+# Returns the size of a chunk from its size line, extensions
+# after ";" are ignored. Raises ValueError if it is not hex.
+#
+def parse_chunk_size(line: bytes) -> int:
+    size = line.split(b";", 1)[0].strip()
+
+    if(CHUNK_SIZE.fullmatch(size) is None):
+        raise ValueError("Malformed chunk size")
+
+    return int(size, 16)
+
+#
+# reader decoding a Transfer-Encoding: chunked body
+#
+class chunked_reader():
+
+    def __init__(self, rfile, max_size: int):
+        self.rfile = rfile
+        self.max_size = max_size
+        self.total = 0
+        self.chunk_left = 0
+        self.done = False
+
+    def consumed(self) -> int:
+        return self.total - self.chunk_left
+
+    def next_chunk(self) -> bool:
+        if(self.done):
+            return False
+
+        if(self.total > 0):
+            # CRLF terminating the previous chunk
+            self.rfile.readline(LINE_LIMIT)
+
+        line = self.rfile.readline(LINE_LIMIT)
+        if(not line):
+            raise ValueError("Request body ended early")
+
+        size = parse_chunk_size(line)
+
+        if(size == 0):
+            # skip trailers
+            while line not in (b"\r\n", b"\n", b""):
+                line = self.rfile.readline(LINE_LIMIT)
+
+            self.done = True
+            return False
+
+        self.total += size
+        if(self.total > self.max_size):
+            raise body_too_large()
+
+        self.chunk_left = size
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        parts = [ ]
+
+        while size != 0:
+            if(self.chunk_left == 0 and not self.next_chunk()):
+                break
+
+            n = self.chunk_left if size < 0 else min(size, self.chunk_left)
+            data = self.rfile.read(n)
+            if(not data):
+                raise ValueError("Request body ended early")
+
+            self.chunk_left -= len(data)
+            parts.append(data)
+
+            if(size > 0):
+                size -= len(data)
+
+        return b"".join(parts)
+
+    def readline(self, limit: int = -1) -> bytes:
+        parts = [ ]
+
+        while limit != 0:
+            if(self.chunk_left == 0 and not self.next_chunk()):
+                break
+
+            n = self.chunk_left if limit < 0 else min(limit, self.chunk_left)
+            data = self.rfile.readline(n)
+            if(not data):
+                raise ValueError("Request body ended early")
+
+            self.chunk_left -= len(data)
+            parts.append(data)
+
+            if(limit > 0):
+                limit -= len(data)
+
+            if(data.endswith(b"\n")):
+                break
+
+        return b"".join(parts)
+
+    def discard(self):
+        while self.read(LINE_LIMIT):
+            pass
+
+#
+# file part of a multipart/form-data body
+#
+# Small uploads stay in memory, larger ones are
+# spooled to a temporary file.
+#
+class upload():
+
+    def __init__(self, file, filename: str, content_type: str):
+        self.file = file
+        self.filename = filename
+        self.content_type = content_type
+
+    def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+#
+# Parse a Content-Type or Content-Disposition style header
+# Returns the value and a dict of its parameters
+#
+def parse_header(name: str, value: str):
+    msg = Message()
+    msg[name] = value
+
+    params = msg.get_params(header=name, unquote=True)
+    if(not params):
+        return "", { }
+
+    return params[0][0].lower(), { k.lower(): v for k, v in params[1:] }
+
+#
+# Parse a multipart/form-data body from a reader
+#
+# Plain fields become str values, file parts upload objects
+# that are spooled to disk above spool_threshold bytes.
+#
+def parse_multipart(reader, boundary: bytes, spool_threshold: int) -> dict:
+    delim = b"--" + boundary
+    fields = { }
+
+    # skip the preamble
+    while True:
+        line = reader.readline(LINE_LIMIT)
+        if(not line):
+            raise ValueError("Multipart body without boundary")
+
+        stripped = line.rstrip()
+        if(stripped == delim):
+            break
+        if(stripped == delim + b"--"):
+            return fields
+
+    last = False
+    while not last:
+        headers = { }
+        while True:
+            line = reader.readline(LINE_LIMIT)
+            if(not line):
+                raise ValueError("Multipart body ended in part headers")
+
+            if(line in (b"\r\n", b"\n")):
+                break
+
+            key, _, value = line.decode("utf-8", "replace").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        _, disposition = parse_header("Content-Disposition", headers.get("content-disposition", ""))
+        name = disposition.get("name")
+        filename = disposition.get("filename")
+
+        if(filename is not None):
+            sink = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        else:
+            sink = io.BytesIO()
+
+        # the line break before a delimiter belongs to the delimiter
+        pending = b""
+        at_line_start = True
+        while True:
+            line = reader.readline(LINE_LIMIT)
+            if(not line):
+                raise ValueError("Multipart body ended in part data")
+
+            # the line limit split a CRLF
+            if(pending == b"\r" and line == b"\n"):
+                pending = b"\r\n"
+                at_line_start = True
+                continue
+
+            if(at_line_start and line.startswith(delim)):
+                stripped = line.rstrip()
+                if(stripped == delim):
+                    break
+                if(stripped == delim + b"--"):
+                    last = True
+                    break
+
+            sink.write(pending)
+
+            if(line.endswith(b"\r\n")):
+                pending = b"\r\n"
+                line = line[:-2]
+            elif(line.endswith(b"\n")):
+                pending = b"\n"
+                line = line[:-1]
+            elif(line.endswith(b"\r")):
+                # data, unless the next read starts with LF
+                pending = b"\r"
+                line = line[:-1]
+            else:
+                pending = b""
+
+            at_line_start = pending in (b"\r\n", b"\n")
+            sink.write(line)
+
+        if(name is None):
+            sink.close()
+            continue
+
+        previous = fields.get(name)
+        if(isinstance(previous, upload)):
+            previous.close()
+
+        if(filename is not None):
+            sink.seek(0)
+            fields[name] = upload(sink, filename, headers.get("content-type", "application/octet-stream"))
+        else:
+            fields[name] = sink.getvalue().decode("utf-8", "replace")
+
+    return fields
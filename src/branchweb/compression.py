@@ -0,0 +1,114 @@
+import functools
+import zlib
+
+# zstd is optional, it is only offered if the zstandard module is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# encodings in order of preference on equal quality
+if(zstandard is not None):
+    SUPPORTED_ENCODINGS = ("zstd", "gzip", "deflate")
+else:
+    SUPPORTED_ENCODINGS = ("gzip", "deflate")
+
+# zlib wbits for the supported zlib based encodings
+ZLIB_WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS
+}
+
+#
+# Pick the best supported encoding from an Accept-Encoding header
+# offered: the encodings to choose from in order of preference,
+#          e.g. the precompressed variants of a file
+# Returns the encoding name or None for identity
+#
+@functools.lru_cache(maxsize=256)
+def negotiate(accept_encoding: str, offered: tuple = SUPPORTED_ENCODINGS):
+    qualities = { }
+
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if(not name):
+            continue
+
+        q = 1.0
+        params = params.strip()
+        if(params.startswith("q=")):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+
+        qualities[name] = q
+
+    best = None
+    best_q = 0.0
+    for encoding in offered:
+        q = qualities.get(encoding, qualities.get("*", 0.0))
+        if(q > best_q):
+            best = encoding
+            best_q = q
+
+    return best
+
+#
+# Compress data in one go
+#
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    if(encoding == "zstd"):
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    c = zlib.compressobj(level, zlib.DEFLATED, ZLIB_WBITS[encoding])
+    return c.compress(data) + c.flush()
+
+#
+# incremental compressor for streamed bodies
+#
+class compressor():
+
+    def __init__(self, encoding: str, level: int):
+        if(encoding == "zstd"):
+            self.obj = zstandard.ZstdCompressor(level=level).compressobj()
+            self.sync_flush = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self.obj = zlib.compressobj(level, zlib.DEFLATED, ZLIB_WBITS[encoding])
+            self.sync_flush = zlib.Z_SYNC_FLUSH
+
+    #
+    # Compress a piece of the body, with flush set everything
+    # passed so far can be decoded by the client
+    #
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        out = self.obj.compress(data)
+
+        if(flush):
+            out += self.obj.flush(self.sync_flush)
+
+        return out
+
+    def finish(self) -> bytes:
+        return self.obj.flush()
+
+#
+# response body that is sent repeatedly, its compressed
+# variants are computed once and kept with it
+#
+class static_response():
+
+    def __init__(self, data: bytes, content_type: str):
+        self.data = data
+        self.content_type = content_type
+        self.variants: dict[str, bytes] = { }
+
+    def compressed(self, encoding: str, level: int) -> bytes:
+        variant = self.variants.get(encoding)
+
+        if(variant is None):
+            variant = compress(self.data, encoding, level)
+            self.variants[encoding] = variant
+
+        return variant
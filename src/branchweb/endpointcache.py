@@ -0,0 +1,308 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import inspect
+import threading
+import time
+
+from . import compression
+from . import metrics
+from . import webserver
+
+#
+# a cached response, the body is kept pre-encoded
+# together with its compressed variants
+#
+class cache_entry():
+
+    def __init__(self, http_status: int, webstatus: str, static: compression.static_response, expires: float):
+        self.http_status = http_status
+        self.webstatus = webstatus
+        self.static = static
+        self.expires = expires
+
+        # compressed variants are added later and are
+        # smaller than the body, count them up front
+        self.size = 2 * len(static.data)
+
+#
+# endpoint_cache class
+#
+# Responses of GET endpoints keyed by route, form data and
+# route parameters. Entries expire after their TTL, the least
+# recently used ones are evicted beyond max_entries or max_bytes.
+# Concurrent misses of a key wait for the first one instead of
+# running the handler again.
+#
+class endpoint_cache():
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None):
+        if(max_entries is None):
+            max_entries = webserver.WEB_CONFIG["endpoint_cache_entries"]
+
+        if(max_bytes is None):
+            max_bytes = webserver.WEB_CONFIG["endpoint_cache_bytes"]
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        # key -> Future of the cache_entry being computed
+        self.pending: dict[tuple, concurrent.futures.Future] = { }
+
+        # bumped on invalidation, results computed across
+        # an invalidation of their route are not stored
+        self.generation = 0
+        self.route_generations: dict[str, int] = { }
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(route: str, form_data: dict, params: dict, user: str = None) -> tuple:
+        form = ()
+        if(form_data):
+            # all values of repeated fields, in the order they were sent
+            pairs = getattr(form_data, "pairs", None) or tuple(form_data.items())
+            form = tuple(sorted(pairs, key=lambda pair: pair[0]))
+
+        return (route, form, tuple(sorted(params.items())), user)
+
+    def get(self, key: tuple) -> cache_entry:
+        with self.lock:
+            entry = self.entries.get(key)
+            if(entry is None):
+                return None
+
+            if(entry.expires <= time.monotonic()):
+                self.remove(key)
+                return None
+
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple, entry: cache_entry, generation: tuple):
+        with self.lock:
+            if(generation != self.generation_of(key[0])):
+                return
+
+            if(key in self.entries):
+                self.remove(key)
+
+            self.entries[key] = entry
+            self.size += entry.size
+
+            while(self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes)):
+                self.remove(next(iter(self.entries)))
+
+    # called with the lock held
+    def remove(self, key: tuple):
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+
+    # called with the lock held
+    def generation_of(self, route: str) -> tuple:
+        return (self.generation, self.route_generations.get(route, 0))
+
+    def invalidate(self, route: str = None, form_data: dict = None, **params):
+        """
+        Drops cached responses, e.g. from a POST handler that changed their data
+
+        Args
+        ----
+            route (str, optional): The registered path of the endpoint. Defaults to all endpoints.
+            form_data (dict, optional): Only drop the response for this form data (and params)
+            params: Route parameters of the response to drop
+        """
+
+        with self.lock:
+            if(route is None):
+                self.entries.clear()
+                self.size = 0
+                self.generation += 1
+                return
+
+            self.route_generations[route] = self.route_generations.get(route, 0) + 1
+
+            if(form_data is None and not params):
+                for key in [ key for key in self.entries if key[0] == route ]:
+                    self.remove(key)
+            else:
+                # the responses of all users
+                target = endpoint_cache.make_key(route, form_data, params)[:3]
+                for key in [ key for key in self.entries if key[:3] == target ]:
+                    self.remove(key)
+
+    #
+    # Returns the pending Future of key and whether the
+    # caller is the one that has to compute it
+    #
+    def claim(self, key: tuple):
+        with self.lock:
+            future = self.pending.get(key)
+            if(future is not None):
+                self.coalesced += 1
+                return future, False, None
+
+            self.misses += 1
+            future = concurrent.futures.Future()
+            self.pending[key] = future
+            return future, True, self.generation_of(key[0])
+
+    #
+    # Store what the handler sent and wake up the waiting requests
+    #
+    def complete(self, key: tuple, future, generation: tuple, captured: list, webstatus: str, ttl: float):
+        entry = None
+
+        # only single, successful send_body responses are reusable
+        if(len(captured) == 1 and webstatus in ("", "SUCCESS")):
+            http_status, content_type, data, static = captured[0]
+
+            if(http_status == 200):
+                if(static is None):
+                    static = compression.static_response(data, content_type)
+
+                entry = cache_entry(http_status, webstatus, static, time.monotonic() + ttl)
+                self.put(key, entry, generation)
+
+        with self.lock:
+            self.pending.pop(key, None)
+
+        future.set_result(entry)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced
+            }
+
+    def collect_metrics(self) -> list:
+        """
+        Returns the cache gauges and counters for the metrics registry
+        """
+
+        stats = self.stats()
+
+        return [
+            ("branchweb_endpoint_cache_entries", "gauge", "Responses held by the endpoint cache.", { }, stats["entries"]),
+            ("branchweb_endpoint_cache_bytes", "gauge", "Estimated size of the cached responses.", { }, stats["bytes"]),
+            ("branchweb_endpoint_cache_hits_total", "counter", "Requests served from the endpoint cache.", { }, stats["hits"]),
+            ("branchweb_endpoint_cache_misses_total", "counter", "Requests that ran the handler to fill the cache.", { }, stats["misses"]),
+            ("branchweb_endpoint_cache_coalesced_total", "counter", "Requests that waited on a concurrent miss.", { }, stats["coalesced"])
+        ]
+
+    def lookup(self, httphandler, form_data: dict, params: dict):
+        # responses of requires_auth endpoints are kept per user
+        owner = httphandler.auth_user
+        key = endpoint_cache.make_key(httphandler.endpoint.path, form_data, params, owner.name if owner is not None else None)
+        entry = self.get(key)
+
+        if(entry is not None):
+            with self.lock:
+                self.hits += 1
+
+        return key, entry
+
+    def serve(self, httphandler, func, ttl: float, form_data: dict, params: dict):
+        key, entry = self.lookup(httphandler, form_data, params)
+        if(entry is not None):
+            send_entry(httphandler, entry)
+            return
+
+        future, leader, generation = self.claim(key)
+
+        if(not leader):
+            try:
+                entry = future.result(timeout=webserver.WEB_CONFIG["endpoint_cache_wait"])
+            except concurrent.futures.TimeoutError:
+                entry = None
+
+            if(entry is not None):
+                send_entry(httphandler, entry)
+            else:
+                func(httphandler, form_data, **params)
+
+            return
+
+        httphandler.response_capture = [ ]
+        try:
+            func(httphandler, form_data, **params)
+        finally:
+            captured = httphandler.response_capture
+            httphandler.response_capture = None
+            self.complete(key, future, generation, captured, httphandler.response_webstatus, ttl)
+
+    async def serve_async(self, httphandler, func, ttl: float, form_data: dict, params: dict):
+        key, entry = self.lookup(httphandler, form_data, params)
+        if(entry is not None):
+            send_entry(httphandler, entry)
+            return
+
+        future, leader, generation = self.claim(key)
+
+        if(not leader):
+            try:
+                entry = await asyncio.wait_for(asyncio.wrap_future(future), webserver.WEB_CONFIG["endpoint_cache_wait"])
+            except asyncio.TimeoutError:
+                entry = None
+
+            if(entry is not None):
+                send_entry(httphandler, entry)
+            else:
+                await func(httphandler, form_data, **params)
+
+            return
+
+        httphandler.response_capture = [ ]
+        try:
+            await func(httphandler, form_data, **params)
+        finally:
+            captured = httphandler.response_capture
+            httphandler.response_capture = None
+            self.complete(key, future, generation, captured, httphandler.response_webstatus, ttl)
+
+def send_entry(httphandler, entry: cache_entry):
+    httphandler.response_webstatus = entry.webstatus
+    httphandler.send_static(entry.static, entry.http_status)
+
+cache = endpoint_cache()
+metrics.registry.add_collector(cache.collect_metrics)
+
+#
+# Decorator caching the responses of a GET endpoint handler
+# for ttl seconds, WEB_CONFIG["endpoint_cache_ttl"] by default
+#
+# Only responses sent with a single send_body based call
+# (send_web_response, send_str_raw, ..) with webstatus
+# SUCCESS are cached. Handlers whose response depends on
+# anything but the route, form data and route parameters
+# (headers, cookies) must not be cached, except for the
+# user of requires_auth endpoints, which is part of the key.
+#
+def cached(ttl: float = None):
+    if(ttl is None):
+        ttl = webserver.WEB_CONFIG["endpoint_cache_ttl"]
+
+    def decorate(func):
+        if(inspect.iscoroutinefunction(func)):
+            async def wrapper(httphandler, form_data, **params):
+                await cache.serve_async(httphandler, func, ttl, form_data, params)
+        else:
+            def wrapper(httphandler, form_data, **params):
+                cache.serve(httphandler, func, ttl, form_data, params)
+
+        return functools.wraps(func)(wrapper)
+
+    return decorate
+
+def invalidate(route: str = None, form_data: dict = None, **params):
+    cache.invalidate(route, form_data, **params)
@@ -15,6 +15,27 @@ class key():
         self.key_id = str(uuid.uuid4())
         self.timestamp = time.time()
 
+    @staticmethod
+    def from_stored(key_id: str, timestamp: float) -> super:
+        """
+        Reconstructs a key that was persisted by a user store
+
+        Args
+        ----
+            key_id (str): The UUID of the key
+            timestamp (float): The time of the last refresh
+
+        Returns
+        -------
+        A key instance
+        """
+
+        k = key()
+        k.key_id = key_id
+        k.timestamp = timestamp
+
+        return k
+
     def refresh(self):
         """
         Refreshes the timestamp of this key
@@ -0,0 +1,270 @@
+import bisect
+import threading
+import weakref
+
+# upper bounds of the request latency histogram in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# fold the shards of exited threads once this many are registered
+SHARD_FOLD_THRESHOLD = 128
+
+#
+# metrics_shard class
+#
+# Counters written by a single thread only, so recording a
+# request needs no lock. The registry sums all shards when
+# the metrics are rendered.
+#
+class metrics_shard():
+
+    def __init__(self):
+        # (method, route, code, status) -> requests
+        self.requests: dict[tuple, int] = { }
+
+        # (method, route) -> [ bucket counts.., +Inf count, seconds sum, bytes in, bytes out ]
+        self.routes: dict[tuple, list] = { }
+
+        # result -> attempts
+        self.auth: dict[str, int] = { }
+
+        self.in_flight = 0
+
+    def merge(self, other):
+        for k, v in other.requests.items():
+            self.requests[k] = self.requests.get(k, 0) + v
+
+        for k, v in other.routes.items():
+            mine = self.routes.get(k)
+            if(mine is None):
+                self.routes[k] = list(v)
+            else:
+                for i in range(len(v)):
+                    mine[i] += v[i]
+
+        for k, v in other.auth.items():
+            self.auth[k] = self.auth.get(k, 0) + v
+
+        self.in_flight += other.in_flight
+
+#
+# metrics_registry class
+#
+# Request, traffic and auth metrics of this process in
+# per-thread shards, plus gauges supplied by collectors.
+#
+class metrics_registry():
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        # (thread, shard) of all threads that recorded something
+        self.shards: list[tuple] = [ ]
+
+        # sum of the shards of exited threads
+        self.retired = metrics_shard()
+
+        self.collectors: list = [ ]
+
+    def shard(self) -> metrics_shard:
+        shard = getattr(self.local, "shard", None)
+        if(shard is not None):
+            return shard
+
+        shard = metrics_shard()
+        self.local.shard = shard
+
+        with self.lock:
+            if(len(self.shards) >= SHARD_FOLD_THRESHOLD):
+                self.fold()
+
+            self.shards.append((threading.current_thread(), shard))
+
+        return shard
+
+    #
+    # Merge the shards of exited threads into the retired one,
+    # called with the lock held
+    #
+    def fold(self):
+        alive = [ ]
+
+        for thread, shard in self.shards:
+            if(thread.is_alive()):
+                alive.append((thread, shard))
+            else:
+                self.retired.merge(shard)
+
+        self.shards = alive
+
+    def request_started(self):
+        self.shard().in_flight += 1
+
+    def request_finished(self, method: str, route: str, code: int, status: str, seconds: float, bytes_in: int, bytes_out: int):
+        """
+        Records a finished request
+
+        Args
+        ----
+            method (str): The request method
+            route (str): The registered path of the endpoint, "" if none matched
+            code (int): The HTTP status code
+            status (str): The webstatus name of a web response, "" otherwise
+            seconds (float): The time spent on the request
+            bytes_in (int): Request body bytes
+            bytes_out (int): Response bytes including headers
+        """
+
+        shard = self.shard()
+        shard.in_flight -= 1
+
+        key = (method, route, code, status)
+        shard.requests[key] = shard.requests.get(key, 0) + 1
+
+        key = (method, route)
+        entry = shard.routes.get(key)
+        if(entry is None):
+            entry = [ 0 ] * (len(LATENCY_BUCKETS) + 4)
+            shard.routes[key] = entry
+
+        entry[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        entry[-3] += seconds
+        entry[-2] += bytes_in
+        entry[-1] += bytes_out
+
+    def count_auth(self, result: str):
+        auth = self.shard().auth
+        auth[result] = auth.get(result, 0) + 1
+
+    def add_collector(self, func):
+        """
+        Adds a function returning gauges to render, bound methods are
+        held weakly and dropped with their object
+
+        Args
+        ----
+            func: Returns a list of (name, type, help, labels dict, value) tuples
+        """
+
+        if(hasattr(func, "__self__")):
+            ref = weakref.WeakMethod(func)
+        else:
+            ref = lambda: func
+
+        with self.lock:
+            self.collectors.append(ref)
+
+    def snapshot(self) -> metrics_shard:
+        total = metrics_shard()
+
+        with self.lock:
+            self.fold()
+            total.merge(self.retired)
+
+            for thread, shard in self.shards:
+                total.merge(shard)
+
+        return total
+
+    def render(self) -> str:
+        """
+        Renders all metrics in the Prometheus text exposition format
+        """
+
+        total = self.snapshot()
+        out = [ ]
+
+        out.append("# HELP branchweb_requests_total Requests handled, by endpoint, HTTP code and webstatus.")
+        out.append("# TYPE branchweb_requests_total counter")
+        for (method, route, code, status), count in sorted(total.requests.items(), key=str):
+            out.append("branchweb_requests_total{} {}".format(labels(method=method, route=route, code=code, status=status), count))
+
+        out.append("# HELP branchweb_request_duration_seconds Time from parsing the request line to the end of the response.")
+        out.append("# TYPE branchweb_request_duration_seconds histogram")
+        for (method, route), entry in sorted(total.routes.items()):
+            cumulative = 0
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                cumulative += entry[i]
+                out.append("branchweb_request_duration_seconds_bucket{} {}".format(labels(method=method, route=route, le=bound), cumulative))
+
+            cumulative += entry[len(LATENCY_BUCKETS)]
+            out.append("branchweb_request_duration_seconds_bucket{} {}".format(labels(method=method, route=route, le="+Inf"), cumulative))
+            out.append("branchweb_request_duration_seconds_sum{} {}".format(labels(method=method, route=route), entry[-3]))
+            out.append("branchweb_request_duration_seconds_count{} {}".format(labels(method=method, route=route), cumulative))
+
+        out.append("# HELP branchweb_request_bytes_total Request body bytes received.")
+        out.append("# TYPE branchweb_request_bytes_total counter")
+        for (method, route), entry in sorted(total.routes.items()):
+            out.append("branchweb_request_bytes_total{} {}".format(labels(method=method, route=route), entry[-2]))
+
+        out.append("# HELP branchweb_response_bytes_total Response bytes sent, including headers.")
+        out.append("# TYPE branchweb_response_bytes_total counter")
+        for (method, route), entry in sorted(total.routes.items()):
+            out.append("branchweb_response_bytes_total{} {}".format(labels(method=method, route=route), entry[-1]))
+
+        out.append("# HELP branchweb_requests_in_flight Requests currently being handled.")
+        out.append("# TYPE branchweb_requests_in_flight gauge")
+        out.append("branchweb_requests_in_flight {}".format(total.in_flight))
+
+        out.append("# HELP branchweb_auth_attempts_total Login attempts by result.")
+        out.append("# TYPE branchweb_auth_attempts_total counter")
+        for result, count in sorted(total.auth.items()):
+            out.append("branchweb_auth_attempts_total{} {}".format(labels(result=result), count))
+
+        with self.lock:
+            self.collectors = [ ref for ref in self.collectors if ref() is not None ]
+            collectors = [ ref() for ref in self.collectors ]
+
+        described = set()
+        for func in collectors:
+            if(func is None):
+                continue
+
+            for name, mtype, mhelp, mlabels, value in func():
+                if(name not in described):
+                    described.add(name)
+                    out.append("# HELP {} {}".format(name, mhelp))
+                    out.append("# TYPE {} {}".format(name, mtype))
+
+                out.append("{}{} {}".format(name, labels(**mlabels), value))
+
+        out.append("")
+        return "\n".join(out)
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def labels(**kwargs) -> str:
+    if(not kwargs):
+        return ""
+
+    return "{" + ",".join([ "{}=\"{}\"".format(k, escape(v)) for k, v in kwargs.items() ]) + "}"
+
+#
+# wraps the wfile of a connection and counts the bytes written
+#
+class counting_writer():
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return self.wfile.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.wfile, name)
+
+registry = metrics_registry()
+
+#
+# Register a GET endpoint rendering the metrics registry
+#
+def register_metrics_endpoint(path: str = "metrics"):
+    from .webserver import web_server
+
+    def metrics_endpoint(httphandler, form_data):
+        httphandler.send_body(200, "text/plain; version=0.0.4; charset=utf-8", registry.render().encode("utf-8"))
+
+    web_server.register_get_endpoints({ path: metrics_endpoint })
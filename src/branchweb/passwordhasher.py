@@ -0,0 +1,300 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+import bcrypt
+
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from .webserver import WEB_CONFIG, info
+
+#
+# Raised if a password operation is refused without running it
+#
+class auth_rejected(Exception):
+    pass
+
+#
+# Raised if too many hash operations are running or queued
+#
+class hasher_busy(auth_rejected):
+    pass
+
+#
+# Raised if a user or client exceeded its login attempts
+#
+class auth_throttled(auth_rejected):
+    pass
+
+# executed in the worker processes
+def _hashpw(passwd: str, rounds: int) -> str:
+    return bcrypt.hashpw(passwd.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+def _checkpw(passwd: str, phash: str) -> bool:
+    return bcrypt.checkpw(passwd.encode("utf-8"), phash.encode("utf-8"))
+
+#
+# Returns the bcrypt cost factor of a hash, None if it can not be read
+#
+def hash_rounds(phash: str) -> int:
+    try:
+        return int(phash.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+#
+# fixed window attempt counter per key
+#
+class attempt_throttle():
+
+    def __init__(self, max_attempts: int, window: float):
+        self.max_attempts = max_attempts
+        self.window = window
+        self.entries: dict[str, tuple[float, int]] = { }
+        self.lock = threading.Lock()
+        self.next_sweep = time.monotonic() + window
+
+    def allow(self, key) -> bool:
+        """
+        Counts an attempt for the supplied key
+
+        Args
+        ----
+            key: The user or client to count the attempt for
+
+        Returns
+        -------
+        True, False if the key is out of attempts for the current window
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            if(now >= self.next_sweep):
+                self.sweep(now)
+
+            start, count = self.entries.get(key, (now, 0))
+            if(now - start > self.window):
+                start, count = now, 0
+
+            if(count >= self.max_attempts):
+                return False
+
+            self.entries[key] = (start, count + 1)
+            return True
+
+    def reset(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def sweep(self, now: float):
+        self.entries = { k: v for k, v in self.entries.items() if now - v[0] <= self.window }
+        self.next_sweep = now + self.window
+
+#
+# password_hasher class
+#
+# Runs bcrypt in a bounded pool, so logins do not stall request
+# threads or saturate the server. bcrypt releases the GIL, the
+# threads of the default pool hash in parallel.
+#
+# With use_processes the workers are started with forkserver or
+# spawn, which import the __main__ module of the application
+# again: its startup code needs an if __name__ == "__main__" guard.
+#
+# Only operations a client can trigger are rejected once
+# max_pending is reached, creating users and setting
+# passwords wait for the pool.
+#
+class password_hasher():
+
+    def __init__(self, workers: int = None, max_pending: int = None, use_processes: bool = False):
+        """
+        Creates a new password hasher
+
+        Args
+        ----
+            workers (int, optional): Pool size. Defaults to WEB_CONFIG["hash_workers"].
+            max_pending (int, optional): Running plus queued operations before rejecting. Defaults to WEB_CONFIG["hash_max_pending"].
+            use_processes (bool, optional): Use a process pool instead of a thread pool. Defaults to False.
+        """
+
+        if(workers is None):
+            workers = WEB_CONFIG["hash_workers"]
+
+        if(max_pending is None):
+            max_pending = WEB_CONFIG["hash_max_pending"]
+
+        # the workers must not inherit the threads and locks of the server
+        if(use_processes):
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="branchweb-hash")
+
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+
+        self.user_throttle = attempt_throttle(WEB_CONFIG["auth_max_attempts_user"], WEB_CONFIG["auth_attempt_window"])
+        self.client_throttle = attempt_throttle(WEB_CONFIG["auth_max_attempts_client"], WEB_CONFIG["auth_attempt_window"])
+
+    def submit(self, func, *args, limited: bool = True):
+        """
+        Submits a hash operation, if the admission limit allows it
+
+        Args
+        ----
+            limited (bool, optional): Reject the operation if the pool is saturated, otherwise it is queued. Defaults to True.
+
+        Returns
+        -------
+        A concurrent.futures.Future of the result
+
+        Raises
+        ------
+            hasher_busy: If limited and max_pending operations are already running or queued
+        """
+
+        with self.lock:
+            if(limited and self.pending >= self.max_pending):
+                raise hasher_busy("Too many pending password operations")
+
+            self.pending += 1
+
+        try:
+            future = self.executor.submit(func, *args)
+        except BaseException:
+            self.release(None)
+            raise
+
+        future.add_done_callback(self.release)
+        return future
+
+    def release(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def hash_password(self, passwd: str, limited: bool = False):
+        """
+        Hashes a password with WEB_CONFIG["bcrypt_rounds"]
+
+        Args
+        ----
+            passwd (str): The password in plaintext
+            limited (bool, optional): Reject the operation if the pool is saturated, for rehashes on login. Defaults to False.
+
+        Returns
+        -------
+        A future of the hash string
+
+        Raises
+        ------
+            hasher_busy: If limited and the pool is saturated
+        """
+
+        return self.submit(_hashpw, passwd, WEB_CONFIG["bcrypt_rounds"], limited=limited)
+
+    def verify(self, username: str, passwd: str, phash: str, client: str = None):
+        """
+        Checks a login attempt against the throttles and verifies the password
+
+        Args
+        ----
+            username (str): The user trying to log in
+            passwd (str): The password in plaintext
+            phash (str): The stored hash of the user
+            client (str, optional): The client address of the attempt
+
+        Returns
+        -------
+        A future of True or False
+
+        Raises
+        ------
+            auth_throttled: If the user or client ran out of attempts
+            hasher_busy: If the pool is saturated
+        """
+
+        if(not self.user_throttle.allow(username)):
+            raise auth_throttled("Too many login attempts for user {}".format(username))
+
+        if(client is not None and not self.client_throttle.allow(client)):
+            raise auth_throttled("Too many login attempts from {}".format(client))
+
+        future = self.submit(_checkpw, passwd, phash)
+
+        # resolved only after the throttle was reset, so a waiter
+        # can not race the reset with its next attempt
+        result = Future()
+
+        def reset_on_success(f):
+            try:
+                valid = f.result()
+            except BaseException as ex:
+                result.set_exception(ex)
+                return
+
+            if(valid):
+                self.user_throttle.reset(username)
+
+            result.set_result(valid)
+
+        future.add_done_callback(reset_on_success)
+        return result
+
+    async def verify_async(self, username: str, passwd: str, phash: str, client: str = None) -> bool:
+        """
+        Awaitable version of verify() for the asyncio engine
+        """
+
+        return await asyncio.wrap_future(self.verify(username, passwd, phash, client))
+
+    async def hash_password_async(self, passwd: str, limited: bool = False) -> str:
+        """
+        Awaitable version of hash_password() for the asyncio engine
+        """
+
+        return await asyncio.wrap_future(self.hash_password(passwd, limited))
+
+    @staticmethod
+    def needs_rehash(phash: str) -> bool:
+        """
+        Checks if a hash was made with another cost factor than WEB_CONFIG["bcrypt_rounds"]
+        """
+
+        rounds = hash_rounds(phash)
+        return rounds is not None and rounds != WEB_CONFIG["bcrypt_rounds"]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+_hasher: password_hasher = None
+_hasher_lock = threading.Lock()
+
+#
+# Returns the shared password hasher, created on first use
+#
+def get_hasher() -> password_hasher:
+    global _hasher
+
+    if(_hasher is None):
+        with _hasher_lock:
+            if(_hasher is None):
+                _hasher = password_hasher(use_processes=WEB_CONFIG["hash_use_processes"])
+                info("Password hashing with {} workers (processes: {})", WEB_CONFIG["hash_workers"], WEB_CONFIG["hash_use_processes"])
+
+    return _hasher
+
+#
+# Executors do not survive a fork, workers of a
+# prefork server create their own hasher
+#
+def _reset_after_fork():
+    global _hasher, _hasher_lock
+
+    _hasher = None
+    _hasher_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
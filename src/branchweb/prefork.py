@@ -0,0 +1,211 @@
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+
+from .webserver import make_server, drain_server, log_output, WEB_CONFIG, info, debug
+
+#
+# prefork_server class
+#
+# Forks worker processes that each run a server engine on a
+# shared port, so handler code is not limited to one core by
+# the GIL. The parent only supervises: crashed workers are
+# restarted, SIGTERM / SIGINT or stop() drain all workers.
+#
+# By default the workers inherit one listening socket, with
+# WEB_CONFIG["prefork_reuseport"] every worker binds its own
+# SO_REUSEPORT socket and the kernel balances between them.
+#
+# Endpoints registered before serve_forever() are inherited
+# by every worker. Everything that must not be shared across
+# a fork (database connections, usermanagers, thread pools)
+# belongs into worker_init(worker_id), which runs in each worker.
+#
+class prefork_server():
+
+    # seconds after the drain deadline until workers are killed
+    kill_grace = 5
+
+    def __init__(self, hostname, serverport, processes = None, engine = "threaded", workers = None, queue_size = None, worker_init = None):
+        if(processes is None):
+            processes = os.cpu_count()
+
+        self.hostname = hostname
+        self.serverport = serverport
+        self.processes = processes
+        self.engine = engine
+        self.workers = workers
+        self.queue_size = queue_size
+        self.worker_init = worker_init
+
+        self.reuseport = WEB_CONFIG["prefork_reuseport"] and hasattr(socket, "SO_REUSEPORT")
+        self.sock = None
+
+        # pid -> (worker_id, start time)
+        self.children: dict[int, tuple[int, float]] = { }
+        self.stopping = False
+        self.draining = False
+        self.kill_timer = None
+
+        # drain deadline of the workers, shared memory so stop()
+        # can set it after they were forked
+        self.drain_timeout = multiprocessing.RawValue("d", WEB_CONFIG["shutdown_timeout"])
+
+    #
+    # Bind the port in the supervisor, so a port in use fails
+    # before forking. In reuseport mode the socket only holds
+    # the port and never listens.
+    #
+    def bind(self):
+        if(not self.reuseport):
+            return socket.create_server((self.hostname, self.serverport), backlog=socket.SOMAXCONN)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.hostname, self.serverport))
+        return sock
+
+    #
+    # Fork and supervise the workers until stop() was called
+    # and all of them exited
+    #
+    def serve_forever(self):
+        self.sock = self.bind()
+
+        if(threading.current_thread() is threading.main_thread()):
+            signal.signal(signal.SIGTERM, self.handle_signal)
+            signal.signal(signal.SIGINT, self.handle_signal)
+
+        info("Starting {} {} worker processes on {}:{}..", self.processes, self.engine, self.hostname, self.serverport)
+
+        try:
+            for worker_id in range(self.processes):
+                self.spawn(worker_id)
+
+            while self.children:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+
+                child = self.children.pop(pid, None)
+                if(child is None or self.stopping):
+                    continue
+
+                worker_id, started = child
+                info("Worker {} (pid {}) exited with status {}, restarting..", worker_id, pid, os.waitstatus_to_exitcode(status))
+
+                # do not spin on a worker that crashes right away
+                if(time.monotonic() - started < WEB_CONFIG["prefork_restart_delay"]):
+                    time.sleep(WEB_CONFIG["prefork_restart_delay"])
+
+                if(not self.stopping):
+                    self.spawn(worker_id)
+
+        finally:
+            if(self.kill_timer is not None):
+                self.kill_timer.cancel()
+
+            self.sock.close()
+
+        info("All worker processes exited.")
+
+    def handle_signal(self, signum, frame):
+        self.stop()
+
+    #
+    # Ask all workers to drain for at most timeout seconds
+    # (WEB_CONFIG["shutdown_timeout"] by default) and exit,
+    # workers still running kill_grace seconds later are killed
+    #
+    def stop(self, timeout = None):
+        if(self.stopping):
+            return
+
+        if(timeout is None):
+            timeout = WEB_CONFIG["shutdown_timeout"]
+
+        self.stopping = True
+        self.draining = True
+        self.drain_timeout.value = timeout
+        info("Stopping {} worker processes..", len(self.children))
+
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        self.kill_timer = threading.Timer(timeout + self.kill_grace, self.kill_children)
+        self.kill_timer.daemon = True
+        self.kill_timer.start()
+
+    def kill_children(self):
+        for pid in list(self.children):
+            info("Worker pid {} did not drain in time, killing it.", pid)
+
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def spawn(self, worker_id):
+        pid = os.fork()
+
+        if(pid != 0):
+            self.children[pid] = (worker_id, time.monotonic())
+            return
+
+        # worker process, never returns into the supervisor
+        code = 1
+        try:
+            self.run_worker(worker_id)
+            code = 0
+        except BaseException:
+            info("Worker {} failed: {}", worker_id, traceback.format_exc())
+        finally:
+            log_output.flush()
+            os._exit(code)
+
+    def run_worker(self, worker_id):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.children = { }
+
+        sock = self.sock
+        if(self.reuseport):
+            self.sock.close()
+            sock = socket.create_server((self.hostname, self.serverport), backlog=socket.SOMAXCONN, reuse_port=True)
+
+        if(self.worker_init is not None):
+            self.worker_init(worker_id)
+
+        web_serv = make_server(self.hostname, self.serverport, self.engine, self.workers, self.queue_size, sock)
+
+        # shutdown() blocks until serve_forever returned,
+        # so it can not run in the signal handler itself
+        def stop_worker(signum, frame):
+            # the asyncio engine drains in serve_forever
+            web_serv.drain_timeout = self.drain_timeout.value
+            threading.Thread(target=web_serv.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, stop_worker)
+
+        debug("Worker {} serving in pid {}", worker_id, os.getpid())
+        web_serv.serve_forever()
+
+        prefork_server.drain(web_serv, self.drain_timeout.value)
+        debug("Worker {} drained", worker_id)
+
+    #
+    # Let the connections of a stopped server finish their
+    # current request, for at most timeout seconds
+    #
+    @staticmethod
+    def drain(web_serv, timeout = None):
+        drain_server(web_serv, timeout)
@@ -0,0 +1,264 @@
+import collections
+import cProfile
+import io
+import pstats
+import random
+import sys
+import threading
+import time
+import traceback
+
+from . import webserver
+
+#
+# request_trace class
+#
+# Timing breakdown of one request, only created while
+# WEB_CONFIG["slow_request_threshold"] is set.
+#
+class request_trace():
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases: dict[str, float] = { }
+        self.thread_id = None
+        self.stack = None
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    #
+    # The phases with the time of nested phases taken
+    # out of the handler, in the order they happen
+    #
+    def breakdown(self) -> dict:
+        phases = dict(self.phases)
+
+        if("handler" in phases):
+            nested = phases.get("auth", 0.0) + phases.get("serialize", 0.0) + phases.get("write", 0.0)
+            phases["handler"] = max(0.0, phases["handler"] - nested)
+
+        order = ("parse", "session", "body", "auth", "handler", "serialize", "write")
+        return { name: phases[name] for name in order if name in phases }
+
+# traces of requests whose handler is running, by thread
+running: dict[int, request_trace] = { }
+running_lock = threading.Lock()
+watchdog_thread = None
+
+# recent slow requests, newest last
+slow_requests = collections.deque(maxlen=50)
+
+# aggregated profiles of sampled requests
+profile_stats: pstats.Stats = None
+profile_lock = threading.Lock()
+profiled_requests = 0
+
+local = threading.local()
+
+def tracing_enabled() -> bool:
+    return webserver.WEB_CONFIG["slow_request_threshold"] is not None
+
+#
+# The trace of the request handled by the current thread
+#
+def current_trace() -> request_trace:
+    return getattr(local, "trace", None)
+
+#
+# Called before a handler runs on the current thread
+#
+def handler_started(trace: request_trace):
+    trace.thread_id = threading.get_ident()
+    local.trace = trace
+
+    with running_lock:
+        running[trace.thread_id] = trace
+
+    start_watchdog()
+
+def handler_finished(trace: request_trace):
+    local.trace = None
+
+    with running_lock:
+        running.pop(trace.thread_id, None)
+
+#
+# Capture the stack of handlers running for longer
+# than the threshold, while they are still running
+#
+def start_watchdog():
+    global watchdog_thread
+
+    if(watchdog_thread is not None):
+        return
+
+    with running_lock:
+        if(watchdog_thread is not None):
+            return
+
+        watchdog_thread = threading.Thread(target=watchdog_loop, name="branchweb-profiler", daemon=True)
+        watchdog_thread.start()
+
+def watchdog_loop():
+    while True:
+        threshold = webserver.WEB_CONFIG["slow_request_threshold"]
+        if(threshold is None):
+            time.sleep(1)
+            continue
+
+        time.sleep(max(threshold / 2, 0.01))
+        now = time.perf_counter()
+
+        with running_lock:
+            overdue = [ t for t in running.values() if t.stack is None and now - t.start > threshold ]
+
+        if(not overdue):
+            continue
+
+        frames = sys._current_frames()
+        for trace in overdue:
+            frame = frames.get(trace.thread_id)
+            if(frame is not None):
+                trace.stack = "".join(traceback.format_stack(frame))
+
+#
+# Record a finished request, slow ones are logged and kept
+#
+def request_finished(trace: request_trace, method: str, route: str, seconds: float):
+    threshold = webserver.WEB_CONFIG["slow_request_threshold"]
+    if(threshold is None or seconds < threshold):
+        return
+
+    phases = trace.breakdown()
+    slow_requests.append({
+        "time": time.time(),
+        "method": method,
+        "route": route,
+        "seconds": seconds,
+        "phases": phases,
+        "stack": trace.stack
+    })
+
+    webserver.info("Slow request {} {} took {:.1f} ms ({})", method, route, seconds * 1000,
+                   ", ".join([ "{} {:.1f} ms".format(name, t * 1000) for name, t in phases.items() ]))
+
+#
+# Should the handler of the supplied route run under cProfile
+#
+def should_profile(route: str) -> bool:
+    if(route in webserver.WEB_CONFIG["profile_routes"]):
+        return True
+
+    rate = webserver.WEB_CONFIG["profile_sample_rate"]
+    return rate > 0 and random.random() < rate
+
+#
+# Run func under cProfile and add the result to the
+# aggregated stats, returns whatever func returned
+#
+def profile_call(func, *args, **kwargs):
+    global profile_stats, profiled_requests
+
+    profiler = cProfile.Profile()
+
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiler is active
+        return func(*args, **kwargs)
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+
+        with profile_lock:
+            if(profile_stats is None):
+                profile_stats = pstats.Stats(profiler)
+            else:
+                profile_stats.add(profiler)
+
+            profiled_requests += 1
+
+def stats_text(sort: str = "cumulative", limit: int = 40) -> str:
+    """
+    Renders the aggregated profile of all sampled requests
+
+    Args
+    ----
+        sort (str, optional): A pstats sort key. Defaults to "cumulative".
+        limit (int, optional): Functions to list. Defaults to 40.
+
+    Returns
+    -------
+    The pstats report as text
+    """
+
+    out = io.StringIO()
+
+    with profile_lock:
+        out.write("{} profiled requests\n\n".format(profiled_requests))
+
+        if(profile_stats is not None):
+            profile_stats.stream = out
+            profile_stats.sort_stats(sort).print_stats(limit)
+
+    return out.getvalue()
+
+def dump_stats(path: str) -> bool:
+    """
+    Writes the aggregated profile to a file that pstats or snakeviz can load
+
+    Returns
+    -------
+    True, False if nothing was profiled yet
+    """
+
+    with profile_lock:
+        if(profile_stats is None):
+            return False
+
+        profile_stats.dump_stats(path)
+        return True
+
+def reset():
+    global profile_stats, profiled_requests
+
+    with profile_lock:
+        profile_stats = None
+        profiled_requests = 0
+
+    slow_requests.clear()
+
+def slow_text() -> str:
+    out = [ ]
+
+    for entry in slow_requests:
+        out.append("{} {} {:.1f} ms at {}".format(entry["method"], entry["route"], entry["seconds"] * 1000, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["time"]))))
+        out.append("  " + ", ".join([ "{} {:.1f} ms".format(name, t * 1000) for name, t in entry["phases"].items() ]))
+
+        if(entry["stack"] is not None):
+            out.append(entry["stack"])
+
+    return "\n".join(out) + "\n"
+
+#
+# Register a GET endpoint reporting the slow requests and the
+# aggregated profile. Form fields: sort, limit and reset=1.
+# It exposes code internals, only register it where trusted.
+#
+def register_profile_endpoint(path: str = "profile"):
+    def profile_endpoint(httphandler, form_data):
+        if(form_data is None):
+            form_data = { }
+
+        text = "Slow requests\n=============\n" + slow_text()
+        text += "\nProfile\n=======\n" + stats_text(form_data.get("sort", "cumulative"), int(form_data.get("limit", 40)))
+
+        if(form_data.get("reset") == "1"):
+            reset()
+
+        httphandler.send_body(200, "text/plain; charset=utf-8", text.encode("utf-8"))
+
+    webserver.web_server.register_get_endpoints({ path: profile_endpoint })
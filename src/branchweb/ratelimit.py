@@ -0,0 +1,174 @@
+import threading
+import time
+
+from . import metrics
+from . import webserver
+
+#
+# token_bucket_limiter class
+#
+# One token bucket per (route budget, client) as a tuple of
+# (tokens, last update, rate, burst) in a dict. Buckets are
+# updated without a lock, concurrent requests of the same
+# client can at worst both take the last token.
+# Buckets that refilled completely carry no state and are dropped
+# every WEB_CONFIG["rate_limit_sweep_interval"] seconds, or as soon as
+# more than WEB_CONFIG["rate_limit_max_buckets"] exist.
+#
+class token_bucket_limiter():
+
+    def __init__(self):
+        # key -> (tokens, monotonic time of the last update, rate, burst)
+        self.buckets: dict[tuple, tuple] = { }
+
+        self.sweep_lock = threading.Lock()
+        self.next_sweep = 0.0
+
+        self.limited = 0
+
+    def acquire(self, key: tuple, rate: float, burst: float) -> float:
+        """
+        Takes a token from the bucket of key
+
+        Args
+        ----
+            key (tuple): The bucket, e.g. (route, client)
+            rate (float): Tokens added per second
+            burst (float): Size of the bucket
+
+        Returns
+        -------
+        0 if a token was taken, otherwise the seconds until one is available
+        """
+
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+
+        if(bucket is None):
+            tokens = burst
+
+            if(len(self.buckets) >= webserver.WEB_CONFIG["rate_limit_max_buckets"]):
+                self.sweep(now, True)
+        else:
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+
+        if(tokens < 1):
+            self.buckets[key] = (tokens, now, rate, burst)
+            self.limited += 1
+            return (1 - tokens) / rate
+
+        self.buckets[key] = (tokens - 1, now, rate, burst)
+
+        if(now >= self.next_sweep):
+            self.sweep(now)
+
+        return 0.0
+
+    def release(self, key: tuple):
+        """
+        Gives back a token taken by acquire(), when the request is charged to another bucket
+
+        Args
+        ----
+            key (tuple): The bucket the token was taken from
+        """
+
+        bucket = self.buckets.get(key)
+        if(bucket is not None):
+            tokens, updated, rate, burst = bucket
+            self.buckets[key] = (min(burst, tokens + 1), updated, rate, burst)
+
+    #
+    # Drop full buckets, if there are still too many,
+    # drop the least recently used half
+    #
+    def sweep(self, now: float, force: bool = False):
+        if(not self.sweep_lock.acquire(blocking=force)):
+            return
+
+        try:
+            self.next_sweep = now + webserver.WEB_CONFIG["rate_limit_sweep_interval"]
+            buckets = self.buckets.copy()
+
+            for key, bucket in buckets.items():
+                tokens, updated, rate, burst = bucket
+
+                if(tokens + (now - updated) * rate >= burst):
+                    self.drop(key, bucket)
+
+            if(len(self.buckets) >= webserver.WEB_CONFIG["rate_limit_max_buckets"]):
+                by_age = sorted(self.buckets.copy().items(), key=lambda item: item[1][1])
+
+                for key, bucket in by_age[:len(by_age) // 2]:
+                    self.drop(key, bucket)
+
+        finally:
+            self.sweep_lock.release()
+
+    def drop(self, key: tuple, bucket: tuple):
+        # only if no request updated it meanwhile
+        if(self.buckets.get(key) is bucket):
+            self.buckets.pop(key, None)
+
+    def reset(self):
+        self.buckets.clear()
+
+#
+# connection_counter class
+#
+# Open connections per client address, checked when
+# a connection is accepted
+#
+class connection_counter():
+
+    def __init__(self):
+        self.connections: dict[str, int] = { }
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    def open(self, address: str) -> bool:
+        """
+        Counts a new connection of address, every call must be
+        followed by a call to close(), even if it returned False
+
+        Returns
+        -------
+        False if the address exceeds WEB_CONFIG["max_connections_per_ip"]
+        """
+
+        limit = webserver.WEB_CONFIG["max_connections_per_ip"]
+
+        with self.lock:
+            count = self.connections.get(address, 0) + 1
+            self.connections[address] = count
+
+            if(limit is not None and count > limit):
+                self.rejected += 1
+                return False
+
+        return True
+
+    def close(self, address: str):
+        with self.lock:
+            count = self.connections.get(address, 0) - 1
+
+            if(count > 0):
+                self.connections[address] = count
+            else:
+                self.connections.pop(address, None)
+
+def collect_metrics() -> list:
+    """
+    Returns the rate limiting gauges and counters for the metrics registry
+    """
+
+    return [
+        ("branchweb_rate_limit_buckets", "gauge", "Token buckets of clients that used part of their budget.", { }, len(limiter.buckets)),
+        ("branchweb_rate_limited_total", "counter", "Requests rejected with 429.", { }, limiter.limited),
+        ("branchweb_connection_clients", "gauge", "Client addresses with open connections.", { }, len(connections.connections)),
+        ("branchweb_connections_rejected_total", "counter", "Connections refused by the per address cap.", { }, connections.rejected)
+    ]
+
+limiter = token_bucket_limiter()
+connections = connection_counter()
+metrics.registry.add_collector(collect_metrics)
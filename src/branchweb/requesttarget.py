@@ -0,0 +1,150 @@
+import functools
+import urllib.parse
+
+# parse results of this many distinct request targets are kept
+TARGET_CACHE_SIZE = 1024
+
+# longer targets are parsed every time, they rarely repeat
+MAX_CACHED_TARGET = 512
+
+#
+# multi_dict class
+#
+# Form fields as a dict of the last value of every key,
+# getlist() returns all values of a repeated key.
+#
+class multi_dict(dict):
+
+    def __init__(self, pairs: tuple = ()):
+        super().__init__(pairs)
+
+        # (key, value) pairs in the order they were sent
+        self.pairs = pairs
+
+    def getlist(self, key: str) -> list:
+        """
+        Returns all values sent for a key
+
+        Args
+        ----
+            key (str): The field name
+
+        Returns
+        -------
+        The values in the order they were sent, an empty list if the key is missing
+        """
+
+        if(key not in self):
+            return [ ]
+
+        values = [ v for k, v in self.pairs if k == key ]
+
+        # changed by a handler since it was parsed
+        if(not values or values[-1] != self[key]):
+            return [ self[key] ]
+
+        return values
+
+def parse_query(query: str) -> tuple:
+    """
+    Splits a query string or url encoded body into percent decoded pairs
+
+    Fields without a "=" have an empty value, "+" decodes to a space
+    and only the first "=" of a field separates key and value.
+
+    Args
+    ----
+        query (str): The query string, without the leading "?"
+
+    Returns
+    -------
+    A tuple of (key, value) pairs
+    """
+
+    pairs = [ ]
+
+    for field in query.split("&"):
+        if(not field):
+            continue
+
+        key, sep, value = field.partition("=")
+
+        if("%" in key or "+" in key):
+            key = urllib.parse.unquote_plus(key)
+
+        if("%" in value or "+" in value):
+            value = urllib.parse.unquote_plus(value)
+
+        pairs.append((key, value))
+
+    return tuple(pairs)
+
+#
+# Percent decode a path, encoded slashes stay encoded
+# so they do not split a segment
+#
+def decode_path(path: str) -> str:
+    if("%" not in path):
+        return path
+
+    segments = [ ]
+    for segment in path.split("/"):
+        decoded = urllib.parse.unquote(segment)
+        segments.append(segment if "/" in decoded else decoded)
+
+    return "/".join(segments)
+
+def parse_target(target: str):
+    """
+    Parses a request target into the route and its form fields
+
+    "/route/sub?k=v" - route "route/sub", the query as form fields
+    "/?route=x&k=v"  - legacy form, the first key is the route and
+                       all fields, including the first, are form fields
+    "/route"         - no form fields
+
+    Absolute targets ("http://host/route?k=v") are reduced to their path,
+    a fragment is ignored.
+
+    Args
+    ----
+        target (str): The request target of the request line
+
+    Returns
+    -------
+    A tuple of (route, pairs) with the route not starting with "/" and pairs
+    None if there was no query, None if the target is not a path
+    """
+
+    if(len(target) <= MAX_CACHED_TARGET):
+        return parse_target_cached(target)
+
+    return parse_target_uncached(target)
+
+def parse_target_uncached(target: str):
+    if(not target.startswith("/")):
+        if(target == "*"):
+            return "*", None
+
+        if("://" not in target):
+            return None
+
+        parts = urllib.parse.urlsplit(target)
+        target = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+
+    target = target.partition("#")[0]
+    path, sep, query = target.partition("?")
+    path = decode_path(path[1:])
+
+    if(not sep or not query):
+        return path, None
+
+    pairs = parse_query(query)
+
+    # legacy form, the first field names the route
+    if(not path and pairs):
+        return pairs[0][0], pairs
+
+    return path, pairs
+
+parse_target_cached = functools.lru_cache(maxsize=TARGET_CACHE_SIZE)(parse_target_uncached)
@@ -0,0 +1,189 @@
+#
+# router class
+#
+# Exact paths are resolved through a dict, paths containing
+# {param} segments through a segment trie.
+#
+class router():
+
+    def __init__(self):
+        """
+        Creates a new, empty router
+        """
+
+        self.static_routes: dict[str, object] = {}
+        self.root: _trie_node = _trie_node()
+
+    @staticmethod
+    def is_parameterized(path: str) -> bool:
+        """
+        Checks if the supplied path contains {param} segments
+
+        Args
+        ----
+            path (str): The path to check
+
+        Returns
+        -------
+        True or False
+        """
+
+        return "{" in path
+
+    @staticmethod
+    def split_path(path: str) -> list[str]:
+        """
+        Splits a path into its segments, ignoring leading and trailing slashes
+
+        Args
+        ----
+            path (str): The path to split
+
+        Returns
+        -------
+        The list of segments
+        """
+
+        return path.strip("/").split("/")
+
+    def add(self, path: str, ep):
+        """
+        Adds an endpoint for the supplied path
+
+        Args
+        ----
+            path (str): The path, optionally containing {param} segments
+            ep: The endpoint object to return on a match
+
+        Raises
+        ------
+            ValueError: If the path (or an equivalent parameterized path) is already registered
+        """
+
+        if (not router.is_parameterized(path)):
+            if (path in self.static_routes):
+                raise ValueError("Duplicate route: {}".format(path))
+
+            self.static_routes[path] = ep
+            return
+
+        node = self.root
+        for segment in router.split_path(path):
+            if (segment.startswith("{") and segment.endswith("}")):
+                name = segment[1:-1]
+                if (node.param_child is None):
+                    node.param_child = _trie_node()
+                    node.param_name = name
+                elif (node.param_name != name):
+                    raise ValueError("Conflicting parameter names {{{}}} and {{{}}} in route: {}".format(node.param_name, name, path))
+
+                node = node.param_child
+            else:
+                child = node.children.get(segment)
+                if (child is None):
+                    child = _trie_node()
+                    node.children[segment] = child
+
+                node = child
+
+        if (node.endpoint is not None):
+            raise ValueError("Duplicate route: {}".format(path))
+
+        node.endpoint = ep
+
+    def match(self, path: str):
+        """
+        Resolves the supplied path to an endpoint
+
+        Args
+        ----
+            path (str): The requested path
+
+        Returns
+        -------
+        A tuple of (endpoint, params dict), or (None, None) if nothing matched
+        """
+
+        ep = self.static_routes.get(path)
+        if (ep is not None):
+            return ep, {}
+
+        # nothing parameterized registered, skip the trie walk
+        if (not self.root.children and self.root.param_child is None):
+            return None, None
+
+        params = {}
+        ep = self.root.match(router.split_path(path), 0, params)
+        if (ep is None):
+            return None, None
+
+        return ep, params
+
+    def copy(self) -> "router":
+        """
+        Creates a router with the same routes, adding routes
+        to the copy does not change this router
+
+        Returns
+        -------
+        The new router
+        """
+
+        copy = router()
+        copy.static_routes = dict(self.static_routes)
+        copy.root = self.root.copy()
+        return copy
+
+    def __len__(self):
+        return len(self.static_routes) + self.root.count()
+
+#
+# node of the parameterized route trie
+#
+class _trie_node():
+
+    def __init__(self):
+        self.children: dict[str, _trie_node] = {}
+        self.param_name: str = None
+        self.param_child: _trie_node = None
+        self.endpoint = None
+
+    def match(self, segments: list[str], index: int, params: dict):
+        if (index == len(segments)):
+            return self.endpoint
+
+        segment = segments[index]
+
+        # static segments take precedence over parameters
+        child = self.children.get(segment)
+        if (child is not None):
+            ep = child.match(segments, index + 1, params)
+            if (ep is not None):
+                return ep
+
+        if (self.param_child is not None and segment):
+            ep = self.param_child.match(segments, index + 1, params)
+            if (ep is not None):
+                params[self.param_name] = segment
+                return ep
+
+        return None
+
+    def copy(self) -> "_trie_node":
+        node = _trie_node()
+        node.children = { segment: child.copy() for segment, child in self.children.items() }
+        node.param_name = self.param_name
+        node.param_child = self.param_child.copy() if self.param_child is not None else None
+        node.endpoint = self.endpoint
+        return node
+
+    def count(self) -> int:
+        total = 1 if self.endpoint is not None else 0
+
+        for child in self.children.values():
+            total += child.count()
+
+        if (self.param_child is not None):
+            total += self.param_child.count()
+
+        return total
@@ -0,0 +1,174 @@
+import threading
+import time
+
+from . import webserver
+
+#
+# server_handle class
+#
+# Controls a server created by start_web_server: run it in a
+# background thread, stop it with a drain deadline, watch the
+# requests in flight and swap its endpoints while it runs.
+#
+# Requests are counted per process, the workers of a prefork
+# server are not visible to the handle in the supervisor, and
+# reload_routes only changes the routes of the supervisor.
+#
+class server_handle():
+
+    def __init__(self, web_serv, engine: str):
+        self.server = web_serv
+        self.engine = engine
+        self.thread = None
+        self.started = False
+        self.stopped = threading.Event()
+
+        # the exception serve_forever stopped with
+        self.error = None
+
+    def start(self) -> "server_handle":
+        """
+        Runs the server in a background thread
+
+        Returns
+        -------
+        The handle itself
+
+        Raises
+        ------
+            OSError: If the asyncio engine could not listen on the address
+        """
+
+        self.started = True
+
+        self.thread = threading.Thread(target=self.serve_forever, name="branchweb-server", daemon=True)
+        self.thread.start()
+
+        # the asyncio engine binds in the server thread
+        ready = getattr(self.server, "ready", None)
+        if(ready is not None):
+            ready.wait()
+
+            if(self.server.server is None):
+                self.stopped.wait()
+                raise self.error
+
+        return self
+
+    #
+    # Run the server in the current thread until it is stopped
+    #
+    def serve_forever(self):
+        self.started = True
+
+        try:
+            self.server.serve_forever()
+        except Exception as ex:
+            self.error = ex
+            webserver.info("Webserver stopped: {}", ex)
+        finally:
+            self.stopped.set()
+
+    def stop(self, timeout: float = None) -> bool:
+        """
+        Stops accepting connections and lets the requests in flight finish
+
+        Connections waiting for a further request are closed, the
+        connections of requests still running at the deadline as well.
+
+        Args
+        ----
+            timeout (float, optional): Seconds to wait for the requests in flight. Defaults to WEB_CONFIG["shutdown_timeout"].
+
+        Returns
+        -------
+        True if all requests finished before the deadline
+        """
+
+        if(timeout is None):
+            timeout = webserver.WEB_CONFIG["shutdown_timeout"]
+
+        deadline = time.monotonic() + timeout
+        self.server.draining = True
+
+        if(hasattr(self.server, "children")):
+            # prefork: the workers drain themselves, the
+            # supervisor kills them kill_grace seconds later
+            self.server.stop(timeout)
+            return self.stopped.wait(timeout + self.server.kill_grace + 1) if self.started else True
+
+        if(not hasattr(self.server, "server_close")):
+            # asyncio: serve_forever drains before it returns
+            self.server.drain_timeout = timeout
+            self.server.shutdown()
+
+            if(self.started):
+                self.stopped.wait(timeout + 1)
+
+            return self.server.drained is not False
+
+        # blocks until the accept loop returned
+        if(self.started and not self.stopped.is_set()):
+            self.server.shutdown()
+
+        return webserver.drain_server(self.server, max(0, deadline - time.monotonic()))
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Waits until the server stopped
+
+        Returns
+        -------
+        False if timeout passed first
+        """
+
+        return self.stopped.wait(timeout)
+
+    def running(self) -> bool:
+        return self.started and not self.stopped.is_set()
+
+    #
+    # The address the server accepts connections on,
+    # with the port it bound if it was started on port 0
+    #
+    def address(self) -> tuple:
+        if(hasattr(self.server, "server_address")):
+            return self.server.server_address[:2]
+
+        server = getattr(self.server, "server", None)
+        if(server is not None and server.sockets):
+            return server.sockets[0].getsockname()[:2]
+
+        return (self.server.hostname, self.server.serverport)
+
+    def in_flight(self) -> int:
+        """
+        Returns the amount of requests being handled right now
+        """
+
+        return webserver.web_server.active_requests.in_flight
+
+    def stats(self) -> dict:
+        stats = {
+            "engine": self.engine,
+            "running": self.running(),
+            "draining": self.server.draining,
+            "in_flight": self.in_flight(),
+            "requests": webserver.web_server.active_requests.total
+        }
+
+        if(hasattr(self.server, "pool_stats")):
+            stats["pool"] = self.server.pool_stats()
+
+        return stats
+
+    def reload_routes(self, register):
+        """
+        Replaces all endpoints at once, see web_server.reload_routes
+
+        Args
+        ----
+            register: Function making the register_* calls of the new endpoints
+        """
+
+        webserver.web_server.reload_routes(register)
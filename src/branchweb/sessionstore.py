@@ -0,0 +1,219 @@
+import atexit
+import sqlite3
+import threading
+import time
+
+from . import webserver
+
+#
+# session_store class
+#
+# Persists authkeys as key id -> (username, last refresh time).
+# Shared stores can be read by other processes, keys minted
+# in one worker then validate in all others.
+#
+class session_store():
+
+    # other processes may add, refresh and revoke keys
+    shared: bool = False
+
+    def put(self, key_id: str, name: str, timestamp: float):
+        """
+        Stores a newly minted key
+        """
+
+        raise NotImplementedError()
+
+    def get(self, key_id: str):
+        """
+        Looks up a key
+
+        Returns
+        -------
+        A tuple of (username, timestamp) or None
+        """
+
+        raise NotImplementedError()
+
+    def touch(self, key_id: str, timestamp: float):
+        """
+        Records a refresh of a key, stores may defer writing it
+        """
+
+        raise NotImplementedError()
+
+    def delete(self, key_id: str):
+        raise NotImplementedError()
+
+    def delete_expired(self, before: float) -> int:
+        """
+        Removes all keys last refreshed before the supplied time
+
+        Returns
+        -------
+        The amount of keys removed
+        """
+
+        raise NotImplementedError()
+
+    def count(self) -> int:
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+#
+# memory_session_store class
+#
+# Keys only live in the key index of the usermanager of
+# this process, nothing is persisted.
+#
+class memory_session_store(session_store):
+
+    def put(self, key_id: str, name: str, timestamp: float):
+        pass
+
+    def get(self, key_id: str):
+        return None
+
+    def touch(self, key_id: str, timestamp: float):
+        pass
+
+    def delete(self, key_id: str):
+        pass
+
+    def delete_expired(self, before: float) -> int:
+        return 0
+
+    def count(self) -> int:
+        return 0
+
+#
+# sqlite_session_store class
+#
+# Keys in an SQLite database in WAL mode, which may be the
+# database of a sqlite_store. Refreshes are collected and
+# written in one transaction every WEB_CONFIG["session_flush_interval"]
+# seconds instead of once per request.
+#
+class sqlite_session_store(session_store):
+
+    shared = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS authkeys (
+            key_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            timestamp REAL NOT NULL
+        ) WITHOUT ROWID;
+
+        CREATE INDEX IF NOT EXISTS authkeys_name ON authkeys(name);
+        CREATE INDEX IF NOT EXISTS authkeys_timestamp ON authkeys(timestamp);
+    """
+
+    def __init__(self, path: str):
+        """
+        Opens (and if needed creates) the session database at the supplied path
+
+        Args
+        ----
+            path (str): The path to the database file
+        """
+
+        self.path = path
+        self.lock = threading.Lock()
+
+        # key_id -> newest refresh time not yet written
+        self.pending: dict[str, float] = {}
+        self.next_flush = time.monotonic() + webserver.WEB_CONFIG["session_flush_interval"]
+
+        self.db = sqlite3.connect(path, timeout=webserver.WEB_CONFIG["sqlite_busy_timeout"], isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(sqlite_session_store.SCHEMA)
+
+        atexit.register(self.flush)
+
+        webserver.debug("Opened session database at {}", path)
+
+    def put(self, key_id: str, name: str, timestamp: float):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO authkeys (key_id, name, timestamp) VALUES (?, ?, ?)", (key_id, name, timestamp))
+
+    def get(self, key_id: str):
+        with self.lock:
+            rows = self.db.execute("SELECT name, timestamp FROM authkeys WHERE key_id = ?", (key_id, )).fetchall()
+            if (not rows):
+                return None
+
+            name, timestamp = rows[0]
+
+            # refreshed by this process, but not written yet
+            pending = self.pending.get(key_id)
+            if (pending is not None and pending > timestamp):
+                timestamp = pending
+
+            return name, timestamp
+
+    def touch(self, key_id: str, timestamp: float):
+        with self.lock:
+            self.pending[key_id] = timestamp
+
+            if (len(self.pending) < webserver.WEB_CONFIG["session_flush_batch"] and time.monotonic() < self.next_flush):
+                return
+
+            self.write_pending()
+
+    def flush(self):
+        """
+        Writes all deferred refreshes to the database
+        """
+
+        with self.lock:
+            self.write_pending()
+
+    def write_pending(self):
+        self.next_flush = time.monotonic() + webserver.WEB_CONFIG["session_flush_interval"]
+
+        if (not self.pending):
+            return
+
+        pending = self.pending
+        self.pending = {}
+
+        # never resurrect a key that was revoked meanwhile, never
+        # move a refresh of another worker back in time
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.executemany("UPDATE authkeys SET timestamp = ? WHERE key_id = ? AND timestamp < ?",
+                                [ (timestamp, key_id, timestamp) for key_id, timestamp in pending.items() ])
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+        self.db.execute("COMMIT")
+        webserver.debug("Wrote {} deferred session refreshes", len(pending))
+
+    def delete(self, key_id: str):
+        with self.lock:
+            self.pending.pop(key_id, None)
+            self.db.execute("DELETE FROM authkeys WHERE key_id = ?", (key_id, ))
+
+    def delete_expired(self, before: float) -> int:
+        with self.lock:
+            self.write_pending()
+            return self.db.execute("DELETE FROM authkeys WHERE timestamp < ?", (before, )).rowcount
+
+    def count(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM authkeys").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.write_pending()
+            self.db.close()
+
+        atexit.unregister(self.flush)
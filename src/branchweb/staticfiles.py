@@ -0,0 +1,390 @@
+import collections
+import email.utils
+import functools
+import mimetypes
+import os
+import stat
+import threading
+import time
+
+from . import compression
+from . import metrics
+from . import webserver
+
+# precompressed siblings in order of preference, by the
+# Content-Encoding they are sent with
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+# cache budget of an entry without data
+ENTRY_OVERHEAD = 256
+
+#
+# Content-Type of a file name, text is assumed to be utf-8
+#
+@functools.lru_cache(maxsize=256)
+def content_type_of(extension: str) -> str:
+    content_type = mimetypes.guess_type("file" + extension)[0] or "application/octet-stream"
+
+    if(content_type.startswith("text/") or content_type in ("application/javascript", "application/json")):
+        content_type += "; charset=utf-8"
+
+    return content_type
+
+#
+# file_entry class
+#
+# A regular file as it was when it was last checked, small files
+# carry their contents. siblings maps the encodings of up to date
+# precompressed variants to their paths.
+#
+class file_entry():
+
+    def __init__(self, path: str, st: os.stat_result, content_type: str, data: bytes = None, siblings: dict = None):
+        self.path = path
+        self.signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.etag = "\"{:x}-{:x}-{:x}\"".format(*self.signature)
+        self.content_type = content_type
+        self.data = data
+        self.siblings = siblings or { }
+        self.checked = time.monotonic()
+
+    def cost(self) -> int:
+        return ENTRY_OVERHEAD + (len(self.data) if self.data is not None else 0)
+
+#
+# file_cache class
+#
+# file_entry objects by path, the least recently used ones are
+# evicted beyond max_bytes. Entries are checked against the file
+# system again once they are older than WEB_CONFIG["static_revalidate"]
+# seconds, hot files cost no system call in between.
+#
+class file_cache():
+
+    def __init__(self, max_bytes: int = None, max_file: int = None):
+        if(max_bytes is None):
+            max_bytes = webserver.WEB_CONFIG["static_cache_bytes"]
+
+        if(max_file is None):
+            max_file = webserver.WEB_CONFIG["static_cache_max_file"]
+
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: str, siblings: bool = True) -> file_entry:
+        """
+        Returns the entry of a regular file
+
+        Args
+        ----
+            path (str): The file path
+            siblings (bool, optional): Look for precompressed variants of the file
+
+        Returns
+        -------
+        The file_entry or None if path is not a regular file
+        """
+
+        with self.lock:
+            entry = self.entries.get(path)
+
+            if(entry is not None and time.monotonic() - entry.checked < webserver.WEB_CONFIG["static_revalidate"]):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry
+
+        try:
+            st = os.stat(path)
+        except (OSError, ValueError):
+            self.drop(path)
+            return None
+
+        if(not stat.S_ISREG(st.st_mode)):
+            self.drop(path)
+            return None
+
+        if(entry is not None and entry.signature == (st.st_ino, st.st_mtime_ns, st.st_size)):
+            if(siblings):
+                entry.siblings = file_cache.find_siblings(path, st)
+
+            entry.checked = time.monotonic()
+
+            with self.lock:
+                self.hits += 1
+
+            return entry
+
+        with self.lock:
+            self.misses += 1
+
+        entry = self.load(path, st)
+        if(entry is not None and siblings):
+            entry.siblings = file_cache.find_siblings(path, st)
+
+        if(entry is not None):
+            self.put(path, entry)
+
+        return entry
+
+    #
+    # Build the entry of a changed or new file, small
+    # files are read while they are still open
+    #
+    def load(self, path: str, st: os.stat_result) -> file_entry:
+        content_type = content_type_of(os.path.splitext(path)[1].lower())
+
+        if(st.st_size > self.max_file):
+            return file_entry(path, st, content_type)
+
+        try:
+            with open(path, "rb") as file:
+                st = os.fstat(file.fileno())
+                data = file.read(self.max_file + 1)
+        except OSError:
+            return None
+
+        # grew since the stat, sent from disk
+        if(len(data) != st.st_size):
+            return file_entry(path, st, content_type)
+
+        return file_entry(path, st, content_type, data)
+
+    #
+    # Precompressed variants that are not older than the file
+    #
+    @staticmethod
+    def find_siblings(path: str, st: os.stat_result) -> dict:
+        siblings = { }
+
+        for encoding, suffix in PRECOMPRESSED:
+            try:
+                sibling = os.stat(path + suffix)
+            except OSError:
+                continue
+
+            if(stat.S_ISREG(sibling.st_mode) and sibling.st_mtime_ns >= st.st_mtime_ns):
+                siblings[encoding] = path + suffix
+
+        return siblings
+
+    def put(self, path: str, entry: file_entry):
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if(old is not None):
+                self.size -= old.cost()
+
+            self.entries[path] = entry
+            self.size += entry.cost()
+
+            while(self.entries and self.size > self.max_bytes):
+                self.size -= self.entries.popitem(last=False)[1].cost()
+
+    def drop(self, path: str):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if(entry is not None):
+                self.size -= entry.cost()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def collect_metrics(self) -> list:
+        """
+        Returns the static file cache gauges and counters for the metrics registry
+        """
+
+        with self.lock:
+            return [
+                ("branchweb_static_cache_entries", "gauge", "Files known to the static file cache.", { }, len(self.entries)),
+                ("branchweb_static_cache_bytes", "gauge", "Size of the cached static files.", { }, self.size),
+                ("branchweb_static_cache_hits_total", "counter", "Static file lookups answered from the cache.", { }, self.hits),
+                ("branchweb_static_cache_misses_total", "counter", "Static file lookups that loaded the file.", { }, self.misses)
+            ]
+
+cache = file_cache()
+metrics.registry.add_collector(cache.collect_metrics)
+
+#
+# static_mount class
+#
+# Serves the files below directory for the GET requests of a
+# URL prefix, see web_server.register_static_mount. Directories
+# are answered with their index file, dot files are never served.
+#
+class static_mount():
+
+    def __init__(self, prefix: str, directory: str, cache_control: str = None, index: str = "index.html", cache: file_cache = None):
+        if(cache_control is None):
+            cache_control = webserver.WEB_CONFIG["static_cache_control"]
+
+        self.prefix = prefix.strip("/")
+        self.directory = os.path.abspath(directory)
+        self.cache_control = cache_control
+        self.index = index
+        self.cache = cache
+
+        if(not os.path.isdir(self.directory)):
+            raise ValueError("Not a directory: {}".format(directory))
+
+    #
+    # Returns the path below the prefix if the
+    # route belongs to this mount, otherwise None
+    #
+    def relative(self, route: str) -> str:
+        if(not self.prefix):
+            return route
+
+        if(route == self.prefix):
+            return ""
+
+        if(route.startswith(self.prefix) and route[len(self.prefix)] == "/"):
+            return route[len(self.prefix) + 1:]
+
+        return None
+
+    #
+    # Map a relative path to a file path, None if it
+    # could leave the directory or names a dot file
+    #
+    def file_path(self, path: str) -> str:
+        segments = path.split("/")
+
+        for segment in segments:
+            if(segment.startswith(".") or "\\" in segment or "\0" in segment):
+                return None
+
+        if(path.endswith("/") or not path):
+            segments[-1] = self.index
+
+        return os.path.join(self.directory, *segments)
+
+    def handle(self, httphandler, form_data: dict, path: str = ""):
+        files = self.cache if self.cache is not None else cache
+        file_path = self.file_path(path)
+
+        entry = files.get(file_path) if file_path is not None else None
+        if(entry is None):
+            if(file_path is not None and not path.endswith("/") and os.path.isdir(file_path)):
+                send_redirect(httphandler, "/" + "/".join(filter(None, (self.prefix, path))) + "/")
+                return
+
+            httphandler.response_webstatus = webserver.webstatus.SERV_FAILURE.name
+            httphandler.send_error(404, "File not found")
+            return
+
+        encoding = None
+        variant = entry
+        accept_encoding = httphandler.headers["Accept-Encoding"]
+
+        if(entry.siblings and accept_encoding is not None):
+            encoding = compression.negotiate(accept_encoding, tuple(entry.siblings))
+
+            if(encoding is not None):
+                variant = files.get(entry.siblings[encoding], False)
+
+                # removed since the last check
+                if(variant is None):
+                    encoding = None
+                    variant = entry
+
+        send_variant(httphandler, entry, variant, encoding, self.cache_control)
+
+def send_redirect(httphandler, location: str):
+    httphandler.send_response(301)
+    httphandler.send_header("Location", location)
+    httphandler.send_header("Content-Length", 0)
+    httphandler.end_headers()
+
+#
+# Send a file_entry of a static file, variant is the entry
+# of the file or of its precompressed sibling for encoding
+#
+def send_variant(httphandler, entry: file_entry, variant: file_entry, encoding: str, cache_control: str):
+    file = None
+
+    if(variant.data is None):
+        try:
+            file = open(variant.path, "rb")
+        except OSError:
+            httphandler.send_error(404, "File not found")
+            return
+
+        # the headers have to describe what is sent
+        st = os.fstat(file.fileno())
+        if(variant.signature != (st.st_ino, st.st_mtime_ns, st.st_size)):
+            variant = file_entry(variant.path, st, variant.content_type)
+
+    try:
+        send_file_entry(httphandler, entry, variant, encoding, cache_control, file)
+    except (BrokenPipeError, ConnectionResetError):
+        httphandler.close_connection = True
+        webserver.info("Client disconnected before static file download completed.")
+    finally:
+        if(file is not None):
+            file.close()
+
+def send_file_entry(httphandler, entry: file_entry, variant: file_entry, encoding: str, cache_control: str, file):
+    if(httphandler.is_not_modified(variant.etag, variant.mtime)):
+        httphandler.send_response(304)
+        send_validators(httphandler, entry, variant, cache_control)
+        httphandler.end_headers()
+        return
+
+    start = 0
+    end = variant.size - 1
+
+    byte_range = None
+    if(httphandler.range_applies(variant.etag, variant.mtime)):
+        byte_range = webserver.web_server.parse_range(httphandler.headers["Range"], variant.size)
+
+        if(byte_range == ()):
+            httphandler.send_response(416)
+            httphandler.send_header("Content-Range", "bytes */{}".format(variant.size))
+            httphandler.send_header("Content-Length", 0)
+            httphandler.end_headers()
+            return
+
+    if(byte_range is None):
+        httphandler.send_response(200)
+    else:
+        start, end = byte_range
+        httphandler.send_response(206)
+        httphandler.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, variant.size))
+
+    httphandler.send_header("Content-Type", entry.content_type)
+    httphandler.send_header("Content-Length", end - start + 1)
+    httphandler.send_header("Accept-Ranges", "bytes")
+
+    if(encoding is not None):
+        httphandler.send_header("Content-Encoding", encoding)
+
+    send_validators(httphandler, entry, variant, cache_control)
+    httphandler.end_headers()
+
+    if(file is None):
+        if(byte_range is None):
+            httphandler.write_answer(variant.data)
+        else:
+            httphandler.write_answer(memoryview(variant.data)[start:end + 1])
+    else:
+        httphandler.write_file_range(file, start, end - start + 1, True)
+
+def send_validators(httphandler, entry: file_entry, variant: file_entry, cache_control: str):
+    httphandler.send_header("ETag", variant.etag)
+    httphandler.send_header("Last-Modified", email.utils.formatdate(variant.mtime, usegmt=True))
+
+    if(cache_control):
+        httphandler.send_header("Cache-Control", cache_control)
+
+    if(entry.siblings):
+        httphandler.send_header("Vary", "Accept-Encoding")
@@ -0,0 +1,459 @@
+import collections
+import selectors
+import socket
+import threading
+import time
+
+from . import metrics
+from . import webserver
+
+STREAM_FORMATS = {
+    "sse": "text/event-stream; charset=utf-8",
+    "jsonl": "application/x-ndjson"
+}
+
+#
+# stream_subscriber class
+#
+# One streaming response connection. Its socket is owned by the
+# hub thread, which writes the queued events without blocking.
+# The stream ends once server, the server that accepted the
+# connection, is draining.
+#
+class stream_subscriber():
+
+    def __init__(self, hub, channels: list, format: str, chunked: bool, head: bytes, server = None):
+        self.hub = hub
+        self.server = server
+        self.channels = list(channels)
+        self.format = format
+        self.chunked = chunked
+        self.sock = None
+
+        # queued bytes, starting with the response headers
+        self.buffer = collections.deque([ head ])
+        self.buffered = len(head)
+
+        # "open", "ending" once the stream was closed, and
+        # "dead" once the socket is closed or should be
+        self.state = "open"
+        self.last_enqueue = time.monotonic()
+        self.last_progress = time.monotonic()
+        self.events = 0
+
+    #
+    # Send an event to this subscriber only, e.g. the current
+    # state before the published changes
+    #
+    def send(self, data, event: str = None, event_id: str = None):
+        frame = self.hub.encode(self.format, self.chunked, data, event, event_id)
+
+        with self.hub.lock:
+            self.hub.enqueue(self, frame)
+
+    #
+    # End the response once the queued events are written
+    #
+    def close(self):
+        self.hub.end(self)
+
+#
+# stream_hub class
+#
+# Publish / subscribe for streaming responses. Published events are
+# encoded once per format and queued on every subscriber of the
+# channel, a single thread writes them to all subscriber sockets.
+#
+# Idle streams receive a heartbeat every WEB_CONFIG["stream_heartbeat"]
+# seconds. Subscribers that fall behind by more than
+# WEB_CONFIG["stream_max_buffer"] bytes or make no progress for
+# WEB_CONFIG["stream_write_timeout"] seconds are disconnected, so a
+# slow consumer never holds back the others.
+#
+class stream_hub():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # channel -> subscribers
+        self.channels: dict[str, set] = { }
+
+        # handed over by request handlers, not yet registered
+        self.attaching: list = [ ]
+
+        # subscribers with new data or a new state
+        self.dirty: set = set()
+
+        self.thread = None
+        self.selector = None
+        self.wake_r = None
+        self.wake_w = None
+        self.woken = False
+        self.subscribers = 0
+
+        self.published = 0
+        self.evicted = 0
+
+    #
+    # Encode one event in the wire format of a stream
+    #
+    @staticmethod
+    def encode(format: str, chunked: bool, data, event: str = None, event_id: str = None) -> bytes:
+        if(isinstance(data, str)):
+            data = data.encode("utf-8")
+        elif(not isinstance(data, (bytes, bytearray))):
+            data = webserver.json_dumps(data)
+
+        if(format == "sse"):
+            frame = bytearray()
+
+            if(event is not None):
+                frame += b"event: " + event.encode("utf-8") + b"\n"
+
+            if(event_id is not None):
+                frame += b"id: " + str(event_id).encode("utf-8") + b"\n"
+
+            for line in bytes(data).split(b"\n"):
+                frame += b"data: " + line + b"\n"
+
+            frame += b"\n"
+        else:
+            # event names and ids have no equivalent in json lines
+            frame = bytes(data) + b"\n"
+
+        if(chunked):
+            return b"%x\r\n" % len(frame) + bytes(frame) + b"\r\n"
+
+        return bytes(frame)
+
+    def publish(self, channel: str, data, event: str = None, event_id: str = None) -> int:
+        """
+        Sends an event to all subscribers of a channel
+
+        Args
+        ----
+            channel (str): The channel name
+            data: The event data, bytes and str are sent as they are, other objects as json
+            event (str, optional): The SSE event name
+            event_id (str, optional): The SSE event id, clients send the last one back as Last-Event-ID
+
+        Returns
+        -------
+        The amount of subscribers the event was queued for
+        """
+
+        frames = { }
+
+        with self.lock:
+            subscribers = self.channels.get(channel)
+            if(not subscribers):
+                return 0
+
+            self.published += 1
+            queued = 0
+
+            # evicting a subscriber changes the set
+            for sub in list(subscribers):
+                variant = (sub.format, sub.chunked)
+                frame = frames.get(variant)
+
+                if(frame is None):
+                    frame = self.encode(sub.format, sub.chunked, data, event, event_id)
+                    frames[variant] = frame
+
+                if(self.enqueue(sub, frame)):
+                    queued += 1
+
+            return queued
+
+    #
+    # Queue bytes for a subscriber, called with the lock held
+    # Returns False if the subscriber is gone or was evicted
+    #
+    def enqueue(self, sub: stream_subscriber, frame: bytes) -> bool:
+        if(sub.state != "open"):
+            return False
+
+        sub.buffer.append(frame)
+        sub.buffered += len(frame)
+        sub.last_enqueue = time.monotonic()
+        sub.events += 1
+
+        if(sub.buffered > webserver.WEB_CONFIG["stream_max_buffer"]):
+            self.evict(sub, "fell {} bytes behind".format(sub.buffered))
+
+        self.mark(sub)
+        return sub.state == "open"
+
+    # called with the lock held
+    def mark(self, sub: stream_subscriber):
+        self.dirty.add(sub)
+
+        if(not self.woken and self.wake_w is not None):
+            self.woken = True
+
+            try:
+                self.wake_w.send(b"\0")
+            except BlockingIOError:
+                pass
+
+    # called with the lock held
+    def unsubscribe(self, sub: stream_subscriber):
+        for channel in sub.channels:
+            subscribers = self.channels.get(channel)
+            if(subscribers is None):
+                continue
+
+            subscribers.discard(sub)
+            if(not subscribers):
+                del self.channels[channel]
+
+    # called with the lock held
+    def evict(self, sub: stream_subscriber, reason: str):
+        self.unsubscribe(sub)
+        sub.state = "dead"
+        self.evicted += 1
+        webserver.debug("Evicted stream subscriber: {}", reason)
+
+    #
+    # Subscribe a new stream, its connection is handed
+    # over with attach() once the handler is done with it
+    #
+    def subscribe(self, channels: list, format: str, chunked: bool, head: bytes, server = None) -> stream_subscriber:
+        sub = stream_subscriber(self, channels, format, chunked, head, server)
+
+        with self.lock:
+            for channel in sub.channels:
+                self.channels.setdefault(channel, set()).add(sub)
+
+        return sub
+
+    def attach(self, sub: stream_subscriber, sock: socket.socket):
+        sock.setblocking(False)
+        self.start()
+
+        # the hub thread registers the socket before it
+        # flushes a subscriber that has one
+        with self.lock:
+            sub.sock = sock
+            sub.last_progress = time.monotonic()
+            self.subscribers += 1
+            self.attaching.append(sub)
+            self.mark(sub)
+
+    def end(self, sub: stream_subscriber):
+        with self.lock:
+            if(sub.state != "open"):
+                return
+
+            self.unsubscribe(sub)
+
+            if(sub.chunked):
+                sub.buffer.append(b"0\r\n\r\n")
+
+            sub.state = "ending"
+            self.mark(sub)
+
+    def close_channel(self, channel: str):
+        """
+        Ends the streams of all subscribers of a channel
+        """
+
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+
+        for sub in subscribers:
+            self.end(sub)
+
+    def channel_count(self, channel: str) -> int:
+        with self.lock:
+            return len(self.channels.get(channel, ()))
+
+    def start(self):
+        if(self.thread is not None):
+            return
+
+        with self.lock:
+            if(self.thread is not None):
+                return
+
+            self.selector = selectors.DefaultSelector()
+            self.wake_r, self.wake_w = socket.socketpair()
+            self.wake_r.setblocking(False)
+            self.wake_w.setblocking(False)
+            self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+
+            self.thread = threading.Thread(target=self.run, name="branchweb-streams", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        next_sweep = time.monotonic() + 1
+
+        while True:
+            with self.lock:
+                attaching = self.attaching
+                dirty = self.dirty
+                self.attaching = [ ]
+                self.dirty = set()
+                self.woken = False
+
+            for sub in attaching:
+                self.selector.register(sub.sock, selectors.EVENT_READ, sub)
+
+            for sub in dirty:
+                if(sub.sock is not None):
+                    self.flush(sub)
+
+            for key, mask in self.selector.select(max(0, next_sweep - time.monotonic())):
+                sub = key.data
+                if(sub is None):
+                    try:
+                        self.wake_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+
+                if(mask & selectors.EVENT_READ):
+                    self.receive(sub)
+
+                if(mask & selectors.EVENT_WRITE):
+                    self.flush(sub)
+
+            if(time.monotonic() >= next_sweep):
+                self.sweep()
+                next_sweep = time.monotonic() + 1
+
+    #
+    # Clients do not send anything on a stream, reading
+    # only notices that they went away
+    #
+    def receive(self, sub: stream_subscriber):
+        try:
+            data = sub.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if(not data):
+            with self.lock:
+                self.unsubscribe(sub)
+                sub.state = "dead"
+
+            self.drop(sub)
+
+    #
+    # Write as much of the queue as the socket takes
+    # and update what the selector waits for
+    #
+    def flush(self, sub: stream_subscriber):
+        with self.lock:
+            state = sub.state
+            data = b"".join(sub.buffer)
+            sub.buffer.clear()
+            sub.buffered = 0
+
+        if(state == "dead"):
+            self.drop(sub)
+            return
+
+        sent = 0
+        if(data):
+            try:
+                sent = sub.sock.send(data)
+            except BlockingIOError:
+                pass
+            except OSError:
+                with self.lock:
+                    self.unsubscribe(sub)
+                    sub.state = "dead"
+
+                self.drop(sub)
+                return
+
+        with self.lock:
+            if(sent < len(data)):
+                sub.buffer.appendleft(data[sent:])
+                sub.buffered += len(data) - sent
+
+            if(sent > 0):
+                sub.last_progress = time.monotonic()
+
+            pending = bool(sub.buffer)
+            ended = sub.state == "ending" and not pending
+
+        if(ended):
+            self.drop(sub)
+            return
+
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if pending else selectors.EVENT_READ
+        if(self.selector.get_key(sub.sock).events != events):
+            self.selector.modify(sub.sock, events, sub)
+
+    #
+    # Close the socket of a subscriber, hub thread only
+    #
+    def drop(self, sub: stream_subscriber):
+        if(sub.sock is None):
+            return
+
+        try:
+            self.selector.unregister(sub.sock)
+        except (KeyError, ValueError):
+            pass
+
+        sub.sock.close()
+        sub.sock = None
+
+        with self.lock:
+            self.subscribers -= 1
+
+    #
+    # Heartbeats, stalled consumers and draining, once a second
+    #
+    def sweep(self):
+        now = time.monotonic()
+        heartbeat = webserver.WEB_CONFIG["stream_heartbeat"]
+        write_timeout = webserver.WEB_CONFIG["stream_write_timeout"]
+
+        with self.lock:
+            subscribers = [ key.data for key in self.selector.get_map().values() if key.data is not None ]
+
+        for sub in subscribers:
+            # the server of the stream shuts down
+            if(getattr(sub.server, "draining", False)):
+                self.end(sub)
+                continue
+
+            with self.lock:
+                if(sub.state != "open"):
+                    continue
+
+                if(sub.buffer and now - sub.last_progress > write_timeout):
+                    self.evict(sub, "no progress for {:.0f} s".format(now - sub.last_progress))
+                    self.mark(sub)
+                elif(now - sub.last_enqueue >= heartbeat):
+                    frame = b": heartbeat\n\n" if sub.format == "sse" else b"\n"
+                    if(sub.chunked):
+                        frame = b"%x\r\n" % len(frame) + frame + b"\r\n"
+
+                    self.enqueue(sub, frame)
+
+    def collect_metrics(self) -> list:
+        """
+        Returns the stream gauges and counters for the metrics registry
+        """
+
+        with self.lock:
+            return [
+                ("branchweb_stream_subscribers", "gauge", "Open streaming responses.", { }, self.subscribers),
+                ("branchweb_stream_channels", "gauge", "Channels with subscribers.", { }, len(self.channels)),
+                ("branchweb_stream_events_total", "counter", "Events published to a channel with subscribers.", { }, self.published),
+                ("branchweb_stream_evicted_total", "counter", "Subscribers disconnected for falling behind.", { }, self.evicted)
+            ]
+
+hub = stream_hub()
+metrics.registry.add_collector(hub.collect_metrics)
+
+def publish(channel: str, data, event: str = None, event_id: str = None) -> int:
+    return hub.publish(channel, data, event, event_id)
@@ -1,8 +1,11 @@
 
-import bcrypt
 import time
 
 from .key import key
+from .passwordhasher import get_hasher, auth_rejected
+from . import webserver
+from . import metrics
+from . import profiling
 
 #
 # user class
@@ -23,12 +26,11 @@ class user():
         self.phash: str = ""
         self.authkeys: dict[str, key] = {}
 
-        if (passwd is not None):
-            byte_array = passwd.encode("utf-8")
-            salt = bcrypt.gensalt()
-            passwdhash = bcrypt.hashpw(byte_array, salt)
+        # the usermanager indexing this users keys, set by the manager
+        self.manager = None
 
-            self.phash = passwdhash.decode("utf-8")
+        if (passwd is not None):
+            self.phash = get_hasher().hash_password(passwd).result()
 
     @staticmethod
     def from_pw_hash(name: str, phash: str) -> super:
@@ -58,32 +60,121 @@ class user():
             passwd (str): The new password to set
         """
 
-        byte_array = passwd.encode("utf-8")
-        salt = bcrypt.gensalt()
-        passwdhash = bcrypt.hashpw(byte_array, salt)
-
-        self.phash = passwdhash.decode("utf-8")
+        self.phash = get_hasher().hash_password(passwd).result()
 
-    def authenticate(self, passwd: str) -> key:
+    def authenticate(self, passwd: str, client: str = None) -> key:
         """
         Checks if the supplied password is valid for the user and returns an authkey
 
+        The password is verified in the password hasher pool, attempts
+        are throttled per user and per client.
+
         Args
         ----
             passwd: (str): The password to validate
+            client (str, optional): The client address, used for throttling
 
         Returns
         -------
-        The new authkey or None on failure
+        The new authkey or None on failure or if the attempt was rejected
         """
 
-        if (bcrypt.checkpw(passwd.encode("utf-8"), self.phash.encode("utf-8"))):
-            newkey = key()
-            self.authkeys[newkey.key_id] = newkey
-            print("User {} authenticated for key {}".format(self.name, newkey.key_id))
-            return newkey
-        else:
+        trace = profiling.current_trace()
+        started = time.perf_counter()
+
+        try:
+            valid = get_hasher().verify(self.name, passwd, self.phash, client).result()
+        except auth_rejected as ex:
+            metrics.registry.count_auth("rejected")
+            webserver.info("Authentication of user {} rejected: {}", self.name, ex)
             return None
+        finally:
+            if (trace is not None):
+                trace.add("auth", time.perf_counter() - started)
+
+        if (not valid):
+            metrics.registry.count_auth("failure")
+            return None
+
+        metrics.registry.count_auth("success")
+
+        self.rehash(passwd)
+        return self.create_authkey()
+
+    async def authenticate_async(self, passwd: str, client: str = None) -> key:
+        """
+        Awaitable version of authenticate() for async def endpoints
+        """
+
+        hasher = get_hasher()
+
+        try:
+            valid = await hasher.verify_async(self.name, passwd, self.phash, client)
+        except auth_rejected as ex:
+            metrics.registry.count_auth("rejected")
+            webserver.info("Authentication of user {} rejected: {}", self.name, ex)
+            return None
+
+        if (not valid):
+            metrics.registry.count_auth("failure")
+            return None
+
+        metrics.registry.count_auth("success")
+
+        if (hasher.needs_rehash(self.phash)):
+            try:
+                self.update_hash(await hasher.hash_password_async(passwd, limited=True))
+            except auth_rejected:
+                pass
+
+        return self.create_authkey()
+
+    def rehash(self, passwd: str):
+        """
+        Rehashes the password after a successful login if WEB_CONFIG["bcrypt_rounds"] changed
+
+        Args
+        ----
+            passwd (str): The verified password
+        """
+
+        hasher = get_hasher()
+        if (not hasher.needs_rehash(self.phash)):
+            return
+
+        try:
+            self.update_hash(hasher.hash_password(passwd, limited=True).result())
+        except auth_rejected:
+            # try again on the next login
+            pass
+
+    def update_hash(self, phash: str):
+        """
+        Replaces the password hash and persists it through the usermanager
+        """
+
+        self.phash = phash
+
+        if (self.manager is not None):
+            self.manager.save_user(self)
+
+    def create_authkey(self) -> key:
+        """
+        Mints a new authkey for this user
+
+        Returns
+        -------
+        The new authkey
+        """
+
+        newkey = key()
+        self.authkeys[newkey.key_id] = newkey
+
+        if (self.manager is not None):
+            self.manager.index_key(newkey, self)
+
+        webserver.info("User {} authenticated for key {}", self.name, newkey.key_id)
+        return newkey
 
     def has_authkey(self, authkey: str) -> bool:
         """
@@ -113,10 +204,11 @@ class user():
         True, False if the key was never handed out
         """
 
-        if (not self.has_authkey(authkey)):
+        if (self.authkeys.pop(authkey, None) is None):
             return False
 
-        del self.authkeys[authkey]
+        if (self.manager is not None):
+            self.manager.unindex_key(authkey)
 
         return True
 
@@ -136,9 +228,9 @@ class user():
 
         revoked_keys = 0
 
-        for (hash, key) in self.authkeys:
-            if (key.has_expired(cur_time, lifetime)):
-                self.revoke_authkey(hash)
+        for (key_id, k) in list(self.authkeys.items()):
+            if (k.has_expired(cur_time, lifetime)):
+                self.revoke_authkey(key_id)
                 revoked_keys = revoked_keys + 1
 
         return revoked_keys
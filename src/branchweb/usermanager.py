@@ -1,32 +1,139 @@
 USER_FILE = "users.meta"
 
 import secrets
-import os
 import string
-import bcrypt
+import threading
+import heapq
+import time
 
 from .user import user
+from .key import key
+from .passwordhasher import get_hasher
+from .userstore import user_store, flat_file_store
+from .sessionstore import session_store, memory_session_store, sqlite_session_store
 from . import webserver
+from . import metrics
 
 #
 # usermanager class
 # 
 class usermanager():
 
-    def __init__(self, user_file: str = USER_FILE):
+    def __init__(self, user_file: str = USER_FILE, start_reaper: bool = True, store: user_store = None, sessions: session_store = None):
         """
         Creates a new usermanager and reads or creates the userfile
 
         Args
         ----
             user_file (str, optional): The path to the userfile. Defaults to USER_FILE.
+            start_reaper (bool, optional): Start the background key expiry thread. Defaults to True.
+            store (user_store, optional): The storage backend, replaces user_file. Defaults to a flat_file_store on user_file.
+            sessions (session_store, optional): Where authkeys are kept. Defaults to the database of shared stores, memory otherwise.
         """
 
-        webserver.debug("Initializing new user manager with userfile at {}".format(user_file))
+        if (store is None):
+            store = flat_file_store(user_file)
 
-        self.userfile: str = user_file
+        if (sessions is None):
+            if (store.shared):
+                sessions = sqlite_session_store(store.path)
+            else:
+                sessions = memory_session_store()
+
+        webserver.debug("Initializing new user manager with {} at {}".format(type(store).__name__, store.path))
+
+        self.store: user_store = store
+        self.sessions: session_store = sessions
+        self.userfile: str = store.path
+
+        # all users for stores loaded up front, the ones
+        # looked up so far for lazy stores
         self.users: list[user] = []
-        self.read_file(user_file)
+        self.user_index: dict[str, user] = {}
+
+        # guards the store and the user list
+        self.store_lock = threading.RLock()
+        self.next_reload_check: float = time.monotonic() + webserver.WEB_CONFIG["userfile_check_interval"]
+
+        # key_id -> user index for constant time key lookups
+        self.key_index: dict[str, user] = {}
+        self.key_lock = threading.Lock()
+
+        # min-heap of (deadline, key_id), entries of refreshed keys
+        # are pushed back with their new deadline when they surface
+        self.key_deadlines: list[tuple[float, str]] = []
+
+        # key_id -> (owner, key, validated until) of keys validated against
+        # a shared session store within WEB_CONFIG["auth_cache_ttl"]
+        self.session_cache: dict[str, tuple[user, key, float]] = {}
+
+        self.keys_issued: int = 0
+        self.keys_expired: int = 0
+
+        self.reaper_thread: threading.Thread = None
+        self.reaper_stop = threading.Event()
+
+        if (self.store.is_empty()):
+            self.create_root_user(self.store)
+
+        self.read_file()
+
+        metrics.registry.add_collector(self.collect_metrics)
+
+        if (start_reaper):
+            self.start_key_reaper()
+
+    def attach_user(self, u: user):
+        """
+        Makes this manager track the keys of the supplied user
+
+        Args
+        ----
+            u (user): The user to attach
+        """
+
+        u.manager = self
+
+        for k in list(u.authkeys.values()):
+            self.index_key(k, u)
+
+    def index_key(self, k: key, owner: user):
+        """
+        Adds a key to the key index and schedules its expiry, called by user.authenticate()
+
+        Args
+        ----
+            k (key): The new key
+            owner (user): The user owning the key
+        """
+
+        deadline = k.timestamp + webserver.WEB_CONFIG["key_timeout"]
+
+        with self.key_lock:
+            self.key_index[k.key_id] = owner
+            heapq.heappush(self.key_deadlines, (deadline, k.key_id))
+            self.keys_issued += 1
+
+        self.sessions.put(k.key_id, owner.name, k.timestamp)
+
+    def unindex_key(self, key_id: str) -> user:
+        """
+        Removes a key from the key index, called by user.revoke_authkey()
+
+        Args
+        ----
+            key_id (str): The key id (UUID) to remove
+
+        Returns
+        -------
+        The user that owned the key, None if it was not indexed
+        """
+
+        self.sessions.delete(key_id)
+        self.session_cache.pop(key_id, None)
+
+        with self.key_lock:
+            return self.key_index.pop(key_id, None)
 
     def get_user(self, name: str) -> user:
         """
@@ -41,11 +148,54 @@ class usermanager():
         The user object or None if the user is not registered
         """
 
-        for u in self.users:
-            if(u.name == name):
-                return u
+        if (self.store.lazy):
+            return self.lookup_user(name)
 
-        return None
+        if (time.monotonic() >= self.next_reload_check):
+            self.reload_if_changed()
+
+        return self.user_index.get(name)
+
+    def lookup_user(self, name: str) -> user:
+        """
+        Fetches a user from a lazy store, updating or dropping the cached user object
+
+        Args
+        ----
+            name (str): The username to look up
+
+        Returns
+        -------
+        The user object or None if the user does not exist
+        """
+
+        phash = self.store.get_user(name)
+
+        with self.store_lock:
+            user_obj = self.user_index.get(name)
+
+            if (phash is None):
+                if (user_obj is not None):
+                    self.drop_user(user_obj)
+
+                return None
+
+            if (user_obj is not None):
+                user_obj.phash = phash
+                return user_obj
+
+            return self.track_user(user.from_pw_hash(name, phash))
+
+    def track_user(self, u: user) -> user:
+        """
+        Adds a user object to the user index and list
+        """
+
+        self.attach_user(u)
+        self.user_index[u.name] = u
+        self.users.append(u)
+
+        return u
 
     def get_key_owner(self, key_id: str) -> user:
         """
@@ -57,14 +207,231 @@ class usermanager():
 
         Returns
         -------
-        The user object or None if the key has not been authenticated
+        The user object or None if the key has not been authenticated or has expired
         """
 
-        for u in self.users:
-            if (u.has_authkey(key_id)):
-                return u
+        if (self.sessions.shared):
+            return self.get_shared_key_owner(key_id)
+
+        owner = self.key_index.get(key_id)
+        if (owner is None):
+            return None
+
+        k = owner.authkeys.get(key_id)
+        if (k is None):
+            return None
+
+        if (k.has_expired(time.time(), webserver.WEB_CONFIG["key_timeout"])):
+            if (owner.revoke_authkey(key_id)):
+                with self.key_lock:
+                    self.keys_expired += 1
+
+            return None
+
+        # sliding expiry window
+        k.refresh()
+        return owner
+
+    def get_shared_key_owner(self, key_id: str) -> user:
+        """
+        get_key_owner() for session stores shared between processes, the
+        key is validated against the store so keys minted or revoked by
+        other processes are honoured, at most WEB_CONFIG["auth_cache_ttl"]
+        seconds late
+
+        Args
+        ----
+            key_id (str): The key id (UUID) to look up
+
+        Returns
+        -------
+        The user object or None if the key is unknown or has expired
+        """
+
+        cached = self.session_cache.get(key_id)
+        if (cached is not None and cached[2] > time.monotonic()):
+            owner, k, validated_until = cached
+
+            # not revoked or reaped by this process meanwhile
+            if (owner.authkeys.get(key_id) is k and owner.manager is self):
+                k.refresh()
+                self.sessions.touch(key_id, k.timestamp)
+                return owner
+
+        stored = self.sessions.get(key_id)
+        cur_time = time.time()
+
+        if (stored is None or cur_time - stored[1] > webserver.WEB_CONFIG["key_timeout"]):
+            owner = self.key_index.get(key_id)
+
+            if (stored is not None):
+                self.sessions.delete(key_id)
+                with self.key_lock:
+                    self.keys_expired += 1
+
+            if (owner is not None):
+                owner.revoke_authkey(key_id)
+
+            return None
+
+        name, timestamp = stored
+
+        owner = self.get_user(name)
+        if (owner is None):
+            return None
+
+        k = owner.authkeys.get(key_id)
+        if (k is None):
+            # minted by another process
+            k = key.from_stored(key_id, timestamp)
+            owner.authkeys[key_id] = k
 
-        return None
+            with self.key_lock:
+                self.key_index[key_id] = owner
+                heapq.heappush(self.key_deadlines, (timestamp + webserver.WEB_CONFIG["key_timeout"], key_id))
+
+        k.refresh()
+        self.sessions.touch(key_id, k.timestamp)
+        self.session_cache[key_id] = (owner, k, time.monotonic() + webserver.WEB_CONFIG["auth_cache_ttl"])
+        return owner
+
+    def reap_expired_keys(self, cur_time: float = None) -> int:
+        """
+        Revokes all keys that have not been refreshed within WEB_CONFIG["key_timeout"]
+
+        Args
+        ----
+            cur_time (float, optional): The time to check against. Defaults to the current time.
+
+        Returns
+        -------
+        The amount of keys revoked
+        """
+
+        if (cur_time is None):
+            cur_time = time.time()
+
+        lifetime = webserver.WEB_CONFIG["key_timeout"]
+        refreshed = []
+        reaped = 0
+
+        with self.key_lock:
+            while (self.key_deadlines and self.key_deadlines[0][0] < cur_time):
+                deadline, key_id = heapq.heappop(self.key_deadlines)
+
+                owner = self.key_index.get(key_id)
+                if (owner is None):
+                    continue
+
+                k = owner.authkeys.get(key_id)
+                if (k is None):
+                    continue
+
+                if (k.has_expired(cur_time, lifetime)):
+                    del self.key_index[key_id]
+                    owner.authkeys.pop(key_id, None)
+                    reaped += 1
+                else:
+                    refreshed.append((k.timestamp + lifetime, key_id))
+
+            for entry in refreshed:
+                heapq.heappush(self.key_deadlines, entry)
+
+            # drop heap entries of revoked keys if they start to dominate
+            if (len(self.key_deadlines) > 2 * len(self.key_index) + 64):
+                self.key_deadlines = [ (owner.authkeys[key_id].timestamp + lifetime, key_id)
+                                       for key_id, owner in self.key_index.items()
+                                       if key_id in owner.authkeys ]
+                heapq.heapify(self.key_deadlines)
+
+            self.keys_expired += reaped
+
+            now = time.monotonic()
+            self.session_cache = { key_id: cached for key_id, cached in self.session_cache.items() if cached[2] > now }
+
+        # local copies of shared keys are only dropped above,
+        # the session store decides on its own timestamps
+        if (self.sessions.shared):
+            reaped += self.sessions.delete_expired(cur_time - lifetime)
+
+        if (reaped > 0):
+            webserver.debug("Reaped {} expired authkeys".format(reaped))
+
+        return reaped
+
+    def key_stats(self) -> dict:
+        """
+        Returns counters about the authkeys handled by this manager
+
+        Returns
+        -------
+        A dict with the live, issued and expired key counts
+        """
+
+        with self.key_lock:
+            return {
+                "live": len(self.key_index),
+                "issued": self.keys_issued,
+                "expired": self.keys_expired,
+                "scheduled": len(self.key_deadlines),
+                "stored": self.sessions.count()
+            }
+
+    def collect_metrics(self) -> list:
+        """
+        Returns the user and key gauges of this manager for the metrics registry
+        """
+
+        stats = self.key_stats()
+        labels = { "store": self.userfile }
+
+        return [
+            ("branchweb_live_keys", "gauge", "Authkeys held by this process.", labels, stats["live"]),
+            ("branchweb_stored_keys", "gauge", "Authkeys in the shared session store.", labels, stats["stored"]),
+            ("branchweb_keys_issued_total", "counter", "Authkeys minted by this process.", labels, stats["issued"]),
+            ("branchweb_keys_expired_total", "counter", "Authkeys expired by this process.", labels, stats["expired"]),
+            ("branchweb_users_loaded", "gauge", "User objects held by this process.", labels, len(self.users))
+        ]
+
+    def start_key_reaper(self, interval: float = None):
+        """
+        Starts the background thread revoking expired keys
+
+        Args
+        ----
+            interval (float, optional): Seconds between runs. Defaults to WEB_CONFIG["key_reap_interval"].
+        """
+
+        if (self.reaper_thread is not None and self.reaper_thread.is_alive()):
+            return
+
+        if (interval is None):
+            interval = webserver.WEB_CONFIG["key_reap_interval"]
+
+        self.reaper_stop.clear()
+        self.reaper_thread = threading.Thread(target=self._reaper_loop, args=(interval,), name="branchweb-key-reaper", daemon=True)
+        self.reaper_thread.start()
+
+    def stop_key_reaper(self):
+        """
+        Stops the background key expiry thread
+        """
+
+        if (self.reaper_thread is None):
+            return
+
+        self.reaper_stop.set()
+        self.reaper_thread.join()
+        self.reaper_thread = None
+
+        self.sessions.flush()
+
+    def _reaper_loop(self, interval: float):
+        while (not self.reaper_stop.wait(interval)):
+            try:
+                self.reap_expired_keys()
+            except Exception as ex:
+                webserver.info("Key reaper failed: {}".format(ex))
 
     def revoke_authkey(self, key_id: str) -> user:
         """
@@ -104,85 +471,135 @@ class usermanager():
         True, False if the username is already taken
         """
 
-        for u in self.users:
-            if(u.name == username):
-                return False
+        if (self.get_user(username) is not None):
+            return False
 
         user_obj = user(username, password)
-        self.users.append(user_obj)
 
-        webserver.debug("New user {}: updating file..".format(username))
-        self.write_file(self.userfile)
+        with self.store_lock:
+            webserver.debug("New user {}: updating store..", username)
+
+            if (not self.store.add_user(username, user_obj.phash)):
+                return False
+
+            self.track_user(user_obj)
 
         return True
 
+    def save_user(self, u: user):
+        """
+        Persists the current password hash of a user
+
+        Args
+        ----
+            u (user): The user to persist
+        """
+
+        with self.store_lock:
+            self.store.put_user(u.name, u.phash)
+
     def write_file(self, user_file_path: str = ""):
         """
-        Writes out the current users to the (optionally) provided path
+        Writes out the current users to the store or the (optionally) provided userfile
+
+        Userfiles are written to a temporary file that replaces the
+        target after it was synced, so readers never see a torn file.
 
         Args
         ----
-            user_file_path (str, optional): The file to write into. Defaults to the userfile supplied to the constructor.
+            user_file_path (str, optional): The userfile to export into. Defaults to the store supplied to the constructor.
         """
 
-        if (user_file_path == ""):
-            user_file_path = self.userfile
+        with self.store_lock:
+            hashes = { u.name: u.phash for u in self.users }
 
-        webserver.debug("Writing userfile to {}".format(user_file_path))
-        user_file = open(user_file_path, "w")
+            if (user_file_path == "" or user_file_path == self.store.path):
+                self.store.save_users(hashes)
+                return
 
-        for u in self.users:
-            user_file.write("{}={}\n".format(u.name, u.phash))
+            # export everything, not just the users looked up so far
+            all_hashes = self.store.load_users()
+            all_hashes.update(hashes)
+            flat_file_store(user_file_path).replace_users(all_hashes)
 
-    def read_file(self, user_file_path: str):
+    def reload_if_changed(self) -> bool:
         """
-        Reads the userfile from the supplied path or creates it with a new root user
+        Reads the store again if it was changed by someone else
+
+        Returns
+        -------
+        True if the store was reloaded
+        """
+
+        self.next_reload_check = time.monotonic() + webserver.WEB_CONFIG["userfile_check_interval"]
+
+        if (not self.store.changed()):
+            return False
+
+        webserver.info("Userfile {} changed on disk, reloading..", self.userfile)
+        self.read_file()
+        return True
+
+    def read_file(self, user_file_path: str = ""):
+        """
+        Loads the users from the store or the supplied userfile
+
+        Users already known keep their authkeys, users missing
+        from the source are dropped. Lazy stores are not preloaded.
 
         Args
         ----
-            user_file_path (str): The file to read or create
+            user_file_path (str, optional): The userfile to read, created with a new root user if missing. Defaults to the store.
         """
-        self.users = []
 
-        if(not os.path.exists(user_file_path)):
-            self.create_userfile(user_file_path)
+        with self.store_lock:
+            if (user_file_path == "" or user_file_path == self.store.path):
+                if (self.store.lazy):
+                    return
 
-        webserver.debug("Reading user file from {}".format(user_file_path))
+                source = self.store
+            else:
+                source = flat_file_store(user_file_path)
+                if (source.is_empty()):
+                    self.create_root_user(source)
 
-        user_file = open(user_file_path, "r")
-        user_file_arr = user_file.read().split("\n")
+            hashes = source.load_users()
 
-        for userl in user_file_arr:
-            if(len(userl) == 0):
-                continue
+            for name in [ name for name in self.user_index if name not in hashes ]:
+                self.drop_user(self.user_index[name])
 
-            # skip comments
-            if(userl[0] == '#'):
-                continue
+            for usern, phash in hashes.items():
+                user_obj = self.user_index.get(usern)
+                if (user_obj is not None):
+                    user_obj.phash = phash
+                    continue
 
-            user_arr = userl.split("=")
-            usern = user_arr[0]
-            phash = user_arr[1]
+                self.track_user(user.from_pw_hash(usern, phash))
 
-            found = False
-            for u in self.users:
-                if(u.name == usern):
-                    found = True
+    def drop_user(self, u: user):
+        """
+        Forgets a user that disappeared from the store and revokes its keys
+        """
 
-            if (not found):
-                self.users.append(user.from_pw_hash(usern, phash))
+        with self.store_lock:
+            self.user_index.pop(u.name, None)
+            self.users.remove(u)
 
-    def create_userfile(self, user_file_path: str):
+            for key_id in list(u.authkeys.keys()):
+                u.revoke_authkey(key_id)
+
+            u.manager = None
+
+    def create_root_user(self, store: user_store):
         """
-        Creates a new userfile with a root user and random password
+        Adds a root user with a random password to the supplied store and prints the password
 
         Args
         ----
-            user_file_path (str): The userfile to create
+            store (user_store): The store to add the user to
         """
 
-        webserver.info("Creating new userfile at {}".format(user_file_path))
-        user_file = open(user_file_path, "w")
+        webserver.info("Creating new root user in {}".format(store.path))
 
         generator_chars = string.ascii_letters + string.digits + string.punctuation
 
@@ -197,9 +614,16 @@ class usermanager():
         webserver.info("Password: {}".format(pwd))
         webserver.info("============================")
 
-        byte_array = pwd.encode("utf-8")
-        salt = bcrypt.gensalt()
-        phash = bcrypt.hashpw(byte_array, salt)
+        phash = get_hasher().hash_password(pwd).result()
+        store.add_user("root", phash)
+
+    def create_userfile(self, user_file_path: str):
+        """
+        Creates a new userfile with a root user and random password
+
+        Args
+        ----
+            user_file_path (str): The userfile to create
+        """
 
-        user_file.write("root={}\n".format(phash.decode("utf-8")))
-        user_file.close()
+        self.create_root_user(flat_file_store(user_file_path))
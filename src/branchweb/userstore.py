@@ -0,0 +1,390 @@
+import contextlib
+import os
+import sqlite3
+import stat
+import tempfile
+import threading
+
+from . import webserver
+
+# fcntl is POSIX only, elsewhere a flat file store only
+# serializes the threads of its own process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#
+# user_store class
+#
+# Storage backend of a usermanager, maps usernames to password hashes
+#
+class user_store():
+
+    # users are looked up one by one instead of being loaded up front
+    lazy: bool = False
+
+    # other processes may change the store
+    shared: bool = False
+
+    path: str = ""
+
+    def is_empty(self) -> bool:
+        """
+        Checks if the store holds no users yet
+        """
+
+        raise NotImplementedError()
+
+    def load_users(self) -> dict:
+        """
+        Reads all users from the store
+
+        Returns
+        -------
+        A dict of username -> password hash
+        """
+
+        raise NotImplementedError()
+
+    def get_user(self, name: str) -> str:
+        """
+        Looks up a single user
+
+        Returns
+        -------
+        The password hash or None if the user does not exist
+        """
+
+        raise NotImplementedError()
+
+    def add_user(self, name: str, phash: str) -> bool:
+        """
+        Stores a new user
+
+        Returns
+        -------
+        True, False if the username is already taken
+        """
+
+        raise NotImplementedError()
+
+    def put_user(self, name: str, phash: str):
+        """
+        Stores or updates a user
+        """
+
+        raise NotImplementedError()
+
+    def save_users(self, users: dict):
+        """
+        Stores or updates all supplied users (username -> password hash)
+        """
+
+        raise NotImplementedError()
+
+    def delete_user(self, name: str):
+        """
+        Removes a user
+        """
+
+        raise NotImplementedError()
+
+    def changed(self) -> bool:
+        """
+        Checks if someone else modified the store since it was last read or written
+        """
+
+        return False
+
+    def close(self):
+        pass
+
+#
+# flat_file_store class
+#
+# The classic "name=hash" userfile. Changes are appended,
+# the last line of a user wins and the file is compacted
+# once outdated lines outnumber the users.
+#
+# Writers hold an flock on "<path>.lock" and read the file
+# again first if another process changed it, so prefork
+# workers sharing the file do not lose each others users.
+#
+class flat_file_store(user_store):
+
+    def __init__(self, path: str):
+        """
+        Creates a store on the supplied userfile, the file is read by load_users()
+
+        Args
+        ----
+            path (str): The path to the userfile
+        """
+
+        self.path = path
+        self.lock = threading.RLock()
+        self.hashes: dict[str, str] = {}
+        self.lines: int = 0
+        self.stat = None
+
+        # the lock file while it is held, and whether the file was
+        # reloaded for a write since the last load_users()
+        self.lock_fd = None
+        self.reloaded = False
+
+    #
+    # Hold the userfile lock across processes for a change,
+    # reloading the users first if the file changed on disk
+    #
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock:
+            if (self.lock_fd is not None):
+                yield
+                return
+
+            if (fcntl is not None):
+                self.lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+
+            try:
+                if (self.lock_fd is not None):
+                    fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+
+                if (self.stat_file() != self.stat):
+                    self.read_hashes()
+                    self.reloaded = True
+
+                yield
+            finally:
+                if (self.lock_fd is not None):
+                    os.close(self.lock_fd)
+                    self.lock_fd = None
+
+    @staticmethod
+    def write_atomic(path: str, content: str):
+        """
+        Replaces a file through a synced temporary file and rename
+
+        Args
+        ----
+            path (str): The file to replace
+            content (str): The new content
+        """
+
+        directory = os.path.dirname(os.path.abspath(path))
+
+        # a unique name, other processes may write the file at the same time
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                # mkstemp creates the file readable by the owner only
+                try:
+                    os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+                except FileNotFoundError:
+                    pass
+
+                tmp_file.write(content)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+            raise
+
+        # persist the rename itself
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def stat_file(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            return None
+
+    def is_empty(self) -> bool:
+        try:
+            return os.path.getsize(self.path) == 0
+        except OSError:
+            return True
+
+    def load_users(self) -> dict:
+        with self.lock:
+            self.read_hashes()
+            self.reloaded = False
+
+            return dict(self.hashes)
+
+    def read_hashes(self):
+        with self.lock:
+            hashes: dict[str, str] = {}
+            lines = 0
+
+            if (os.path.exists(self.path)):
+                webserver.debug("Reading user file from {}", self.path)
+
+                with open(self.path, "r") as user_file:
+                    user_file_arr = user_file.read().split("\n")
+
+                for userl in user_file_arr:
+                    if (len(userl) == 0):
+                        continue
+
+                    # skip comments
+                    if (userl[0] == '#'):
+                        continue
+
+                    # later lines override earlier ones
+                    usern, _, phash = userl.partition("=")
+                    hashes[usern] = phash
+                    lines += 1
+
+            self.hashes = hashes
+            self.lines = lines
+            self.stat = self.stat_file()
+
+    def get_user(self, name: str) -> str:
+        return self.hashes.get(name)
+
+    def add_user(self, name: str, phash: str) -> bool:
+        with self.locked():
+            if (name in self.hashes):
+                return False
+
+            self.put_user(name, phash)
+            return True
+
+    def put_user(self, name: str, phash: str):
+        with self.locked():
+            with open(self.path, "a") as user_file:
+                user_file.write("{}={}\n".format(name, phash))
+                user_file.flush()
+                os.fsync(user_file.fileno())
+
+            self.hashes[name] = phash
+            self.lines += 1
+            self.stat = self.stat_file()
+
+            if (self.lines > 2 * len(self.hashes) + 64):
+                self.rewrite()
+
+    def save_users(self, users: dict):
+        with self.locked():
+            self.hashes.update(users)
+            self.rewrite()
+
+    def delete_user(self, name: str):
+        with self.locked():
+            if (self.hashes.pop(name, None) is not None):
+                self.rewrite()
+
+    def replace_users(self, users: dict):
+        """
+        Replaces the content of the userfile with the supplied users
+        """
+
+        with self.locked():
+            self.hashes = dict(users)
+            self.rewrite()
+
+    def rewrite(self):
+        webserver.debug("Writing userfile to {}", self.path)
+
+        with self.locked():
+            flat_file_store.write_atomic(self.path, "".join([ "{}={}\n".format(name, phash) for name, phash in self.hashes.items() ]))
+            self.lines = len(self.hashes)
+            self.stat = self.stat_file()
+
+    # also True if a write picked up the changes of another process
+    def changed(self) -> bool:
+        return self.reloaded or self.stat_file() != self.stat
+
+#
+# sqlite_store class
+#
+# SQLite database in WAL mode with an indexed user table.
+# Several server processes can share it, users are looked
+# up on demand instead of being held in memory.
+#
+class sqlite_store(user_store):
+
+    lazy = True
+    shared = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            name TEXT PRIMARY KEY,
+            phash TEXT NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str):
+        """
+        Opens (and if needed creates) the database at the supplied path
+
+        Args
+        ----
+            path (str): The path to the database file
+        """
+
+        self.path = path
+        self.lock = threading.Lock()
+
+        # autocommit, transactions are opened explicitly where needed
+        self.db = sqlite3.connect(path, timeout=webserver.WEB_CONFIG["sqlite_busy_timeout"], isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(sqlite_store.SCHEMA)
+
+        webserver.debug("Opened user database at {}", path)
+
+    def query(self, sql: str, args: tuple = ()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def modify(self, sql: str, args: tuple = ()) -> int:
+        with self.lock:
+            return self.db.execute(sql, args).rowcount
+
+    def is_empty(self) -> bool:
+        return not self.query("SELECT 1 FROM users LIMIT 1")
+
+    def load_users(self) -> dict:
+        return dict(self.query("SELECT name, phash FROM users"))
+
+    def get_user(self, name: str) -> str:
+        rows = self.query("SELECT phash FROM users WHERE name = ?", (name, ))
+        return rows[0][0] if rows else None
+
+    def add_user(self, name: str, phash: str) -> bool:
+        return self.modify("INSERT OR IGNORE INTO users (name, phash) VALUES (?, ?)", (name, phash)) == 1
+
+    def put_user(self, name: str, phash: str):
+        self.modify("INSERT INTO users (name, phash) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET phash = excluded.phash", (name, phash))
+
+    def save_users(self, users: dict):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany("INSERT INTO users (name, phash) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET phash = excluded.phash", users.items())
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+            self.db.execute("COMMIT")
+
+    def delete_user(self, name: str):
+        self.modify("DELETE FROM users WHERE name = ?", (name, ))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -1,36 +1,252 @@
-import cgi
 import os
+import io
+import math
+import asyncio
+import inspect
+import time
 import json
 import traceback
 import functools
+import queue
+import threading
+import socket
+import stat
+import email.utils
+import collections
+import atexit
 
 from enum import Enum
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 from functools import wraps
 
+# orjson is optional, it is used for serialization if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from . import compression
+from . import metrics
+from . import profiling
+from . import ratelimit
+from .router import router
+from .requesttarget import multi_dict, parse_query, parse_target
+from .bodyparser import body_too_large, length_reader, chunked_reader, upload, parse_header, parse_multipart
+
+# chunk size for files that can not be sent with sendfile
+FILE_CHUNK_SIZE = 256 * 1024
+
 WEB_CONFIG = {
     "key_timeout": 900,
+    "key_reap_interval": 30,
     "web_debug": False,
     "logger_function_debug": print,
     "logger_function_info": print,
-    "send_cors_headers": False
+    "send_cors_headers": False,
+    "async_workers": 32,
+    "keepalive_timeout": 15,
+    "pool_workers": 16,
+    "pool_queue_size": 64,
+    "pool_retry_after": 1,
+    "read_timeout": 30,
+    "keepalive_max_requests": 100,
+    "max_body_size": 1024 * 1024 * 1024,
+    "upload_spool_threshold": 1024 * 1024,
+    "compression": True,
+    "compression_min_size": 1024,
+    "compression_level": 6,
+    "response_cache_entries": 256,
+    "log_level": "info",
+    "log_async": True,
+    "log_queue_size": 10000,
+    "access_log": True,
+    "bcrypt_rounds": 12,
+    "hash_workers": 2,
+    "hash_use_processes": False,
+    "hash_max_pending": 32,
+    "auth_max_attempts_user": 10,
+    "auth_max_attempts_client": 30,
+    "auth_attempt_window": 60,
+    "userfile_check_interval": 5,
+    "sqlite_busy_timeout": 5,
+    "session_flush_interval": 5,
+    "session_flush_batch": 1024,
+    "shutdown_timeout": 10,
+    "prefork_reuseport": False,
+    "prefork_restart_delay": 1,
+    "metrics": True,
+    "slow_request_threshold": None,
+    "profile_sample_rate": 0.0,
+    "profile_routes": [ ],
+    "endpoint_cache_ttl": 5,
+    "endpoint_cache_entries": 1024,
+    "endpoint_cache_bytes": 32 * 1024 * 1024,
+    "endpoint_cache_wait": 30,
+    "stream_heartbeat": 15,
+    "stream_max_buffer": 1024 * 1024,
+    "stream_write_timeout": 30,
+    "auth_cookie": "authkey",
+    "auth_field": "authkey",
+    "auth_cache_ttl": 2,
+    "rate_limit": None,
+    "rate_limit_sweep_interval": 60,
+    "rate_limit_max_buckets": 100000,
+    "max_connections_per_ip": None,
+    "static_cache_bytes": 32 * 1024 * 1024,
+    "static_cache_max_file": 256 * 1024,
+    "static_revalidate": 1,
+    "static_cache_control": "no-cache"
+}
+
+LOG_LEVELS = {
+    "debug": 10,
+    "info": 20,
+    "off": 100
 }
 
+#
+# queue drained by a writer thread, so request
+# threads never block on the logger functions
+#
+# Consecutive access log lines are passed to
+# the info logger as one batch.
+#
+class log_writer():
+
+    def __init__(self):
+        self.queue = None
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def put(self, logger, msg, is_access = False):
+        if(self.queue is None):
+            self.start()
+
+        try:
+            self.queue.put_nowait((logger, msg, is_access))
+        except queue.Full:
+            self.dropped += 1
+
+    #
+    # The writer thread does not survive a fork,
+    # the child starts its own on the first message
+    #
+    def after_fork(self):
+        self.queue = None
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if(self.queue is not None):
+                return
+
+            self.queue = queue.Queue(maxsize=WEB_CONFIG["log_queue_size"])
+            threading.Thread(target=self.run, name="branchweb-log", daemon=True).start()
+            atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            self.write_batch([ self.queue.get() ])
+
+    #
+    # Write everything queued right now, called at exit
+    #
+    def flush(self):
+        if(self.queue is not None):
+            self.write_batch([ ])
+
+    def write_batch(self, batch):
+        try:
+            while len(batch) < 1024:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        if(self.dropped > 0):
+            dropped = self.dropped
+            self.dropped = 0
+            batch.append(("logger_function_info", "[branchweb] Log queue full, dropped {} messages.".format(dropped), False))
+
+        access_lines = [ ]
+        for logger, msg, is_access in batch:
+            if(is_access):
+                access_lines.append(msg)
+                continue
+
+            if(access_lines):
+                self.write("logger_function_info", "\n".join(access_lines))
+                access_lines = [ ]
+
+            self.write(logger, msg)
+
+        if(access_lines):
+            self.write("logger_function_info", "\n".join(access_lines))
+
+    @staticmethod
+    def write(logger, msg):
+        try:
+            WEB_CONFIG[logger](msg)
+        except Exception:
+            pass
+
+log_output = log_writer()
+os.register_at_fork(after_in_child=log_output.after_fork)
+
+def log_enabled(level):
+    return LOG_LEVELS[WEB_CONFIG["log_level"]] <= LOG_LEVELS[level]
+
+def emit(logger_function, msg, is_access = False):
+    if(WEB_CONFIG["log_async"]):
+        log_output.put(logger_function, msg, is_access)
+    else:
+        WEB_CONFIG[logger_function](msg)
+
+#
 # easier access to functions in web_config
-def debug(msg):
-    WEB_CONFIG["logger_function_debug"](msg)
+#
+# Arguments are only formatted into msg (with str.format)
+# if the message passes WEB_CONFIG["log_level"].
+#
+def debug(msg, *args):
+    if(not log_enabled("debug")):
+        return
+
+    emit("logger_function_debug", msg.format(*args) if args else msg)
+
+def info(msg, *args):
+    if(not log_enabled("info")):
+        return
+
+    emit("logger_function_info", msg.format(*args) if args else msg)
+
+#
+# access log line, batched with its neighbours
+#
+def access(msg, *args):
+    if(not WEB_CONFIG["access_log"] or not log_enabled("info")):
+        return
 
-def info(msg):
-    WEB_CONFIG["logger_function_info"](msg)
+    emit("logger_function_info", msg.format(*args) if args else msg, True)
 
 #
 # endpoint class with path and corresponding handler function
 #
 class endpoint():
-    def __init__(self, path, handler):
+    def __init__(self, path, handler, requires_auth = False, rate_limit = None):
         self.path = path
         self.handlerfunc = handler
+        self.requires_auth = requires_auth or getattr(handler, "requires_auth", False)
+        self.rate_limit = rate_limit
+
+#
+# Decorator marking an endpoint handler as only callable
+# with a valid authkey, see web_server.authorize
+#
+def requires_auth(func):
+    func.requires_auth = True
+    return func
 
 #
 # webstatus Enum
@@ -41,6 +257,19 @@ class webstatus(Enum):
     SERV_FAILURE = 400
     AUTH_FAILURE = 500
 
+#
+# Serialize an object to utf-8 encoded json, with orjson if available
+#
+def json_dumps(obj):
+    if(orjson is not None):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers beyond 64 bit, let json have a go
+            pass
+
+    return json.dumps(obj).encode("utf-8")
+
 #
 # webresponse class
 #
@@ -51,274 +280,1348 @@ class webresponse():
         self.response_code = wstatus.value
         self.payload = payload
 
-    # WebResponse as json string
-    def json_str(self):
-        return json.dumps({ 
+    # WebResponse as utf-8 encoded json
+    def json_bytes(self):
+        return json_dumps({ 
             "status": self.status,
             "response_code": self.response_code,
             "payload": self.payload
         })
 
+    # WebResponse as json string
+    def json_str(self):
+        return self.json_bytes().decode("utf-8")
+
+#
+# request_tracker class
+#
+# Requests of this process from their request line to the
+# end of their response, waited for when a server drains
+#
+class request_tracker():
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.total = 0
+
+    def started(self):
+        with self.condition:
+            self.in_flight += 1
+            self.total += 1
+
+    def finished(self):
+        with self.condition:
+            self.in_flight -= 1
+
+            if(self.in_flight == 0):
+                self.condition.notify_all()
+
+    #
+    # Wait until no request is in flight,
+    # returns False if timeout passed first
+    #
+    def wait_idle(self, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.in_flight == 0, timeout)
+
+#
+# route_table class
+#
+# The endpoints of a server, compiled into routers. A published
+# table is never changed, registering endpoints publishes a
+# changed copy, see web_server.change_routes.
+#
+class route_table():
+
+    def __init__(self):
+        self.get_endpoints = [ ]
+        self.post_endpoints = [ ]
+        self.get_router = router()
+        self.post_router = router()
+
+        # (staticfiles.static_mount, endpoint) pairs,
+        # longest prefix first
+        self.static_mounts = [ ]
+
+    def copy(self):
+        table = route_table()
+        table.get_endpoints = list(self.get_endpoints)
+        table.post_endpoints = list(self.post_endpoints)
+        table.get_router = self.get_router.copy()
+        table.post_router = self.post_router.copy()
+        table.static_mounts = list(self.static_mounts)
+        return table
+
+    def add_get(self, ep):
+        self.get_router.add(ep.path, ep)
+        self.get_endpoints.append(ep)
+
+    def add_post(self, ep):
+        self.post_router.add(ep.path, ep)
+        self.post_endpoints.append(ep)
+
+    def add_static(self, mount, ep):
+        if(any(m.prefix == mount.prefix for m, e in self.static_mounts)):
+            raise ValueError("Duplicate static mount: {}".format(ep.path))
+
+        self.static_mounts.append((mount, ep))
+        self.static_mounts.sort(key=lambda pair: len(pair[0].prefix), reverse=True)
+
+    #
+    # Resolve a route of a method to (endpoint, params),
+    # (None, None) if nothing matched
+    #
+    def match(self, method, route):
+        if(method == "POST"):
+            return self.post_router.match(route)
+
+        ep, params = self.get_router.match(route)
+        if(ep is not None or not self.static_mounts):
+            return ep, params
+
+        for mount, ep in self.static_mounts:
+            path = mount.relative(route)
+            if(path is not None):
+                return ep, { "path": path }
+
+        return None, None
+
+#
+# cache of pre-encoded responses for payloads that only change
+# with a version, e.g. a package list and its revision counter
+#
+class response_cache():
+
+    def __init__(self, max_entries = None):
+        if(max_entries is None):
+            max_entries = WEB_CONFIG["response_cache_entries"]
+
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    #
+    # Returns the cached compression.static_response
+    # for key and version or None
+    #
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if(entry is None or entry[0] != version):
+                return None
+
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, static):
+        with self.lock:
+            self.entries[key] = (version, static)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key = None):
+        with self.lock:
+            if(key is None):
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
 
 
 class web_server(BaseHTTPRequestHandler):
+
+    #
+    # Keep connections open between requests, every
+    # response is framed by Content-Length or chunked
+    #
+    protocol_version = "HTTP/1.1"
+
+    # headers and body are written separately, on a kept-alive
+    # connection Nagle would hold back the body for a delayed ACK
+    disable_nagle_algorithm = True
+
+    # requests served on the current connection
+    requests_served = 0
+
+    # pre-encoded responses of send_cached_web_response
+    cached_responses = response_cache()
+
+    # endpoint handling the current request
+    endpoint = None
+
+    # the CORS warning is only logged once
+    cors_warning_sent = False
+
+    # metrics of the current request
+    request_start = None
+    request_written = 0
+    response_webstatus = ""
+    body_reader = None
+
+    # list collecting the send_body calls of the current
+    # request while endpointcache computes a response
+    response_capture = None
+
+    # form fields of the request target
+    form_data = None
+
+    # the authkey validated for the current request and its owner
+    auth_key = None
+    auth_user = None
+
+    # usermanager validating the authkeys of requests
+    usermanager = None
+
+    # requests in flight in this process, and whether
+    # the current one was counted by it
+    active_requests = request_tracker()
+    tracked = False
+
+    # profiling.request_trace of the current request, if tracing
+    trace = None
+
+    # compressor of the current chunked response
+    chunk_compressor = None
+
+    # status and framing of the response being sent
+    response_status = None
+    response_framed = False
+    response_connection_sent = False
+
     #
     # Overwrite BaseHTTPRequestHandler to logger_function
     #
     def log_message(self, format, *args):
-        info("[branchweb] {}".format(*args))
+        if(WEB_CONFIG["access_log"] and log_enabled("info")):
+            access("[branchweb] {} - {}", self.address_string(), format % args)
+
+    #
+    # Apply the idle timeout, unless the server
+    # already configured one on the socket
+    #
+    def setup(self):
+        if(self.request.gettimeout() is None):
+            self.timeout = WEB_CONFIG["keepalive_timeout"]
+
+        super().setup()
+
+        # timeout of the reads within a request
+        self.request_timeout = self.connection.gettimeout()
+
+        if(WEB_CONFIG["metrics"]):
+            self.wfile = metrics.counting_writer(self.wfile)
+
+    #
+    # Serve requests until the connection is closed
+    # or keepalive_max_requests is reached
+    #
+    def handle(self):
+        self.close_connection = True
+
+        while True:
+            self.requests_served += 1
+
+            # an idle connection waits keepalive_timeout for its
+            # next request, parse_request restores request_timeout
+            if(self.requests_served > 1):
+                self.connection.settimeout(WEB_CONFIG["keepalive_timeout"])
+
+            try:
+                self.handle_one_request()
+            finally:
+                self.record_request()
+
+            if(self.close_connection or self.keep_alive_ends()):
+                break
+
+    #
+    # Whether the connection is closed after the current response,
+    # besides close_connection. The pool engine does not hold a
+    # worker with an idle connection while others wait for one.
+    #
+    def keep_alive_ends(self):
+        if(getattr(self.server, "draining", False) or self.requests_served >= WEB_CONFIG["keepalive_max_requests"]):
+            return True
+
+        connections_waiting = getattr(self.server, "connections_waiting", None)
+        return connections_waiting is not None and connections_waiting()
+
+    #
+    # Start the metrics of a request once its request line arrived,
+    # so time spent waiting on an idle connection is not counted
+    #
+    def parse_request(self):
+        web_server.active_requests.started()
+        self.tracked = True
+
+        if(self.requests_served > 1 and self.request is not None):
+            self.connection.settimeout(self.request_timeout)
+
+        self.endpoint = None
+        self.form_data = None
+        self.auth_key = None
+        self.auth_user = None
+        self.body_reader = None
+        self.response_status = None
+        self.response_webstatus = ""
+
+        if(WEB_CONFIG["metrics"]):
+            self.request_start = time.perf_counter()
+            self.request_written = getattr(self.wfile, "written", 0)
+            metrics.registry.request_started()
+
+        if(not profiling.tracing_enabled()):
+            self.trace = None
+            return super().parse_request()
+
+        self.trace = profiling.request_trace()
+        parsed = super().parse_request()
+        self.trace.add("parse", time.perf_counter() - self.trace.start)
+        return parsed
+
+    #
+    # Record the metrics of the request that just ended
+    #
+    def record_request(self):
+        if(self.tracked):
+            self.tracked = False
+            web_server.active_requests.finished()
+
+        trace = self.trace
+        if(self.request_start is None and trace is None):
+            return
+
+        route = self.endpoint.path if self.endpoint is not None else ""
+
+        if(self.request_start is not None):
+            metrics.registry.request_finished(self.command or "", route, self.response_status or 0, self.response_webstatus,
+                                              time.perf_counter() - self.request_start, self.request_bytes_in(),
+                                              getattr(self.wfile, "written", 0) - self.request_written)
+            self.request_start = None
+
+        if(trace is not None):
+            self.trace = None
+            profiling.request_finished(trace, self.command or "", route, time.perf_counter() - trace.start)
+
+    def request_bytes_in(self):
+        if(self.body_reader is None):
+            return 0
+
+        return self.body_reader.consumed()
 
     # List of currently active HTTPSessions
     active_sessions = [ ]
     
     #
-    # Static Endpoint register for all
-    # HTTPHandler instances
+    # The route_table requests are resolved against, shared by
+    # all HTTPHandler instances. Each request reads it once, so
+    # a concurrent registration never changes it mid-request.
+    #
+    routes = route_table()
+    routes_lock = threading.RLock()
+
+    # the table collecting the registrations of reload_routes
+    staged_routes = None
+
+    #
+    # Endpoint lists and routers of the current table,
+    # kept for existing callers, treat them as read only
     #
-    get_endpoints = [ ]
-    post_endpoints = [ ]
+    get_endpoints = routes.get_endpoints
+    post_endpoints = routes.post_endpoints
+    get_router = routes.get_router
+    post_router = routes.post_router
 
     #
     # Registers a GET function to the webserver
     # Takes a dict:
     # path -> handler_func
     #
+    # Paths may contain {param} segments, the captured
+    # values are passed to the handler as keyword arguments.
+    # Raises ValueError on duplicate routes.
+    #
+    # cache_ttl: cache the responses of these handlers for
+    #            cache_ttl seconds, see endpointcache.cached
+    # requires_auth: reject requests without a valid authkey
+    #                before the handlers run, see authorize
+    # rate_limit: a (requests per second, burst) budget of every
+    #             client for each of these routes, replacing the
+    #             WEB_CONFIG["rate_limit"] budget shared by all routes
+    #
     @staticmethod
-    def register_get_endpoints(get_dict):
+    def register_get_endpoints(get_dict, cache_ttl = None, requires_auth = False, rate_limit = None):
+        if(cache_ttl is not None):
+            from .endpointcache import cached
+            get_dict = { path: cached(cache_ttl)(handler) for path, handler in get_dict.items() }
+
+        def change(table):
+            for path in get_dict:
+                table.add_get(endpoint(path, get_dict[path], requires_auth, rate_limit))
+
+        web_server.change_routes(change)
+
         for path in get_dict:
             info("Registered GET endpoint for path: {}".format(path))
-            web_server.get_endpoints.append(endpoint(path, get_dict[path]))
+
     #
     # Registers a POST function to the webserver
     # Takes a dict:
     # path -> handler_func
     #
+    # Paths may contain {param} segments, the captured
+    # values are passed to the handler as keyword arguments.
+    # Raises ValueError on duplicate routes.
+    #
+    # requires_auth: reject requests without a valid authkey
+    #                before their body is read, see authorize
+    # rate_limit: a (requests per second, burst) budget per
+    #             client, see register_get_endpoints
+    #
     @staticmethod
-    def register_post_endpoints(post_dict):
+    def register_post_endpoints(post_dict, requires_auth = False, rate_limit = None):
+        def change(table):
+            for path in post_dict:
+                table.add_post(endpoint(path, post_dict[path], requires_auth, rate_limit))
+
+        web_server.change_routes(change)
+
         for path in post_dict:
             info("Registered POST endpoint for path: {}".format(path))
-            web_server.post_endpoints.append(endpoint(path, post_dict[path]))
 
     #
-    # Parse a HTTP-get form
+    # Serve the files below directory for GET requests of
+    # prefix, e.g. ("app", "/srv/frontend") serves /app/,
+    # /app/main.js, .. Registered endpoints take precedence.
+    #
+    # Small files are kept in memory, precompressed .br / .gz
+    # siblings are sent to clients that accept them and large
+    # files are sent with sendfile, see staticfiles.
+    #
+    # cache_control: the Cache-Control header of the files,
+    #                WEB_CONFIG["static_cache_control"] by default
+    # requires_auth, rate_limit: see register_get_endpoints
     #
     @staticmethod
-    def parse_form_data(str_form):
-        form_val = str_form.split("&")
+    def register_static_mount(prefix, directory, cache_control = None, index = "index.html", requires_auth = False, rate_limit = None):
+        from .staticfiles import static_mount
 
-        _dict = { }
+        mount = static_mount(prefix, directory, cache_control, index)
+        ep = endpoint("/" + mount.prefix, mount.handle, requires_auth, rate_limit)
 
-        for dataset in form_val:
-            split = dataset.split("=")
-            if(not "=" in dataset):
-                continue
+        web_server.change_routes(lambda table: table.add_static(mount, ep))
+        info("Registered static mount for path: {} -> {}".format(ep.path, mount.directory))
+
+    #
+    # Apply change(table) to a copy of the current route table
+    # and publish the copy, nothing is published if change
+    # raises. During reload_routes the staged table is changed.
+    #
+    @staticmethod
+    def change_routes(change):
+        with web_server.routes_lock:
+            if(web_server.staged_routes is not None):
+                change(web_server.staged_routes)
+                return
+
+            table = web_server.routes.copy()
+            change(table)
+            web_server.publish_routes(table)
+
+    @staticmethod
+    def publish_routes(table):
+        with web_server.routes_lock:
+            web_server.get_endpoints = table.get_endpoints
+            web_server.post_endpoints = table.post_endpoints
+            web_server.get_router = table.get_router
+            web_server.post_router = table.post_router
+            web_server.routes = table
+
+    #
+    # Replace all endpoints of a running server at once
+    #
+    # register() makes the register_* calls of the new set of
+    # endpoints, including metrics and profiling endpoints that
+    # should stay. Requests see the old table until the new one
+    # is complete, if register() raises the old one stays.
+    #
+    @staticmethod
+    def reload_routes(register):
+        with web_server.routes_lock:
+            web_server.staged_routes = route_table()
+
+            try:
+                register()
+                table = web_server.staged_routes
+            finally:
+                web_server.staged_routes = None
 
-            key = split[0]
-            val = split[1]
-            _dict[key] = val
+            web_server.publish_routes(table)
 
-        return _dict
+        info("Reloaded routes: {} GET, {} POST endpoints, {} static mounts.", len(table.get_endpoints), len(table.post_endpoints), len(table.static_mounts))
+
+    #
+    # Parse a HTTP-get form
+    # Returns a requesttarget.multi_dict of the percent decoded fields
+    #
+    @staticmethod
+    def parse_form_data(str_form):
+        return multi_dict(parse_query(str_form))
 
     #
-    # fetches the real path from 
+    # fetches the real path and the form fields of the request target,
+    # None if it can not be parsed, see requesttarget.parse_target
     #
     def fetch_real_path(self):
-        # strip /
-        self.path = self.path[1:len(self.path)]        
-        form_dict = None
-
-        if(self.path):
-            # if char 0 is ? we have form data to parse
-            if(self.path[0] == '?' and len(self.path) > 1):
-                form_dict = web_server.parse_form_data(self.path[1:len(self.path)])
-                if(not form_dict is None):
-                    lk = list(form_dict.keys())
-                    if(len(lk) == 0):
-                        return None
-                    else:
-                        real_path = lk[0]
-            else:
-                real_path = self.path
-        else:
-            real_path = self.path
-         
-        return real_path, form_dict
+        parsed = parse_target(self.path)
+        if(parsed is None):
+            return None
 
+        real_path, pairs = parsed
+        if(pairs is None):
+            return real_path, None
+
+        return real_path, multi_dict(pairs)
 
     #
     # End HTTPHeaders
     #
     def end_headers(self):
+        # interim responses (100 Continue) have no body and
+        # say nothing about the connection
+        if(self.response_status is not None and self.response_status < 200):
+            return super(web_server, self).end_headers()
+
         if(WEB_CONFIG["send_cors_headers"]):
-            info("Sending Wildcard CORS headers.")
-            info("This should only be used for debugging purposes.")
+            if(not web_server.cors_warning_sent):
+                web_server.cors_warning_sent = True
+                info("Sending Wildcard CORS headers.")
+                info("This should only be used for debugging purposes.")
 
             self.send_header('Access-Control-Allow-Origin', "*")
             self.send_header('Access-Control-Allow-Methods', "*")
             self.send_header('Access-Control-Allow-Headers', "*")
+
+        # the client can only find the end of an unframed body by EOF
+        unframed = not self.response_framed and self.response_status not in (204, 304)
+
+        if(not self.response_connection_sent):
+            if(self.close_connection or unframed or self.keep_alive_ends()):
+                self.send_header("Connection", "close")
+            elif(self.request_version == "HTTP/1.0"):
+                self.send_header("Connection", "keep-alive")
+
         return super(web_server, self).end_headers()
 
+    #
+    # Track the framing of the current response
+    #
+    def send_response_only(self, code, message=None):
+        self.response_status = code
+        self.response_framed = False
+        self.response_connection_sent = False
+        super().send_response_only(code, message)
+
+    def send_header(self, keyword, value):
+        lkeyword = keyword.lower()
+        if(lkeyword == "content-length" or (lkeyword == "transfer-encoding" and value == "chunked")):
+            self.response_framed = True
+        elif(lkeyword == "connection"):
+            self.response_connection_sent = True
+
+        super().send_header(keyword, value)
+
+    #
+    # Send raw bytes to the current HTTPHandler
+    #
+    def write_answer(self, data):
+        started = time.perf_counter() if self.trace is not None else None
+
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            debug("Client closed socket before request could be completed.")
+
+        if(started is not None):
+            self.trace.add("write", time.perf_counter() - started)
+
     #
     # Encode a string as a byte-list and send it
     # to the current HTTPHandler
     #
     def write_answer_encoded(self, message):
-        debug("Sending message: {}".format(message))
-        try:
-            self.wfile.write(bytes(message, "utf-8"))
-        except BrokenPipeError:
-            debug("Client closed socket before request could be completed.")
+        debug("Sending message: {}", message)
+        self.write_answer(bytes(message, "utf-8"))
 
     #
-    # send web response
+    # Pick a Content-Encoding for a body of body_len bytes
+    # (None if unknown), returns None for identity
     #
-    def send_web_response(self, status, payload):
-        wr = webresponse(status, payload).json_str()
-        self.send_response(200)
+    def negotiate_encoding(self, body_len = None):
+        if(not WEB_CONFIG["compression"]):
+            return None
 
-        self.send_header("Content-type", "application/json")
-        self.send_header("Content-Length", len(bytes(wr, "utf-8")))
-        self.end_headers()
-        self.write_answer_encoded(wr)
+        if(body_len is not None and body_len < WEB_CONFIG["compression_min_size"]):
+            return None
+
+        accept_encoding = self.headers["Accept-Encoding"]
+        if(accept_encoding is None):
+            return None
+
+        return compression.negotiate(accept_encoding)
 
     #
-    # send a raw string response without wrapping it in a webresponse object 
+    # Start a chunked response of unknown length,
+    # the body is sent with write_chunk() and end_chunked()
     #
-    def send_str_raw(self, http_status, msg):
+    def begin_chunked(self, http_status, content_type):
+        encoding = self.negotiate_encoding()
+
         self.send_response(http_status)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-        self.write_answer_encoded(msg)
-    
-    #
-    # send a file response to the current http handler
-    # 
-    def send_file(self, file, file_len, file_name):
-        try:
-            self.send_response(200)
-            self.send_header("Content-type", "application/octet-stream")
-            self.send_header("Content-Length", file_len)
-            self.send_header("Content-Disposition", "filename=\"" + file_name + "\"")
-            self.end_headers()
+        self.send_header("Content-type", content_type)
 
-            while True:
-                bytes_read = file.read(4096)
+        if(WEB_CONFIG["compression"]):
+            self.send_header("Vary", "Accept-Encoding")
 
-                if(not bytes_read):
-                    break
+        self.chunk_compressor = None
+        if(encoding is not None):
+            self.send_header("Content-Encoding", encoding)
+            self.chunk_compressor = compression.compressor(encoding, WEB_CONFIG["compression_level"])
 
-                self.wfile.write(bytes_read)
- 
-        except ConnectionResetError:
-            info("Client disconnected before file download completed.")
+        # HTTP/1.0 clients do not understand chunked, end the body by EOF
+        if(self.request_version == "HTTP/1.1"):
+            self.send_header("Transfer-Encoding", "chunked")
+            self.chunked = True
+        else:
+            self.chunked = False
 
+        self.end_headers()
 
     #
-    # send generic malformed request response
-    #
-    def generic_malformed_request(self):
-        self.send_web_response(webstatus.SERV_FAILURE, "Bad Request.")
-
-    # 
-    # handle the get request
+    # Send a piece of a chunked response, with flush set
+    # a compressed stream is flushed to the client
     #
-    def do_GET(self):
-        info("Handling API-get request from {}..".format(self.client_address))
+    def write_chunk(self, data, flush = False):
+        if(self.chunk_compressor is not None):
+            data = self.chunk_compressor.compress(data, flush)
 
-        real_path, form_dict = self.fetch_real_path()
-        if(real_path is None):
-            self.send_web_response(webstatus.SERV_FAILURE, "Bad request.")
+        if(not data):
             return
-        
-        no_match = True
-        for endpoint in web_server.get_endpoints:
-            if(endpoint.path == real_path):
-                # handle
-                try:
-                    endpoint.handlerfunc(self, form_dict)
-                    no_match = False
-                except Exception as ex:
-                    info("Exception raised in endpoint function for {}: {}".format(real_path, ex))
-                    info("Errors from the webserver are not fatal to the masterserver.")
-                    info("Connection reset.")
-                    
-                    if(WEB_CONFIG["web_debug"]):
-                        debug("Stacktrace:")
-                        traceback.print_exc()
-
-                    self.send_web_response(webstatus.SERV_FAILURE, "Internal server error.")
-                    return
-
-        if(no_match):
-            self.send_web_response(webstatus.SERV_FAILURE, "Bad request.")
 
-        return
+        if(self.chunked):
+            self.write_answer(b"%x\r\n" % len(data) + data + b"\r\n")
+        else:
+            self.write_answer(data)
+
+    def end_chunked(self):
+        if(self.chunk_compressor is not None):
+            data = self.chunk_compressor.finish()
+            self.chunk_compressor = None
+            self.write_chunk(data)
+
+        if(self.chunked):
+            self.write_answer(b"0\r\n\r\n")
 
     #
-    # handle a post request
+    # Send a complete body, compressed if the client accepts it
+    # static: an optional compression.static_response holding
+    #         the body and its cached compressed variants
     #
-    def do_POST(self):
-        info("Handling API-post request from {}..".format(self.client_address))
+    def send_body(self, http_status, content_type, data, static = None):
+        if(self.response_capture is not None):
+            self.response_capture.append((http_status, content_type, data, static))
 
-        real_path, form_dict = self.fetch_real_path()
-        if(real_path is None):
-            self.send_web_response(webstatus.SERV_FAILURE, "Bad request.")
+        encoding = self.negotiate_encoding(len(data))
+
+        if(encoding is not None):
+            if(static is not None):
+                data = static.compressed(encoding, WEB_CONFIG["compression_level"])
+            else:
+                data = compression.compress(data, encoding, WEB_CONFIG["compression_level"])
+
+        self.send_response(http_status)
+        self.send_header("Content-type", content_type)
+
+        if(WEB_CONFIG["compression"]):
+            self.send_header("Vary", "Accept-Encoding")
+
+        if(encoding is not None):
+            self.send_header("Content-Encoding", encoding)
+
+        self.send_header("Content-Length", len(data))
+        self.end_headers()
+        self.write_answer(data)
+
+    #
+    # send a compression.static_response
+    #
+    def send_static(self, static, http_status = 200):
+        self.send_body(http_status, static.content_type, static.data, static)
+
+    #
+    # send web response
+    #
+    def send_web_response(self, status, payload):
+        self.response_webstatus = status.name
+
+        if(self.trace is None):
+            wr = webresponse(status, payload).json_bytes()
+        else:
+            started = time.perf_counter()
+            wr = webresponse(status, payload).json_bytes()
+            self.trace.add("serialize", time.perf_counter() - started)
+        if(log_enabled("debug")):
+            debug("Sending message: {}", wr.decode("utf-8"))
+        self.send_body(200, "application/json", wr)
+
+    #
+    # send a web response for an immutable payload from
+    # pre-encoded bytes, re-encoded only when version changes
+    #
+    # payload may be a callable, it is only called on a miss
+    # key defaults to the handler of the current endpoint
+    #
+    def send_cached_web_response(self, status, payload, version, key = None):
+        if(key is None):
+            key = self.endpoint.handlerfunc
+
+        key = (key, status)
+        self.response_webstatus = status.name
+
+        static = web_server.cached_responses.get(key, version)
+        if(static is None):
+            if(callable(payload)):
+                payload = payload()
+
+            static = compression.static_response(webresponse(status, payload).json_bytes(), "application/json")
+            web_server.cached_responses.put(key, version, static)
+
+        self.send_static(static)
+
+    #
+    # send a raw string response without wrapping it in a webresponse object 
+    #
+    def send_str_raw(self, http_status, msg):
+        self.send_body(http_status, "text/html", bytes(msg, "utf-8"))
+
+    #
+    # Turn the current request into a streaming response
+    #
+    # The headers are sent and the connection is handed to the
+    # stream hub, which pushes the events published to channels
+    # until the client disconnects or the returned
+    # streaming.stream_subscriber is closed. The handler returns
+    # right away, no thread is held per stream.
+    #
+    # format: "sse" for text/event-stream or "jsonl" for
+    #         newline delimited json, chunked on HTTP/1.1
+    #
+    def open_stream(self, channels, format = "sse", hub = None):
+        from . import streaming
+
+        if(hub is None):
+            hub = streaming.hub
+
+        if(format not in streaming.STREAM_FORMATS):
+            raise ValueError("Unknown stream format: {}".format(format))
+
+        if(isinstance(channels, str)):
+            channels = [ channels ]
+
+        chunked = self.request_version != "HTTP/1.0"
+        self.close_connection = True
+
+        # the hub writes the headers along with the first events
+        wfile = self.wfile
+        self.wfile = io.BytesIO()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", streaming.STREAM_FORMATS[format])
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("X-Accel-Buffering", "no")
+
+            if(chunked):
+                self.send_header("Transfer-Encoding", "chunked")
+
+            self.end_headers()
+            head = self.wfile.getvalue()
+        finally:
+            self.wfile = wfile
+
+        if(hasattr(wfile, "written")):
+            wfile.written += len(head)
+
+        sub = hub.subscribe(channels, format, chunked, head, self.server)
+        self.hand_over(sub)
+        return sub
+
+    #
+    # Give the connection of the current request to the stream
+    # hub, the server only closes its own reference to it
+    #
+    def hand_over(self, sub):
+        sub.hub.attach(sub, socket.socket(fileno=self.connection.detach()))
+    
+    #
+    # send a file response to the current http handler
+    #
+    # Real files are validated with ETag / Last-Modified, answer
+    # single byte Range requests with 206 and are sent with sendfile.
+    # 
+    def send_file(self, file, file_len, file_name):
+        etag = None
+        mtime = None
+
+        try:
+            fst = os.fstat(file.fileno())
+            if(stat.S_ISREG(fst.st_mode)):
+                etag = "\"{:x}-{:x}\"".format(fst.st_mtime_ns, fst.st_size)
+                mtime = int(fst.st_mtime)
+        except (AttributeError, OSError, ValueError):
+            pass
+
+        if(self.is_not_modified(etag, mtime)):
+            self.send_response(304)
+            if(etag is not None):
+                self.send_header("ETag", etag)
+            self.end_headers()
             return
-        
+
+        start = 0
+        end = file_len - 1
+
+        byte_range = None
+        if(self.range_applies(etag, mtime) and (etag is not None or web_server.is_seekable(file))):
+            byte_range = web_server.parse_range(self.headers["Range"], file_len)
+
+            if(byte_range == ()):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(file_len))
+                self.send_header("Content-Length", 0)
+                self.end_headers()
+                return
+
+        try:
+            if(byte_range is None):
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, file_len))
+
+            self.send_header("Content-type", "application/octet-stream")
+            self.send_header("Content-Length", end - start + 1)
+            self.send_header("Content-Disposition", "filename=\"" + file_name + "\"")
+            self.send_header("Accept-Ranges", "bytes")
+
+            if(etag is not None):
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", email.utils.formatdate(mtime, usegmt=True))
+
+            self.end_headers()
+            self.write_file_range(file, start, end - start + 1, etag is not None)
+ 
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            info("Client disconnected before file download completed.")
+
+    #
+    # write count bytes of file starting at offset
+    #
+    def write_file_range(self, file, offset, count, regular_file):
+        if(count <= 0):
+            return
+
+        if(self.trace is None):
+            self.copy_file_range(file, offset, count, regular_file)
+            return
+
+        started = time.perf_counter()
+        try:
+            self.copy_file_range(file, offset, count, regular_file)
+        finally:
+            self.trace.add("write", time.perf_counter() - started)
+
+    def copy_file_range(self, file, offset, count, regular_file):
+        # zero-copy path, only available on a real socket
+        if(regular_file and isinstance(self.request, socket.socket)):
+            self.wfile.flush()
+            sent = self.request.sendfile(file, offset, count)
+
+            if(isinstance(self.wfile, metrics.counting_writer)):
+                self.wfile.written += sent
+
+            return
+
+        if(offset > 0):
+            file.seek(offset)
+
+        remaining = count
+        while remaining > 0:
+            bytes_read = file.read(min(FILE_CHUNK_SIZE, remaining))
+
+            if(not bytes_read):
+                break
+
+            self.wfile.write(bytes_read)
+            remaining -= len(bytes_read)
+
+    #
+    # Check the If-None-Match / If-Modified-Since headers
+    #
+    def is_not_modified(self, etag, mtime):
+        if(etag is None):
+            return False
+
+        if_none_match = self.headers["If-None-Match"]
+        if(if_none_match is not None):
+            return if_none_match.strip() == "*" or etag in [ e.strip() for e in if_none_match.split(",") ]
+
+        return web_server.not_modified_since(self.headers["If-Modified-Since"], mtime)
+
+    #
+    # Check if a Range header should be honored, If-Range
+    # has to match the current validator
+    #
+    def range_applies(self, etag, mtime):
+        if(self.headers["Range"] is None):
+            return False
+
+        if_range = self.headers["If-Range"]
+        if(if_range is None):
+            return True
+
+        if_range = if_range.strip()
+        if(if_range.startswith("\"") or if_range.startswith("W/")):
+            return etag is not None and if_range == etag
+
+        return web_server.not_modified_since(if_range, mtime)
+
+    @staticmethod
+    def not_modified_since(http_date, mtime):
+        if(http_date is None or mtime is None):
+            return False
+
+        try:
+            since = email.utils.parsedate_to_datetime(http_date)
+        except (TypeError, ValueError):
+            return False
+
+        return since is not None and mtime <= since.timestamp()
+
+    @staticmethod
+    def is_seekable(file):
+        try:
+            return file.seekable()
+        except AttributeError:
+            return False
+
+    #
+    # Parse a single "bytes=" range
+    # Returns (start, end), None if the header should be
+    # ignored or () if the range is not satisfiable
+    #
+    @staticmethod
+    def parse_range(range_header, file_len):
+        unit, _, spec = range_header.partition("=")
+        if(unit.strip() != "bytes" or "," in spec):
+            return None
+
+        first, sep, last = spec.strip().partition("-")
+        if(not sep):
+            return None
+
+        try:
+            if(first == ""):
+                # suffix range: the last n bytes
+                suffix = int(last)
+                if(suffix <= 0):
+                    return ()
+
+                return max(0, file_len - suffix), file_len - 1
+
+            start = int(first)
+            end = int(last) if last != "" else file_len - 1
+        except ValueError:
+            return None
+
+        if(start >= file_len):
+            return ()
+
+        if(start > end):
+            return None
+
+        return start, min(end, file_len - 1)
+
+    #
+    # send generic malformed request response
+    #
+    def generic_malformed_request(self):
+        self.send_web_response(webstatus.SERV_FAILURE, "Bad Request.")
+
+    #
+    # resolve the requested path against the routes of a method,
+    # sends an error response and returns None on failure
+    #
+    def resolve_endpoint(self, method):
+        fetched = self.fetch_real_path()
+        if(fetched is None or fetched[0] is None):
+            self.reject_unread_body()
+            return None
+
+        real_path, form_dict = fetched
+
+        ep, params = web_server.routes.match(method, real_path)
+        if(ep is None):
+            self.reject_unread_body()
+            return None
+
+        self.endpoint = ep
+        self.form_data = form_dict
+
+        limited = ep.rate_limit is not None or WEB_CONFIG["rate_limit"] is not None
+
+        # the address pays until the request is authenticated,
+        # so requests with invalid keys are limited as well
+        if(limited and not self.check_rate_limit()):
+            return None
+
+        if(ep.requires_auth):
+            address_bucket = self.rate_limit_bucket()[0]
+
+            if(not self.authorize()):
+                return None
+
+            if(limited):
+                ratelimit.limiter.release(address_bucket)
+                if(not self.check_rate_limit()):
+                    return None
+
+        return real_path, ep, form_dict, params
+
+    #
+    # Take a token from the budget of the client for the current
+    # endpoint, answers with 429 before the body is read if the
+    # client used it up. Clients are authenticated users, the
+    # address of the connection otherwise.
+    #
+    def check_rate_limit(self):
+        bucket, budget = self.rate_limit_bucket()
+
+        retry_after = ratelimit.limiter.acquire(bucket, budget[0], budget[1])
+        if(retry_after == 0):
+            return True
+
+        self.close_if_body_unread()
+        self.response_webstatus = webstatus.SERV_FAILURE.name
+
+        body = webresponse(webstatus.SERV_FAILURE, "Too many requests.").json_bytes()
+        self.send_response(429)
+        self.send_header("Retry-After", max(1, math.ceil(retry_after)))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.write_answer(body)
+        return False
+
+    #
+    # The bucket of the client for the current endpoint
+    # and its (rate, burst) budget
+    #
+    def rate_limit_bucket(self):
+        ep = self.endpoint
+        budget = ep.rate_limit
+        route = ep.path
+
+        if(budget is None):
+            budget = WEB_CONFIG["rate_limit"]
+            route = ""
+
+        if(self.auth_user is not None):
+            return (route, "user", self.auth_user.name), budget
+
+        return (route, "address", self.client_address[0]), budget
+
+    #
+    # Use the supplied usermanager to validate the authkeys
+    # of requests, required by requires_auth endpoints
+    #
+    @staticmethod
+    def set_usermanager(manager):
+        web_server.usermanager = manager
+
+    #
+    # The authkey sent with the request, from the Authorization header
+    # ("Bearer <key>"), the WEB_CONFIG["auth_cookie"] cookie or the
+    # WEB_CONFIG["auth_field"] form field, in that order
+    #
+    def request_key(self, post_data = None):
+        header = self.headers.get("Authorization")
+        if(header):
+            scheme, sep, value = header.strip().partition(" ")
+            if(sep and scheme.lower() == "bearer"):
+                return value.strip()
+
+        cookies = self.headers.get("Cookie")
+        if(cookies):
+            name = WEB_CONFIG["auth_cookie"]
+            for cookie in cookies.split(";"):
+                key, sep, value = cookie.strip().partition("=")
+                if(key == name):
+                    return value.strip("\"")
+
+        field = WEB_CONFIG["auth_field"]
+        for fields in (self.form_data, post_data):
+            if(isinstance(fields, dict) and fields.get(field)):
+                return fields[field]
+
+        return None
+
+    #
+    # The user owning the authkey of the request, None if it has
+    # none or it is not valid. The key is validated and refreshed
+    # once per request, later calls return the same user.
+    #
+    # post_data: a parsed body to take the key from, if the
+    #            request target and headers do not carry one
+    #
+    def authenticated_user(self, post_data = None):
+        key_id = self.request_key(post_data)
+        if(key_id is None or web_server.usermanager is None):
+            return None
+
+        if(key_id != self.auth_key):
+            self.auth_user = web_server.usermanager.get_key_owner(key_id)
+            self.auth_key = key_id
+
+        return self.auth_user
+
+    #
+    # Check the authkey of a requires_auth endpoint before
+    # its body is read, answers with AUTH_FAILURE if invalid
+    #
+    def authorize(self):
+        if(self.trace is None):
+            owner = self.authenticated_user()
+        else:
+            started = time.perf_counter()
+            owner = self.authenticated_user()
+            self.trace.add("session", time.perf_counter() - started)
+
+        if(owner is not None):
+            return True
+
+        if(web_server.usermanager is None):
+            info("No usermanager set, rejecting request for {}.", self.endpoint.path)
+
+        self.close_if_body_unread()
+        self.send_web_response(webstatus.AUTH_FAILURE, "Authentication required.")
+        return False
+
+    #
+    # send a bad request response, closing the connection
+    # if a request body was left unread
+    #
+    def reject_unread_body(self):
+        self.close_if_body_unread()
+        self.send_web_response(webstatus.SERV_FAILURE, "Bad request.")
+
+    #
+    # a request body that is never read leaves the
+    # connection unusable for further requests
+    #
+    def close_if_body_unread(self):
+        if(self.headers["Content-Length"] is not None or self.headers["Transfer-Encoding"] is not None):
+            self.close_connection = True
+
+    #
+    # read and parse the post body, sends an error
+    # response and returns None on failure
+    #
+    def read_post_data(self):
+        if(self.trace is None):
+            return self.parse_post_data()
+
+        started = time.perf_counter()
+        try:
+            return self.parse_post_data()
+        finally:
+            self.trace.add("body", time.perf_counter() - started)
+
+    def parse_post_data(self):
+        try:
+            reader = self.open_body()
+        except body_too_large:
+            self.close_connection = True
+            self.send_web_response(webstatus.SERV_FAILURE, "Request body too large.")
+            return None
+        except ValueError:
+            self.close_connection = True
+            self.send_web_response(webstatus.SERV_FAILURE, "Bad request.")
+            return None
+
         # no post body, bad request.
-        if(self.headers["Content-Length"] is None):
+        if(reader is None):
             self.send_web_response(webstatus.SERV_FAILURE, "Bad request.")
-            return
-        
-        form = None
+            return None
 
         post_data = {}
 
         try:
+            content_type, params = parse_header("Content-Type", self.headers["Content-Type"] or "")
 
             # If we received JSON data, handle it seperately
-            if(self.headers["Content-Type"] == "application/json"):
-                post_data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if(content_type == "application/json"):
+                post_data = json.loads(reader.read())
+
+            # multipart data is streamed, uploads are spooled to disk
+            elif(content_type == "multipart/form-data"):
+                post_data = parse_multipart(reader, params["boundary"].encode("utf-8"), WEB_CONFIG["upload_spool_threshold"])
 
-            # Else just parse the multipart data
+            # Else just parse the url encoded data
             else:
-                form = cgi.FieldStorage(
-                    fp=self.rfile,
-                    headers=self.headers,
-                    environ={'REQUEST_METHOD':'POST',
-                            'CONTENT_TYPE':self.headers['Content-Type']
-                    }
-                )
-
-                # And convert it to a dict
-                for f_obj in form.list:
-                    post_data[f_obj.name] = f_obj.value
+                post_data = web_server.parse_form_data(reader.read().decode("utf-8"))
+
+            # skip an epilogue, so the connection can be reused
+            reader.discard()
+
+        except body_too_large:
+            self.close_connection = True
+            self.send_web_response(webstatus.SERV_FAILURE, "Request body too large.")
+            return None
 
         except Exception:
+            self.close_connection = True
             self.send_web_response(webstatus.SERV_FAILURE, "Could not parse post data!")
-            return 
-       
-        no_match = True
-        for endpoint in web_server.post_endpoints:
-            if(endpoint.path == real_path):
-                # handle
-                try:
-                    endpoint.handlerfunc(self, form_dict, post_data)
-                    no_match = False
-                except Exception as ex:
-                    info("Exception raised in endpoint function for {}: {}".format(real_path, ex))
-                    info("Errors from the webserver are not fatal to the masterserver.")
-                    info("Connection reset.")
-                    
-                    if(WEB_CONFIG["web_debug"]):
-                        debug("Stacktrace:")
-                        traceback.print_exc()
-
-                    self.send_web_response(webstatus.SERV_FAILURE, "Internal server error.")
-                    return
-
-        if(no_match):
-            self.send_web_response(webstatus.SERV_FAILURE, "Bad request.")
+            return None
+
+        return post_data
+
+    #
+    # Returns a reader for the request body, None if the request
+    # has none. Raises body_too_large before reading anything
+    # if the announced length exceeds max_body_size.
+    #
+    def open_body(self):
+        transfer_encoding = self.headers["Transfer-Encoding"]
+        if(transfer_encoding is not None and transfer_encoding.lower() == "chunked"):
+            self.body_reader = chunked_reader(self.rfile, WEB_CONFIG["max_body_size"])
+            return self.body_reader
+
+        length = self.headers["Content-Length"]
+        if(length is None):
+            return None
+
+        length = int(length)
+        if(length < 0):
+            raise ValueError("Negative Content-Length")
+
+        if(length > WEB_CONFIG["max_body_size"]):
+            raise body_too_large()
+
+        self.body_reader = length_reader(self.rfile, length)
+        return self.body_reader
+
+    #
+    # close the spooled uploads of a request
+    #
+    @staticmethod
+    def close_uploads(post_data):
+        if(not isinstance(post_data, dict)):
+            return
+
+        for value in post_data.values():
+            if(isinstance(value, upload)):
+                value.close()
+
+    #
+    # call an endpoint handler, errors are reported
+    # to the client and never propagate
+    #
+    def call_endpoint(self, real_path, ep, args, params):
+        self.endpoint = ep
+
+        trace = self.trace
+        if(trace is not None):
+            profiling.handler_started(trace)
+            started = time.perf_counter()
+
+        try:
+            if((WEB_CONFIG["profile_sample_rate"] > 0 or WEB_CONFIG["profile_routes"]) and profiling.should_profile(ep.path)):
+                result = profiling.profile_call(ep.handlerfunc, self, *args, **params)
+            else:
+                result = ep.handlerfunc(self, *args, **params)
+
+            # async def handlers outside of the asyncio engine
+            # run on an event loop of their own
+            if(inspect.iscoroutine(result)):
+                asyncio.run(result)
+        except Exception as ex:
+            self.endpoint_failed(real_path, ex)
+        finally:
+            if(trace is not None):
+                trace.add("handler", time.perf_counter() - started)
+                profiling.handler_finished(trace)
+
+    #
+    # flush the response of an async def handler, the
+    # asyncio engine waits until the client took it
+    #
+    async def drain(self):
+        self.wfile.flush()
+
+    #
+    # report an exception raised by an endpoint handler
+    #
+    def endpoint_failed(self, real_path, ex):
+        info("Exception raised in endpoint function for {}: {}".format(real_path, ex))
+        info("Errors from the webserver are not fatal to the masterserver.")
+        info("Connection reset.")
+        
+        if(WEB_CONFIG["web_debug"]):
+            debug("Stacktrace:")
+            traceback.print_exception(ex)
+
+        self.send_web_response(webstatus.SERV_FAILURE, "Internal server error.")
+
+    # 
+    # handle the get request
+    #
+    def do_GET(self):
+        access("Handling API-get request from {}..", self.client_address)
+
+        resolved = self.resolve_endpoint("GET")
+        if(resolved is None):
+            return
+
+        real_path, ep, form_dict, params = resolved
+        self.call_endpoint(real_path, ep, (form_dict, ), params)
+        return
+
+    #
+    # handle a post request
+    #
+    def do_POST(self):
+        access("Handling API-post request from {}..", self.client_address)
+
+        resolved = self.resolve_endpoint("POST")
+        if(resolved is None):
+            return
+
+        real_path, ep, form_dict, params = resolved
+
+        post_data = self.read_post_data()
+        if(post_data is None):
+            return
+
+        try:
+            self.call_endpoint(real_path, ep, (form_dict, post_data), params)
+        finally:
+            web_server.close_uploads(post_data)
 
         return 
 
@@ -326,26 +1629,284 @@ class web_server(BaseHTTPRequestHandler):
     # Handle a OPTIONS request
     #
     def do_OPTIONS(self):
-        info("Handling API-options request from {}..".format(self.client_address))
+        access("Handling API-options request from {}..", self.client_address)
         self.send_web_response(webstatus.SUCCESS, "OK")
         return
 
+#
+# Response to a connection that is refused without reading its request
+#
+def refusal(status, message, retry_after):
+    body = webresponse(webstatus.SERV_FAILURE, message).json_bytes()
+    head = "HTTP/1.0 {}\r\n" \
+           "Retry-After: {}\r\n" \
+           "Content-Type: application/json\r\n" \
+           "Content-Length: {}\r\n" \
+           "Connection: close\r\n\r\n".format(status, retry_after, len(body))
+
+    return bytes(head, "utf-8") + body
+
+#
+# Send a refusal on a socket without blocking, whatever
+# does not fit in the send buffer is lost
+#
+def refuse_connection(request, status, message, retry_after):
+    try:
+        request.settimeout(0)
+        request.sendall(refusal(status, message, retry_after))
+    except OSError:
+        pass
+
+#
+# Enforces WEB_CONFIG["max_connections_per_ip"] when
+# a socketserver based server accepts a connection
+#
+class connection_limit_mixin():
+
+    # socket -> client address of the open connections, a
+    # streamed connection has no peer name once it is detached
+    open_connections = None
+
+    # set when the server shuts down, connections are
+    # closed after the request they are serving
+    draining = False
+
+    def verify_request(self, request, client_address):
+        if(self.open_connections is None):
+            self.open_connections = { }
+
+        self.open_connections[request] = client_address[0]
+
+        if(ratelimit.connections.open(client_address[0])):
+            return True
+
+        refuse_connection(request, "429 Too Many Requests", "Too many connections.", 1)
+        return False
+
+    # called for every accepted connection, refused or not
+    def shutdown_request(self, request):
+        address = self.open_connections.pop(request, None) if self.open_connections is not None else None
+        if(address is not None):
+            ratelimit.connections.close(address)
+
+        super().shutdown_request(request)
+
+    #
+    # Wake up the handlers still waiting on a connection, their
+    # next read sees the end of the stream. With SHUT_RDWR the
+    # responses being written are cut off as well.
+    #
+    def close_connections(self, how = socket.SHUT_RD):
+        for request in list(self.open_connections or ()):
+            try:
+                request.shutdown(how)
+            except OSError:
+                pass
+
 #
 # stub class of ThreadedHTTPServer
 #
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+class ThreadedHTTPServer(connection_limit_mixin, ThreadingMixIn, HTTPServer):
     pass
 
+#
+# HTTPServer with a fixed number of worker threads
+#
+# Accepted connections wait in a bounded queue, if it is full
+# the client immediately receives a 503 with Retry-After.
+#
+class PooledHTTPServer(connection_limit_mixin, HTTPServer):
+
+    def __init__(self, server_address, handler_class, workers = None, queue_size = None, bind_and_activate = True):
+        if(workers is None):
+            workers = WEB_CONFIG["pool_workers"]
+
+        if(queue_size is None):
+            queue_size = WEB_CONFIG["pool_queue_size"]
+
+        # server_close runs if binding fails
+        self.worker_threads = [ ]
+
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+        self.workers = workers
+        self.busy_workers = 0
+        self.rejected_requests = 0
+        self.stats_lock = threading.Lock()
+        self.request_queue = queue.Queue(maxsize=queue_size)
+
+        for i in range(workers):
+            t = threading.Thread(target=self.worker_loop, name="branchweb-worker-{}".format(i), daemon=True)
+            t.start()
+            self.worker_threads.append(t)
+
+    #
+    # Called by the accept loop, hands the connection to the pool
+    #
+    def process_request(self, request, client_address):
+        try:
+            self.request_queue.put_nowait((request, client_address))
+        except queue.Full:
+            with self.stats_lock:
+                self.rejected_requests += 1
+
+            self.reject_request(request)
+
+    #
+    # Answer with 503 without reading the request
+    #
+    def reject_request(self, request):
+        refuse_connection(request, "503 Service Unavailable", "Server busy.", WEB_CONFIG["pool_retry_after"])
+        self.shutdown_request(request)
+
+    def worker_loop(self):
+        while True:
+            item = self.request_queue.get()
+            if(item is None):
+                return
+
+            request, client_address = item
+
+            with self.stats_lock:
+                self.busy_workers += 1
+
+            try:
+                request.settimeout(WEB_CONFIG["read_timeout"])
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+                with self.stats_lock:
+                    self.busy_workers -= 1
+
+    #
+    # Connections accepted but not yet picked up by a worker
+    #
+    def connections_waiting(self):
+        return not self.request_queue.empty()
+
+    #
+    # Queue depth and worker utilization of the pool
+    #
+    def pool_stats(self):
+        with self.stats_lock:
+            return {
+                "workers": self.workers,
+                "busy_workers": self.busy_workers,
+                "utilization": self.busy_workers / self.workers,
+                "queue_depth": self.request_queue.qsize(),
+                "queue_size": self.request_queue.maxsize,
+                "rejected": self.rejected_requests
+            }
+
+    def server_close(self):
+        super().server_close()
+
+        for t in self.worker_threads:
+            self.request_queue.put(None)
+
+#
+# Create the server of an engine without running it
+#
+# If sock is supplied, the server accepts on that already
+# listening socket instead of binding its own.
+#
+def make_server(hostname, serverport, engine = "threaded", workers = None, queue_size = None, sock = None):
+    if(engine == "asyncio"):
+        from .asyncserver import async_server
+        return async_server(hostname, serverport, workers, sock)
+
+    if(engine == "pool"):
+        web_serv = PooledHTTPServer((hostname, serverport), web_server, workers, queue_size, bind_and_activate=sock is None)
+    elif(engine == "threaded"):
+        web_serv = ThreadedHTTPServer((hostname, serverport), web_server, bind_and_activate=sock is None)
+    else:
+        raise ValueError("Unknown server engine: {}".format(engine))
+
+    if(sock is not None):
+        web_serv.socket.close()
+        web_serv.socket = sock
+        web_serv.server_address = sock.getsockname()
+
+    return web_serv
+
+#
+# Let the connections of a stopped server finish their current
+# request, for at most timeout seconds (WEB_CONFIG["shutdown_timeout"]
+# by default). Connections waiting for a further request are closed.
+#
+# Returns True if no request was in flight anymore
+#
+def drain_server(web_serv, timeout = None):
+    if(timeout is None):
+        timeout = WEB_CONFIG["shutdown_timeout"]
+
+    web_serv.draining = True
+    deadline = time.monotonic() + timeout
+
+    # the asyncio engine drains in serve_forever
+    if(not hasattr(web_serv, "server_close")):
+        return web_server.active_requests.in_flight == 0
+
+    drained = web_server.active_requests.wait_idle(timeout)
+
+    if(hasattr(web_serv, "close_connections")):
+        web_serv.close_connections(socket.SHUT_RD if drained else socket.SHUT_RDWR)
+
+    closer = threading.Thread(target=web_serv.server_close, daemon=True)
+    closer.start()
+    closer.join(max(0, deadline - time.monotonic()))
+
+    for t in getattr(web_serv, "worker_threads", [ ]):
+        t.join(max(0, deadline - time.monotonic()))
+
+    return drained
+
 #
 # Start the webserver
 #
-def start_web_server(hostname, serverport):
+# engine selects the server implementation:
+#   "threaded" - one thread per connection (ThreadedHTTPServer)
+#   "asyncio"  - asyncio event loop, sync handlers run in a
+#                bounded thread pool, async def handlers on the loop
+#   "pool"     - fixed worker threads with a bounded accept queue
+#
+# workers and queue_size override the WEB_CONFIG defaults
+# of the "asyncio" and "pool" engines.
+#
+# With processes > 1 the server forks that many worker processes
+# sharing the port, each running the selected engine, see prefork.
+# worker_init(worker_id) is called in every worker after the fork.
+#
+# With background set the server runs in a thread and the
+# serverhandle.server_handle controlling it is returned right
+# away, errors binding the port are raised. Otherwise this
+# blocks until the server stopped and returns its handle.
+#
+def start_web_server(hostname, serverport, engine = "threaded", workers = None, queue_size = None, processes = None, worker_init = None, background = False):
+    from .serverhandle import server_handle
+
     web_serv = None
-   
+
     try:
-        web_serv = ThreadedHTTPServer((hostname, serverport), web_server)
-        web_serv.serve_forever()
+        if(processes is not None and processes > 1):
+            from .prefork import prefork_server
+            web_serv = prefork_server(hostname, serverport, processes, engine, workers, queue_size, worker_init)
+        else:
+            web_serv = make_server(hostname, serverport, engine, workers, queue_size)
+
+        handle = server_handle(web_serv, engine)
+        if(background):
+            return handle.start()
+
+        handle.serve_forever()
+        return handle
     except Exception as ex:
+        if(background):
+            raise
+
         info("Webserver failed to initialize: {}".format(ex))
         info("Thread exiting.")
-        return
+        return None
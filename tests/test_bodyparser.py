@@ -0,0 +1,44 @@
+import io
+
+import pytest
+
+from branchweb.bodyparser import chunked_reader, parse_chunk_size, parse_multipart, body_too_large, LINE_LIMIT
+
+def test_chunked_body():
+    reader = chunked_reader(io.BytesIO(b"3;ext=1\r\nabc\r\nA\r\n0123456789\r\n0\r\nTrailer: x\r\n\r\n"), 100)
+
+    assert reader.read() == b"abc0123456789"
+    assert reader.consumed() == 13
+
+@pytest.mark.parametrize("line", [ b"-1\r\n", b"-FFFFFFFF\r\n", b"+5\r\n", b"0x5\r\n", b"5 5\r\n", b"\r\n", b"1" * 17 + b"\r\n" ])
+def test_malformed_chunk_size(line):
+    with pytest.raises(ValueError):
+        parse_chunk_size(line)
+
+    reader = chunked_reader(io.BytesIO(line + b"x" * 100), 1000)
+    with pytest.raises(ValueError):
+        reader.read()
+
+def test_chunked_body_too_large():
+    reader = chunked_reader(io.BytesIO(b"400\r\n" + b"x" * 1024 + b"\r\n0\r\n\r\n"), 1000)
+
+    with pytest.raises(body_too_large):
+        reader.read()
+
+def multipart(payload: bytes) -> io.BytesIO:
+    return io.BytesIO(b"--b\r\nContent-Disposition: form-data; name=\"file\"; filename=\"f\"\r\n\r\n"
+                      + payload + b"\r\n--b\r\nContent-Disposition: form-data; name=\"x\"\r\n\r\n1\r\n--b--\r\n")
+
+@pytest.mark.parametrize("payload", [
+    b"a" * (LINE_LIMIT - 1),
+    b"a" * (LINE_LIMIT - 1) + b"\r",
+    b"a" * (LINE_LIMIT - 1) + b"\rb",
+    b"a" * (LINE_LIMIT - 2) + b"\r\n",
+    b"line\r\n" + b"a" * (LINE_LIMIT * 2 + 5),
+    b""
+], ids=("limit", "limit-cr", "limit-cr-data", "limit-crlf", "long", "empty"))
+def test_multipart_payload_at_line_limit(payload):
+    fields = parse_multipart(multipart(payload), b"b", 1024)
+
+    assert fields["file"].read() == payload
+    assert fields["x"] == "1"
@@ -0,0 +1,57 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+bcrypt = pytest.importorskip("bcrypt")
+
+from branchweb.passwordhasher import password_hasher, hasher_busy
+
+@pytest.fixture(params=(False, True), ids=("threads", "processes"))
+def hasher(request):
+    hasher = password_hasher(workers=1, max_pending=1, use_processes=request.param)
+    yield hasher
+    hasher.shutdown()
+
+def test_hash_password_waits_for_saturated_pool(hasher):
+    results = [ ]
+    errors = [ ]
+
+    def hash_one(i):
+        try:
+            results.append(hasher.hash_password("password{}".format(i)).result())
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [ threading.Thread(target=hash_one, args=(i, )) for i in range(8) ]
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    assert errors == [ ]
+    assert len(results) == 8
+
+def test_verify_rejects_when_saturated(hasher):
+    phash = hasher.hash_password("password").result()
+
+    # as if max_pending operations were running
+    hasher.max_pending = 0
+
+    with pytest.raises(hasher_busy):
+        hasher.verify("user", "password", phash)
+
+    with pytest.raises(hasher_busy):
+        hasher.hash_password("password", limited=True)
+
+    assert hasher.hash_password("password").result()
+
+def test_threads_by_default():
+    hasher = password_hasher(workers=1)
+
+    try:
+        assert isinstance(hasher.executor, ThreadPoolExecutor)
+    finally:
+        hasher.shutdown()
@@ -0,0 +1,109 @@
+import random
+import string
+import urllib.parse
+
+import pytest
+
+from branchweb.requesttarget import multi_dict, parse_query, parse_target, parse_target_uncached
+
+ALPHABET = string.ascii_letters + string.digits + "%+=&?/#;:@!$'()*,~-._ é中"
+SAFE = string.ascii_letters + string.digits + "-._"
+
+#
+# The parser of the request target before requesttarget, correct
+# for plain "/route" and "/?route=x&k=v" targets only
+#
+def legacy_form(str_form):
+    form = { }
+
+    for dataset in str_form.split("&"):
+        if("=" not in dataset):
+            continue
+
+        split = dataset.split("=")
+        form[split[0]] = split[1]
+
+    return form
+
+def legacy_target(target):
+    path = target[1:]
+    form = None
+
+    if(path and path[0] == "?" and len(path) > 1):
+        form = legacy_form(path[1:])
+        if(not form):
+            return None
+
+        return list(form)[0], form
+
+    return path, form
+
+def parsed(target):
+    result = parse_target(target)
+    if(result is None or result[1] is None):
+        return result
+
+    return result[0], multi_dict(result[1])
+
+def word(rnd):
+    return "".join(rnd.choice(SAFE) for _ in range(rnd.randint(1, 8)))
+
+def test_fuzz_never_raises():
+    rnd = random.Random(21)
+
+    for i in range(50000):
+        target = "".join(rnd.choice(ALPHABET) for _ in range(rnd.randint(0, 40)))
+        if(rnd.random() < 0.95):
+            target = "/" + target
+
+        result = parse_target_uncached(target)
+        assert result is None or isinstance(result[0], str)
+
+def test_legacy_targets_unchanged():
+    rnd = random.Random(21)
+
+    for i in range(10000):
+        keys = list(dict.fromkeys(word(rnd) for _ in range(rnd.randint(1, 5))))
+        query = "&".join("{}={}".format(key, word(rnd)) for key in keys)
+
+        for target in ("/?" + query, "/" + word(rnd), "/" + word(rnd) + "/" + word(rnd), "/"):
+            assert parsed(target) == legacy_target(target), target
+
+def test_urlencoded_bodies_match_parse_qsl():
+    rnd = random.Random(21)
+
+    for i in range(10000):
+        pairs = [ (word(rnd) + rnd.choice(("", " ", "é")), "".join(rnd.choice(ALPHABET) for _ in range(rnd.randint(1, 10)))) for _ in range(rnd.randint(1, 6)) ]
+        body = urllib.parse.urlencode(pairs)
+
+        assert dict(multi_dict(parse_query(body))) == dict(urllib.parse.parse_qsl(body)), body
+
+def test_multi_value_round_trip():
+    rnd = random.Random(21)
+
+    for i in range(10000):
+        pairs = [ (rnd.choice(("a", "b", "k y", "é")), "".join(rnd.choice(ALPHABET) for _ in range(rnd.randint(0, 10)))) for _ in range(rnd.randint(1, 6)) ]
+        route = "r/" + word(rnd)
+        route_target, form = parsed("/" + urllib.parse.quote(route) + "?" + urllib.parse.urlencode(pairs))
+
+        assert route_target == route
+        assert list(form.pairs) == pairs
+
+        for key in set(k for k, v in pairs):
+            values = [ v for k, v in pairs if k == key ]
+            assert form.getlist(key) == values
+            assert form[key] == values[-1]
+
+@pytest.mark.parametrize("target, route, form", [
+    ("/?download=a=b.txt&x=1&x=2", "download", { "download": "a=b.txt", "x": "2" }),
+    ("/files/a%20b/%2Fetc?q=%E2%9C%93+ok&flag", "files/a b/%2Fetc", { "q": "✓ ok", "flag": "" }),
+    ("/?route", "route", { "route": "" }),
+    ("http://host:80/api/v1?x=1#frag", "api/v1", { "x": "1" }),
+    ("/a?", "a", None),
+    ("*", "*", None)
+])
+def test_targets(target, route, form):
+    assert parsed(target) == (route, form)
+
+def test_not_a_path():
+    assert parse_target("host:80") is None
@@ -0,0 +1,52 @@
+import os
+import threading
+
+from branchweb.userstore import flat_file_store
+
+def test_write_atomic_concurrent_writers(tmp_path):
+    path = str(tmp_path / "users")
+    flat_file_store.write_atomic(path, "")
+    os.chmod(path, 0o640)
+
+    contents = [ "user{}=hash\n".format(i) * 1000 for i in range(8) ]
+    errors = [ ]
+
+    def write(content):
+        try:
+            for i in range(20):
+                flat_file_store.write_atomic(path, content)
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [ threading.Thread(target=write, args=(content, )) for content in contents ]
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    assert errors == [ ]
+    assert open(path).read() in contents
+    assert os.listdir(tmp_path) == [ "users" ]
+    assert os.stat(path).st_mode & 0o777 == 0o640
+
+def test_stores_sharing_a_file(tmp_path):
+    path = str(tmp_path / "users")
+    a = flat_file_store(path)
+    b = flat_file_store(path)
+    a.load_users()
+    b.load_users()
+
+    assert a.add_user("x", "h1")
+    assert b.add_user("y", "h2")
+    assert b.changed()
+
+    # x was added by a, b must not register it again
+    assert not b.add_user("x", "h3")
+
+    b.save_users({ "y": "h4" })
+    assert flat_file_store(path).load_users() == { "x": "h1", "y": "h4" }
+
+    assert a.changed()
+    assert a.load_users() == { "x": "h1", "y": "h4" }
+    assert not a.changed()
@@ -0,0 +1,239 @@
+import asyncio
+import json
+import socket
+import time
+import types
+
+import pytest
+
+from branchweb import ratelimit, webserver
+from branchweb.webserver import web_server, webstatus
+
+ENGINES = ("threaded", "pool", "asyncio")
+
+def echo(httphandler, form_data, post_data):
+    httphandler.send_web_response(webstatus.SUCCESS, len(post_data.get("data", "")))
+
+async def async_hello(httphandler, form_data):
+    await asyncio.sleep(0)
+    httphandler.send_web_response(webstatus.SUCCESS, "hello")
+    await httphandler.drain()
+
+web_server.register_post_endpoints({ "test/echo": echo })
+web_server.register_get_endpoints({ "test/async": async_hello })
+web_server.register_get_endpoints({ "test/private": async_hello }, requires_auth=True, rate_limit=(0.001, 2))
+
+def start(engine, **kwargs):
+    return webserver.start_web_server("127.0.0.1", 0, engine=engine, background=True, **kwargs)
+
+@pytest.fixture(scope="module", params=ENGINES)
+def server(request):
+    handle = start(request.param)
+    yield handle
+    handle.stop(1)
+
+def connect(handle):
+    sock = socket.create_connection(handle.address(), timeout=5)
+    return sock, sock.makefile("rb")
+
+#
+# Read one response, returns (status line, headers dict, body)
+#
+def read_response(rfile):
+    status = rfile.readline().decode().strip()
+    headers = { }
+
+    while True:
+        line = rfile.readline().decode().strip()
+        if(not line):
+            break
+
+        key, _, value = line.partition(":")
+        headers[key.strip().lower()] = value.strip()
+
+    length = int(headers.get("content-length", 0))
+    return status, headers, rfile.read(length)
+
+def test_expect_continue_keeps_connection(server):
+    sock, rfile = connect(server)
+    body = json.dumps({ "data": "x" * 100 }).encode()
+
+    for i in range(2):
+        sock.sendall(b"POST /test/echo HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n"
+                     b"Expect: 100-continue\r\nContent-Length: %d\r\n\r\n" % len(body))
+
+        status, headers, data = read_response(rfile)
+        assert status == "HTTP/1.1 100 Continue"
+        assert "connection" not in headers
+
+        sock.sendall(body)
+        status, headers, data = read_response(rfile)
+        assert status == "HTTP/1.1 200 OK"
+        assert headers.get("connection") != "close"
+        assert json.loads(data)["payload"] == 100
+
+    sock.close()
+
+def test_pool_idle_connection_releases_worker(monkeypatch):
+    monkeypatch.setitem(webserver.WEB_CONFIG, "keepalive_timeout", 0.5)
+    handle = start("pool", workers=1)
+    body = json.dumps({ "data": "x" }).encode()
+    request = (b"POST /test/echo HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n"
+               b"Content-Length: %d\r\n\r\n" % len(body)) + body
+
+    try:
+        # keeps the only worker with an idle connection
+        idle, idle_rfile = connect(handle)
+        idle.sendall(request)
+        assert read_response(idle_rfile)[0] == "HTTP/1.1 200 OK"
+
+        started = time.monotonic()
+        sock, rfile = connect(handle)
+        sock.sendall(request)
+        assert read_response(rfile)[0] == "HTTP/1.1 200 OK"
+        assert time.monotonic() - started < 3
+
+        sock.close()
+        idle.close()
+    finally:
+        handle.stop(1)
+
+def test_async_incomplete_body_times_out(monkeypatch):
+    monkeypatch.setitem(webserver.WEB_CONFIG, "read_timeout", 0.5)
+    handle = start("asyncio")
+
+    try:
+        sock, rfile = connect(handle)
+        sock.sendall(b"POST /test/echo HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n"
+                     b"Content-Length: 100\r\n\r\n{")
+
+        # closed without a response once the body stalls
+        assert rfile.read() == b""
+        sock.close()
+    finally:
+        assert handle.stop(1)
+
+def test_start_listens_before_returning(server):
+    assert server.running()
+    assert server.address()[1] != 0
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_start_raises_bind_error(engine):
+    taken = socket.socket()
+    taken.bind(("127.0.0.1", 0))
+    taken.listen()
+
+    try:
+        with pytest.raises(OSError):
+            webserver.start_web_server("127.0.0.1", taken.getsockname()[1], engine=engine, background=True)
+    finally:
+        taken.close()
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_stop_leaves_other_servers_running(engine):
+    stopped = start(engine)
+    handle = start(engine)
+    body = json.dumps({ "data": "x" }).encode()
+
+    try:
+        stopped.stop(1)
+        assert not handle.stats()["draining"]
+
+        sock, rfile = connect(handle)
+        sock.sendall(b"POST /test/echo HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n"
+                     b"Content-Length: %d\r\n\r\n" % len(body) + body)
+
+        status, headers, data = read_response(rfile)
+        assert status == "HTTP/1.1 200 OK"
+        assert headers.get("connection") != "close"
+        sock.close()
+    finally:
+        handle.stop(1)
+
+def test_negative_chunk_size_rejected(server, monkeypatch):
+    monkeypatch.setitem(webserver.WEB_CONFIG, "max_body_size", 1000)
+
+    sock, rfile = connect(server)
+    sock.sendall(b"POST /test/echo HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n"
+                 b"Transfer-Encoding: chunked\r\n\r\n-1\r\n" + b"x" * 4096)
+
+    status, headers, data = read_response(rfile)
+    assert status != "HTTP/1.1 200 OK" or json.loads(data)["status"] == webstatus.SERV_FAILURE.name
+    sock.close()
+
+def test_async_handler_on_every_engine(server):
+    sock, rfile = connect(server)
+    sock.sendall(b"GET /test/async HTTP/1.1\r\nHost: x\r\n\r\n")
+
+    status, headers, data = read_response(rfile)
+    assert status == "HTTP/1.1 200 OK"
+    assert json.loads(data)["payload"] == "hello"
+    sock.close()
+
+def test_rate_limit_before_authentication(server):
+    ratelimit.limiter.reset()
+    sock, rfile = connect(server)
+    statuses = [ ]
+
+    for i in range(3):
+        sock.sendall(b"GET /test/private HTTP/1.1\r\nHost: x\r\nAuthorization: Bearer bogus\r\n\r\n")
+        statuses.append(read_response(rfile)[0])
+
+    assert statuses == [ "HTTP/1.1 200 OK", "HTTP/1.1 200 OK", "HTTP/1.1 429 Too Many Requests" ]
+    sock.close()
+
+class key_owner_stub():
+
+    def get_key_owner(self, key_id):
+        return types.SimpleNamespace(name="user") if key_id == "good" else None
+
+def test_rate_limit_charges_authenticated_user(server, monkeypatch):
+    ratelimit.limiter.reset()
+    monkeypatch.setattr(web_server, "usermanager", key_owner_stub())
+    sock, rfile = connect(server)
+    statuses = [ ]
+
+    for key in (b"good", b"good", b"good", b"bogus", b"bogus"):
+        sock.sendall(b"GET /test/private HTTP/1.1\r\nHost: x\r\nAuthorization: Bearer " + key + b"\r\n\r\n")
+        status, headers, data = read_response(rfile)
+        statuses.append((status, data and json.loads(data)["status"]))
+
+    assert statuses == [
+        ("HTTP/1.1 200 OK", webstatus.SUCCESS.name),
+        ("HTTP/1.1 200 OK", webstatus.SUCCESS.name),
+        ("HTTP/1.1 429 Too Many Requests", webstatus.SERV_FAILURE.name),
+        ("HTTP/1.1 200 OK", webstatus.AUTH_FAILURE.name),
+        ("HTTP/1.1 200 OK", webstatus.AUTH_FAILURE.name)
+    ]
+    sock.close()
+
+def slow(httphandler, form_data):
+    time.sleep(5)
+    httphandler.send_web_response(webstatus.SUCCESS, "slow")
+
+web_server.register_get_endpoints({ "test/slow": slow })
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_prefork_stop_honors_timeout(engine):
+    probe = socket.create_server(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    handle = webserver.start_web_server("127.0.0.1", port, engine=engine, processes=2, background=True)
+
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            break
+        except ConnectionRefusedError:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+    sock.sendall(b"GET /test/slow HTTP/1.1\r\nHost: x\r\n\r\n")
+    time.sleep(0.5)
+
+    started = time.monotonic()
+    assert handle.stop(0.5)
+    assert time.monotonic() - started < 3
+    sock.close()